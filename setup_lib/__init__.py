@@ -0,0 +1,6 @@
+"""
+Helper modules which are shared by the deployment scripts in the root directory of this repo.
+"""
+
+# directory on the remote host where the setup tool stores its state (e.g. completed step fingerprints)
+REMOTE_STATE_DIR = "~/.nc_setup_tool"
@@ -0,0 +1,177 @@
+"""
+Offline (air-gapped) bootstrap of k3s and the mattermost stack: the k3s binary with its airgap images, helm, the
+chart archives and all container images are collected once into the local artifact cache, pushed to the node and
+imported by k3s at startup (from `K3S_IMAGES_DIR`). Nothing is pulled from the internet on the node.
+
+The versions are pinned. The image lists must match the chart versions (see `values.yaml` of the charts) when
+they are updated.
+
+Container images are saved locally with `skopeo` (preferred) or `docker`. Mutable tags (e.g. `latest`) are cached
+as well; delete the file below `~/.cache/nextcloud_setup_tool/images` to refresh such an image.
+"""
+
+import os
+import shutil
+import subprocess
+
+import deploymentutils as du
+
+from .artifacts import ArtifactCache
+
+
+ARCH = "amd64"
+
+K3S_VERSION = "v1.31.4+k3s1"
+HELM_VERSION = "v3.16.3"
+INGRESS_NGINX_CHART_VERSION = "4.11.3"
+CERT_MANAGER_CHART_VERSION = "v1.16.2"
+
+# images used by the charts (with the values set by the helm script)
+CHART_IMAGES = [
+    "registry.k8s.io/ingress-nginx/controller:v1.11.3",
+    "registry.k8s.io/ingress-nginx/kube-webhook-certgen:v1.4.4",
+    *(
+        f"quay.io/jetstack/cert-manager-{name}:{CERT_MANAGER_CHART_VERSION}"
+        for name in ("controller", "webhook", "cainjector", "acmesolver", "startupapicheck")
+    ),
+]
+
+# helm values which make the charts use the imported images (imported images have no registry digest)
+CHART_AIRGAP_VALUES = {
+    "ingress-nginx": "--set controller.image.digest= --set controller.admissionWebhooks.patch.image.digest=",
+    "cert-manager": "",
+}
+
+REMOTE_AIRGAP_DIR = "~/airgap"
+K3S_IMAGES_DIR = "/var/lib/rancher/k3s/agent/images"
+
+
+def _k3s_url(fname: str) -> str:
+    return f"https://github.com/k3s-io/k3s/releases/download/{K3S_VERSION.replace('+', '%2B')}/{fname}"
+
+
+def release_artifacts() -> dict:
+    """
+    Return {name: (url, fetch kwargs)} of all downloadable artifacts.
+    """
+    k3s_checksums = _k3s_url(f"sha256sum-{ARCH}.txt")
+    k3s_install_url = f"https://raw.githubusercontent.com/k3s-io/k3s/{K3S_VERSION.replace('+', '%2B')}/install.sh"
+    helm_url = f"https://get.helm.sh/helm-{HELM_VERSION}-linux-{ARCH}.tar.gz"
+    return {
+        "k3s": (_k3s_url("k3s" if ARCH == "amd64" else f"k3s-{ARCH}"), {"checksum_url": k3s_checksums}),
+        "k3s-images": (_k3s_url(f"k3s-airgap-images-{ARCH}.tar.zst"), {"checksum_url": k3s_checksums}),
+        # the install script of the pinned release (instead of the latest one from get.k3s.io)
+        "k3s-install": (k3s_install_url, {}),
+        "helm": (helm_url, {"checksum_url": f"{helm_url}.sha256sum"}),
+        "ingress-nginx": (
+            "https://github.com/kubernetes/ingress-nginx/releases/download/"
+            f"helm-chart-{INGRESS_NGINX_CHART_VERSION}/ingress-nginx-{INGRESS_NGINX_CHART_VERSION}.tgz",
+            {},
+        ),
+        "cert-manager": (f"https://charts.jetstack.io/charts/cert-manager-{CERT_MANAGER_CHART_VERSION}.tgz", {}),
+    }
+
+
+def image_fname(image: str) -> str:
+    return image.replace("/", "_").replace(":", "_").replace("@", "_") + ".tar"
+
+
+def _save_image_cmd(image: str, fpath: str) -> list:
+    if shutil.which("skopeo"):
+        return [
+            "skopeo", "copy", "--override-os", "linux", "--override-arch", ARCH,
+            f"docker://{image}", f"docker-archive:{fpath}:{image}",
+        ]
+    if shutil.which("docker"):
+        return ["sh", "-c", f"docker pull --platform linux/{ARCH} {image} && docker save -o {fpath} {image}"]
+    msg = "saving container images requires `skopeo` or `docker` on the control machine"
+    raise FileNotFoundError(msg)
+
+
+class AirgapBundle:
+    """
+    Usage:
+
+        airgap = AirgapBundle(artifact_cache, images=["postgres:15-alpine"])
+        airgap.collect()            # local, only missing artifacts are downloaded
+        airgap.push(c)              # before k3s is installed
+        airgap.install_k3s(c, "--disable traefik")
+        airgap.install_helm(c)
+        c.run(f"helm upgrade --install ingress-nginx {airgap.chart('ingress-nginx')} ...")
+    """
+
+    def __init__(self, artifact_cache: ArtifactCache, images: list = ()):
+        self.artifact_cache = artifact_cache
+        self.artifacts = release_artifacts()
+        self.images = [*CHART_IMAGES, *images]
+        self.image_dir = os.path.join(artifact_cache.cache_dir, "images")
+        self.entries = {}
+
+    def remote_fpath(self, name: str) -> str:
+        url = self.artifacts[name][0]
+        return f"{REMOTE_AIRGAP_DIR}/{os.path.basename(url)}"
+
+    def chart(self, name: str) -> str:
+        """
+        Return the remote path of the chart archive (to be used instead of `repo/chart`) and the helm values.
+        """
+        return f"{self.remote_fpath(name)} {CHART_AIRGAP_VALUES[name]}".strip()
+
+    def collect(self):
+        """
+        Download all artifacts and save all container images into the local cache (only once).
+        """
+        for name, (url, fetch_kwargs) in self.artifacts.items():
+            self.entries[name] = self.artifact_cache.fetch(url, **fetch_kwargs)
+
+        os.makedirs(self.image_dir, exist_ok=True)
+        for image in self.images:
+            fpath = os.path.join(self.image_dir, image_fname(image))
+            if os.path.isfile(fpath):
+                continue
+            print(f"saving container image {image} to local artifact cache")
+            tmp_fpath = f"{fpath}.part"
+            if os.path.exists(tmp_fpath):
+                os.remove(tmp_fpath)
+            res = subprocess.run(_save_image_cmd(image, tmp_fpath))
+            if res.returncode != 0:
+                msg = f"could not save container image {image}"
+                raise ValueError(msg)
+            os.replace(tmp_fpath, fpath)
+
+    def push(self, c: du.StateConnection):
+        """
+        Push all artifacts to the node (unchanged files are skipped) and place the images where k3s imports them
+        at startup.
+        """
+        if not self.entries:
+            self.collect()
+        c.run(f"mkdir -p {REMOTE_AIRGAP_DIR}/images", use_dir=False)
+        for name, (url, fetch_kwargs) in self.artifacts.items():
+            self.artifact_cache.push(c, url, self.remote_fpath(name), **fetch_kwargs)
+        for image in self.images:
+            fname = image_fname(image)
+            c.rsync_upload(
+                os.path.join(self.image_dir, fname), f"{REMOTE_AIRGAP_DIR}/images/{fname}", "remote",
+                additional_flags="--partial",
+            )
+
+        c.run(
+            f"sudo mkdir -p {K3S_IMAGES_DIR} && "
+            f"sudo cp -u {REMOTE_AIRGAP_DIR}/images/*.tar {self.remote_fpath('k3s-images')} {K3S_IMAGES_DIR}/",
+            use_dir=False,
+        )
+
+    def install_k3s(self, c: du.StateConnection, args: str = ""):
+        """
+        Install k3s from the pushed binary (the install script (re)starts k3s, which imports the images).
+        """
+        c.run(f"sudo install -m 755 {self.remote_fpath('k3s')} /usr/local/bin/k3s", use_dir=False)
+        c.run(f"INSTALL_K3S_SKIP_DOWNLOAD=true sh {self.remote_fpath('k3s-install')} {args}", use_dir=False)
+
+    def install_helm(self, c: du.StateConnection):
+        c.run(
+            f"tar -xzf {self.remote_fpath('helm')} -C /tmp linux-{ARCH}/helm && "
+            f"sudo install -m 755 /tmp/linux-{ARCH}/helm /usr/local/bin/helm",
+            use_dir=False,
+        )
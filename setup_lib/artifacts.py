@@ -0,0 +1,144 @@
+"""
+Local content-addressed cache for downloaded artifacts (e.g. the Nextcloud release tarball).
+
+Artifacts are downloaded once on the control machine, verified against their published sha256 checksum and then
+pushed to the hosts (rsync delta transfer). Hosts which already have the file with the right hash are skipped.
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+import contextlib
+import urllib.request
+
+import deploymentutils as du
+
+
+LOCAL_CACHE_DIR = os.path.expanduser("~/.cache/nextcloud_setup_tool")
+
+
+def sha256_of_file(fpath: str) -> str:
+    h = hashlib.sha256()
+    with open(fpath, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ArtifactCache:
+    """
+    Layout of the cache directory:
+
+        index/<sha1 of url>.json    {"url": ..., "sha256": ..., "fpath": ...}
+        sha256/<hash>/<basename>    the actual file
+    """
+
+    def __init__(self, cache_dir: str = None):
+        self.cache_dir = cache_dir or LOCAL_CACHE_DIR
+        os.makedirs(os.path.join(self.cache_dir, "index"), exist_ok=True)
+
+    def _index_fpath(self, url: str) -> str:
+        key = hashlib.sha1(url.encode("utf8")).hexdigest()
+        return os.path.join(self.cache_dir, "index", f"{key}.json")
+
+    @contextlib.contextmanager
+    def _lock(self, url: str):
+        # prevent concurrent downloads of the same url (e.g. in fleet mode)
+        with open(f"{self._index_fpath(url)}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def lookup(self, url: str):
+        """
+        Return the index entry of `url` (or None if it is not cached or the file is missing).
+        """
+        try:
+            with open(self._index_fpath(url)) as fp:
+                entry = json.load(fp)
+        except FileNotFoundError:
+            return None
+        if not os.path.isfile(entry["fpath"]):
+            return None
+        return entry
+
+    @staticmethod
+    def fetch_checksum(checksum_url: str, fname: str = None) -> str:
+        """
+        Download a checksum file (format of `sha256sum`: "<hash>  <filename>") and return the hash.
+        If the file lists several files (e.g. the k3s releases), the line of `fname` is used.
+        """
+        with urllib.request.urlopen(checksum_url) as response:
+            lines = [line.split() for line in response.read().decode("utf8").splitlines() if line.strip()]
+        if len(lines) > 1 and fname is not None:
+            lines = [parts for parts in lines if parts[-1].lstrip("*") == fname]
+            if not lines:
+                msg = f"{checksum_url} contains no checksum for {fname}"
+                raise ValueError(msg)
+        return lines[0][0].lower()
+
+    def fetch(self, url: str, sha256: str = None, checksum_url: str = None) -> dict:
+        """
+        Return the index entry of `url` and download the file first if necessary.
+
+        :param sha256:          expected hash (optional)
+        :param checksum_url:    url of the published checksum file (optional, used if `sha256` is None)
+        """
+        with self._lock(url):
+            entry = self.lookup(url)
+            # cached files have been verified when they were downloaded
+            if entry is not None and sha256 in (None, entry["sha256"]):
+                return entry
+
+            if sha256 is None and checksum_url is not None:
+                sha256 = self.fetch_checksum(checksum_url, os.path.basename(url))
+
+            print(f"downloading {url} to local artifact cache")
+            h = hashlib.sha256()
+            fd, tmp_fpath = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as fp, urllib.request.urlopen(url) as response:
+                    for chunk in iter(lambda: response.read(1 << 20), b""):
+                        h.update(chunk)
+                        fp.write(chunk)
+                digest = h.hexdigest()
+                if sha256 is not None and digest != sha256:
+                    msg = f"checksum mismatch for {url}: expected {sha256}, got {digest}"
+                    raise ValueError(msg)
+
+                target_dir = os.path.join(self.cache_dir, "sha256", digest)
+                os.makedirs(target_dir, exist_ok=True)
+                fpath = os.path.join(target_dir, os.path.basename(url))
+                os.replace(tmp_fpath, fpath)
+            finally:
+                if os.path.exists(tmp_fpath):
+                    os.remove(tmp_fpath)
+
+            entry = {"url": url, "sha256": digest, "fpath": fpath}
+            index_fpath = self._index_fpath(url)
+            with open(f"{index_fpath}.tmp", "w") as fp:
+                json.dump(entry, fp, indent=2)
+            os.replace(f"{index_fpath}.tmp", index_fpath)
+            return entry
+
+    def push(self, c: du.StateConnection, url: str, remote_fpath: str, **fetch_kwargs) -> dict:
+        """
+        Ensure that the artifact of `url` is present at `remote_fpath` on the host.
+        The transfer is skipped if the remote file already has the right hash.
+        """
+        entry = self.fetch(url, **fetch_kwargs)
+
+        if not getattr(c, "records_only", False):
+            res = c.run(f"sha256sum {remote_fpath} 2>/dev/null || true", hide=True, use_dir=False)
+            remote_hash = res.stdout.split()[0] if res.stdout.strip() else None
+            if remote_hash == entry["sha256"]:
+                print(du.dim(f"{remote_fpath} is up to date (sha256 {entry['sha256'][:12]}), skipping transfer"))
+                return entry
+
+        # rsync only transfers the differences if an older/partial version exists at the destination
+        c.rsync_upload(entry["fpath"], remote_fpath, "remote", additional_flags="--partial")
+        return entry
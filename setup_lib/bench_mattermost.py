@@ -0,0 +1,538 @@
+"""
+Load benchmark of the Mattermost deployment (REST API and websockets) with a capacity report: latency percentiles
+and error rates next to the cpu and memory of the pods (sampled with `kubectl top` on the node) relative to their
+limits. It shows whether the sizing (replicas, requests/limits, see setup_lib/k8s_sizing.py) holds for a user count.
+
+usage (from the root directory of this repo; site_url, remote and user are read from config.toml):
+
+    python -m setup_lib.bench_mattermost run --admin-token <token> --users 50 --posts-per-s 5 --duration 120
+    python -m setup_lib.bench_mattermost run --admin-login admin --admin-password <pw> --cleanup
+    python -m setup_lib.bench_mattermost compare bench_results/<old>.json bench_results/<new>.json
+
+Setup (reused by later runs): team `nst-bench`, `--channels` open channels and `--users` users (`nst-bench-<i>`, all
+members of all channels, passwords are reset by the admin on every run). `--cleanup` deactivates the users and
+archives the channels at the end.
+
+Phases:
+
+    login           login of every user
+    ws_connect      websocket connection + authentication of every user (until the `hello` event)
+    post            messages posted at `--posts-per-s` (all users together)
+    channel_load    channel switches at `--loads-per-s` (last 60 posts + mark the channel as viewed)
+    ws_delivery     time from posting a message until a member receives the `posted` event (fan-out)
+
+`post` and `channel_load` are started on a fixed schedule (open loop); their latency is measured from the scheduled
+start, so a saturated server shows up as growing latency instead of a lower request rate.
+
+Websocket phases need the optional package `websocket-client` (`pip install websocket-client`); without it they
+are skipped.
+"""
+
+import os
+import ssl
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tomllib
+except ModuleNotFoundError:
+    import tomli as tomllib
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+import deploymentutils as du
+
+from . import benchmarking
+from .fleet import config_fpath
+from .k8s_sizing import parse_cpu, parse_memory
+
+
+TEAM_NAME = "nst-bench"
+USER_PREFIX = "nst-bench"
+MESSAGE_MARKER = "nst-bench"
+
+NAMESPACES = ("mattermost", "ingress-nginx")
+
+# share of the limit above which the capacity report warns
+HIGH_USAGE = 0.8
+
+
+class MattermostError(Exception):
+    pass
+
+
+class MattermostClient:
+    """
+    Minimal REST client (one keep-alive connection per thread).
+    """
+
+    def __init__(self, url: str, token: str = None, insecure=False, timeout=30):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.netloc = parts.netloc
+        self.base_path = parts.path.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+        self.insecure = insecure
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.https:
+                context = ssl._create_unverified_context() if self.insecure else None
+                conn = http.client.HTTPSConnection(self.netloc, timeout=self.timeout, context=context)
+            else:
+                conn = http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def request(self, method: str, path: str, payload=None, return_response=False):
+        """
+        Return the decoded json response; raise MattermostError for status codes >= 400.
+        """
+        headers = {"Content-Type": "application/json", "X-Requested-With": "XMLHttpRequest"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        body = None if payload is None else json.dumps(payload)
+        conn = self._connection()
+        try:
+            conn.request(method, f"{self.base_path}/api/v4{path}", body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._local.conn = None
+            raise
+        if response.status >= 400:
+            msg = f"{method} {path}: {response.status} {data[:200].decode(errors='replace')}"
+            raise MattermostError(msg)
+        result = json.loads(data) if data else None
+        return (result, response) if return_response else result
+
+    def login(self, login_id: str, password: str) -> str:
+        _, response = self.request("POST", "/users/login", {"login_id": login_id, "password": password}, True)
+        self.token = response.getheader("Token")
+        return self.token
+
+
+class MattermostBenchmark:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.recorder = benchmarking.LatencyRecorder()
+        self.admin = MattermostClient(args.url, token=args.admin_token, insecure=args.insecure)
+        self.password = f"Nst-{os.urandom(12).hex()}!"
+        self.users = []
+        self.channel_ids = []
+        self.websockets = []
+        self.stop_event = threading.Event()
+
+    # setup ----------------------------------------------------------------------------------------------
+
+    def get_or_create(self, get_path: str, create_path: str, payload: dict) -> dict:
+        try:
+            return self.admin.request("GET", get_path)
+        except MattermostError:
+            return self.admin.request("POST", create_path, payload)
+
+    def setup(self):
+        args = self.args
+        if not self.admin.token:
+            self.admin.login(args.admin_login, args.admin_password)
+        team = self.get_or_create(
+            f"/teams/name/{TEAM_NAME}", "/teams", {"name": TEAM_NAME, "display_name": "nst benchmark", "type": "I"}
+        )
+        self.team_id = team["id"]
+        for j in range(args.channels):
+            name = f"{TEAM_NAME}-{j}"
+            channel = self.get_or_create(
+                f"/teams/{self.team_id}/channels/name/{name}?include_deleted=true",
+                "/channels",
+                {"team_id": self.team_id, "name": name, "display_name": name, "type": "O"},
+            )
+            if channel.get("delete_at"):
+                # archived by the cleanup of an earlier run
+                self.admin.request("POST", f"/channels/{channel['id']}/restore")
+            self.channel_ids.append(channel["id"])
+
+        for i in range(args.users):
+            username = f"{USER_PREFIX}-{i}"
+            user = self.get_or_create(
+                f"/users/username/{username}",
+                "/users",
+                {"username": username, "email": f"{username}@example.com", "password": self.password},
+            )
+            self.admin.request("PUT", f"/users/{user['id']}/active", {"active": True})
+            self.admin.request("PUT", f"/users/{user['id']}/password", {"new_password": self.password})
+            self.users.append({"id": user["id"], "username": username})
+
+        user_ids = [user["id"] for user in self.users]
+        for start in range(0, len(user_ids), 100):
+            members = [{"team_id": self.team_id, "user_id": user_id} for user_id in user_ids[start:start + 100]]
+            self.admin.request("POST", f"/teams/{self.team_id}/members/batch", members)
+        for channel_id in self.channel_ids:
+            for user_id in user_ids:
+                self.admin.request("POST", f"/channels/{channel_id}/members", {"user_id": user_id})
+        print(du.dim(f"setup: team {TEAM_NAME}, {len(self.channel_ids)} channels, {len(self.users)} users"))
+
+    def cleanup(self):
+        for user in self.users:
+            self.admin.request("DELETE", f"/users/{user['id']}")
+        for channel_id in self.channel_ids:
+            self.admin.request("DELETE", f"/channels/{channel_id}")
+        print(du.dim("cleanup: users deactivated, channels archived"))
+
+    # phases ---------------------------------------------------------------------------------------------
+
+    def phase_login(self):
+        def login(user):
+            user["client"] = MattermostClient(self.args.url, insecure=self.args.insecure)
+            with self.recorder.measure("login"):
+                user["client"].login(user["username"], self.password)
+
+        with self.recorder.phase("login"), ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            list(executor.map(login, self.users))
+        self.users = [user for user in self.users if user["client"].token]
+
+    def _ws_url(self) -> str:
+        parts = urllib.parse.urlsplit(self.args.url)
+        scheme = "wss" if parts.scheme == "https" else "ws"
+        return f"{scheme}://{parts.netloc}{parts.path.rstrip('/')}/api/v4/websocket"
+
+    def _receive(self, ws):
+        while not self.stop_event.is_set():
+            try:
+                message = ws.recv()
+            except websocket.WebSocketTimeoutException:
+                continue
+            except Exception:
+                return
+            if not message:
+                continue
+            event = json.loads(message)
+            if event.get("event") != "posted":
+                continue
+            text = json.loads(event["data"]["post"]).get("message", "")
+            parts = text.split()
+            if len(parts) == 3 and parts[0] == MESSAGE_MARKER:
+                self.recorder.record("ws_delivery", time.time() - float(parts[2]))
+
+    def phase_ws_connect(self):
+        sslopt = {"cert_reqs": 0} if self.args.insecure else None
+
+        def connect(user):
+            with self.recorder.measure("ws_connect"):
+                ws = websocket.create_connection(
+                    self._ws_url(), header=[f"Authorization: Bearer {user['client'].token}"], timeout=30, sslopt=sslopt
+                )
+                # the server sends `hello` after the authentication
+                while json.loads(ws.recv()).get("event") != "hello":
+                    pass
+                ws.settimeout(1)
+                self.websockets.append(ws)
+                threading.Thread(target=self._receive, args=(ws,), daemon=True).start()
+
+        with self.recorder.phase("ws_connect"), ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            list(executor.map(connect, self.users))
+
+    def post(self, t_scheduled: float, rng: random.Random):
+        user, channel_id = rng.choice(self.users), rng.choice(self.channel_ids)
+        message = f"{MESSAGE_MARKER} {rng.getrandbits(32):08x} {time.time()}"
+        try:
+            user["client"].request("POST", "/posts", {"channel_id": channel_id, "message": message})
+            self.recorder.record("post", time.perf_counter() - t_scheduled)
+        except Exception as err:
+            self.recorder.record("post", time.perf_counter() - t_scheduled, ok=False, error=str(err)[:200])
+
+    def channel_load(self, t_scheduled: float, rng: random.Random):
+        user, channel_id = rng.choice(self.users), rng.choice(self.channel_ids)
+        try:
+            user["client"].request("GET", f"/channels/{channel_id}/posts?page=0&per_page=60")
+            user["client"].request("POST", "/channels/members/me/view", {"channel_id": channel_id})
+            self.recorder.record("channel_load", time.perf_counter() - t_scheduled)
+        except Exception as err:
+            self.recorder.record("channel_load", time.perf_counter() - t_scheduled, ok=False, error=str(err)[:200])
+
+    def phase_load(self):
+        """
+        Start `post` and `channel_load` on a fixed schedule (open loop) for `--duration` seconds.
+        """
+        args = self.args
+        schedule = []
+        for op, rate in ((self.post, args.posts_per_s), (self.channel_load, args.loads_per_s)):
+            if rate > 0:
+                schedule.extend((i / rate, op) for i in range(int(args.duration * rate)))
+        schedule.sort(key=lambda item: item[0])
+
+        rng = random.Random(0)
+        # enough workers for the rates even with slow responses
+        with ThreadPoolExecutor(max_workers=max(args.concurrency, 4)) as executor:
+            with self.recorder.phase("post"), self.recorder.phase("channel_load"):
+                t0 = time.perf_counter()
+                for offset, op in schedule:
+                    delay = t0 + offset - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    executor.submit(op, t0 + offset, random.Random(rng.random()))
+                executor.shutdown(wait=True)
+        # late websocket events
+        time.sleep(2)
+
+    def run(self, sampler: "ResourceSampler" = None) -> dict:
+        args = self.args
+        started = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.setup()
+        try:
+            self.phase_login()
+            if websocket is None:
+                print(du.yellow("websocket-client is not installed -> websocket phases are skipped"))
+            elif not args.no_websockets:
+                self.phase_ws_connect()
+            if sampler is not None:
+                sampler.start()
+            self.phase_load()
+        finally:
+            if sampler is not None:
+                sampler.stop()
+            self.stop_event.set()
+            for ws in self.websockets:
+                ws.close()
+            if args.cleanup:
+                self.cleanup()
+
+        if "ws_delivery" in self.recorder.latencies:
+            self.recorder.durations["ws_delivery"] = self.recorder.durations["post"]
+        params = {
+            key: getattr(args, key) for key in ("users", "channels", "posts_per_s", "loads_per_s", "duration")
+        }
+        return {
+            "tool": "bench_mattermost",
+            "target": args.url,
+            "started": started,
+            "params": {**params, "websockets": len(self.websockets)},
+            "phases": self.recorder.summary(),
+            "resources": sampler.summary() if sampler is not None else {},
+        }
+
+
+# ------------------------------------------------------------------------------------------------
+# pod resources
+
+
+class ResourceSampler:
+    """
+    Samples `kubectl top pods` (metrics-server of k3s) in a background thread. `kubectl_cmd` is run locally, e.g.
+    `ssh user@node KUBECONFIG=~/.kube/config kubectl`.
+    """
+
+    def __init__(self, kubectl_cmd: str, interval_s=5.0, namespaces=NAMESPACES):
+        self.kubectl_cmd = kubectl_cmd
+        self.interval_s = interval_s
+        self.namespaces = namespaces
+        self.samples = {}
+        self.limits = {}
+        self.errors = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _kubectl(self, args: str) -> str:
+        res = subprocess.run(f"{self.kubectl_cmd} {args}", shell=True, capture_output=True, text=True, timeout=30)
+        if res.returncode != 0:
+            msg = f"kubectl {args}: {res.stderr.strip()[:200]}"
+            raise ValueError(msg)
+        return res.stdout
+
+    def read_limits(self):
+        pods = json.loads(self._kubectl("get pods -A -o json"))["items"]
+        for pod in pods:
+            namespace = pod["metadata"]["namespace"]
+            if namespace not in self.namespaces:
+                continue
+            limits = [container.get("resources", {}).get("limits", {}) for container in pod["spec"]["containers"]]
+            self.limits[f"{namespace}/{pod['metadata']['name']}"] = {
+                "cpu_limit_m": sum(parse_cpu(limit["cpu"]) for limit in limits if "cpu" in limit) or None,
+                "memory_limit_mb": sum(parse_memory(limit["memory"]) for limit in limits if "memory" in limit) or None,
+            }
+
+    def sample(self):
+        for line in self._kubectl("top pods -A --no-headers").splitlines():
+            fields = line.split()
+            if len(fields) != 4 or fields[0] not in self.namespaces:
+                continue
+            namespace, name, cpu, memory = fields
+            self.samples.setdefault(f"{namespace}/{name}", []).append((parse_cpu(cpu), parse_memory(memory)))
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception as err:
+                self.errors.append(str(err))
+            self._stop.wait(self.interval_s)
+
+    def start(self):
+        try:
+            self.read_limits()
+        except Exception as err:
+            self.errors.append(str(err))
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def summary(self) -> dict:
+        res = {}
+        for pod, samples in self.samples.items():
+            cpu, memory = zip(*samples)
+            res[pod] = {
+                "samples": len(samples),
+                "cpu_m_mean": round(sum(cpu) / len(cpu)),
+                "cpu_m_max": max(cpu),
+                "memory_mb_mean": round(sum(memory) / len(memory)),
+                "memory_mb_max": max(memory),
+                **self.limits.get(pod, {"cpu_limit_m": None, "memory_limit_mb": None}),
+            }
+        if self.errors:
+            res["_errors"] = self.errors[:3]
+        return res
+
+
+def capacity_report(results: dict) -> str:
+    lines = ["pod resources during the load (max / limit):"]
+    resources = {pod: stats for pod, stats in results.get("resources", {}).items() if not pod.startswith("_")}
+    for pod, stats in resources.items():
+        parts = []
+        for key, limit_key, unit in (("cpu_m_max", "cpu_limit_m", "m"), ("memory_mb_max", "memory_limit_mb", " MiB")):
+            limit = stats[limit_key]
+            text = f"{stats[key]}{unit} / {f'{limit}{unit}' if limit else 'no limit'}"
+            if limit and stats[key] > HIGH_USAGE * limit:
+                text = du.bred(f"{text} ({stats[key] / limit:.0%})")
+            parts.append(text)
+        lines.append(f"  {pod:<48} cpu {parts[0]:<24} memory {parts[1]}")
+    for error in results.get("resources", {}).get("_errors", []):
+        lines.append(du.yellow(f"  sampling error: {error}"))
+    if not resources:
+        lines.append("  (no samples)")
+
+    params = results["params"]
+    overloaded = [
+        pod for pod, stats in resources.items()
+        if any(
+            stats[limit_key] and stats[key] > HIGH_USAGE * stats[limit_key]
+            for key, limit_key in (("cpu_m_max", "cpu_limit_m"), ("memory_mb_max", "memory_limit_mb"))
+        )
+    ]
+    errors = any(stats["error_rate"] > 0.01 for stats in results["phases"].values())
+    load = f"{params['users']} users, {params['posts_per_s']} posts/s, {params['loads_per_s']} channel loads/s"
+    if overloaded or errors:
+        reason = f"above {HIGH_USAGE:.0%} of the limits: {', '.join(overloaded)}" if overloaded else "error rate > 1%"
+        lines.append(du.bred(f"the sizing does not hold for {load} ({reason})"))
+    else:
+        lines.append(du.bgreen(f"the sizing holds for {load}"))
+    return "\n".join(lines)
+
+
+# ------------------------------------------------------------------------------------------------
+
+
+def _config() -> dict:
+    fpath = config_fpath("config.toml")
+    if not os.path.isfile(fpath):
+        return {}
+    with open(fpath, "rb") as fp:
+        return tomllib.load(fp)
+
+
+def compare_resources(old: dict, new: dict) -> str:
+    lines = ["pod resources (max):"]
+    old_resources, new_resources = old.get("resources", {}), new.get("resources", {})
+    for pod in sorted((set(old_resources) | set(new_resources)) - {"_errors"}):
+        o, n = old_resources.get(pod), new_resources.get(pod)
+        if o is None or n is None:
+            lines.append(f"  {pod}: only in the {'new' if o is None else 'old'} run")
+            continue
+        lines.append(
+            f"  {pod:<48} cpu {o['cpu_m_max']}m -> {n['cpu_m_max']}m, "
+            f"memory {o['memory_mb_max']} -> {n['memory_mb_max']} MiB"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="load benchmark of a Mattermost deployment")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmark and write the results")
+    run_parser.add_argument("--url", help="default: mattermost::site_url from config.toml")
+    run_parser.add_argument("--admin-token", default=os.environ.get("MM_ADMIN_TOKEN"), help="or $MM_ADMIN_TOKEN")
+    run_parser.add_argument("--admin-login")
+    run_parser.add_argument("--admin-password")
+    run_parser.add_argument("--insecure", action="store_true", help="do not verify the tls certificate")
+    run_parser.add_argument("--users", type=int, default=20)
+    run_parser.add_argument("--channels", type=int, default=5)
+    run_parser.add_argument("--posts-per-s", type=float, default=5.0, help="all users together")
+    run_parser.add_argument("--loads-per-s", type=float, default=10.0, help="channel loads, all users together")
+    run_parser.add_argument("--duration", type=float, default=60.0, help="seconds of the load phase")
+    run_parser.add_argument("--concurrency", type=int, default=16, help="number of client threads")
+    run_parser.add_argument("--no-websockets", action="store_true")
+    run_parser.add_argument(
+        "--kubectl", help="command for `kubectl top` (default: via ssh to remote/user from config.toml)"
+    )
+    run_parser.add_argument("--no-sampling", action="store_true", help="do not sample the pod resources")
+    run_parser.add_argument("--sample-interval", type=float, default=5.0)
+    run_parser.add_argument("--cleanup", action="store_true", help="deactivate the users and archive the channels")
+    run_parser.add_argument("--results-dir", default=benchmarking.RESULTS_DIR)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("old_results")
+    compare_parser.add_argument("new_results")
+    compare_parser.add_argument("--min-change", type=float, default=benchmarking.MIN_RELATIVE_CHANGE)
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        old, new = benchmarking.load_results(args.old_results), benchmarking.load_results(args.new_results)
+        print(benchmarking.compare(old, new, min_relative_change=args.min_change))
+        print(compare_resources(old, new))
+        return
+
+    config = _config()
+    if args.url is None:
+        args.url = config.get("mattermost", {}).get("site_url")
+    if args.url is None:
+        msg = "--url is required (no config.toml with mattermost::site_url found)"
+        raise SystemExit(msg)
+    if not args.admin_token and not (args.admin_login and args.admin_password):
+        msg = "--admin-token (or $MM_ADMIN_TOKEN) or --admin-login and --admin-password are required"
+        raise SystemExit(msg)
+
+    sampler = None
+    if not args.no_sampling:
+        kubectl_cmd = args.kubectl
+        if kubectl_cmd is None and config.get("remote"):
+            kubectl_cmd = f"ssh {config['user']}@{config['remote']} KUBECONFIG=~/.kube/config kubectl"
+        if kubectl_cmd is None:
+            print(du.yellow("no --kubectl and no remote in config.toml -> pod resources are not sampled"))
+        else:
+            sampler = ResourceSampler(kubectl_cmd, interval_s=args.sample_interval)
+
+    results = MattermostBenchmark(args).run(sampler)
+    print(benchmarking.format_phases(results["phases"]))
+    print(capacity_report(results))
+    fpath = benchmarking.write_results(results, "mattermost", args.results_dir)
+    print(du.dim(f"results written to {fpath}"))
+
+
+if __name__ == "__main__":
+    main()
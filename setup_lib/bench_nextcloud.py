@@ -0,0 +1,388 @@
+"""
+WebDAV load benchmark of a deployed Nextcloud instance (to check whether the tuning of `nc_prep02` — php-fpm pool,
+opcache/JIT, memcache — pays off).
+
+usage (from the root directory of this repo):
+
+    python -m setup_lib.bench_nextcloud run                       # target, user and password from config.toml
+    python -m setup_lib.bench_nextcloud run --concurrency 16 --duration 60
+    python -m setup_lib.bench_nextcloud compare bench_results/<old>.json bench_results/<new>.json
+    python -m setup_lib.bench_nextcloud serve --port 8099         # local stand-in server (test of the benchmark)
+    python -m setup_lib.bench_nextcloud run --url http://127.0.0.1:8099 --user bench --password x
+
+Each session is one simulated user with its own keep-alive connection and its own directory below
+`/remote.php/dav/files/<user>/nst-bench-<timestamp>/` (deleted at the end). Phases (all sessions run concurrently):
+
+    put_small, get_small    `--small-files` files of `--small-kb` KiB per session
+    propfind                directory listings (depth 1) of the session directory
+    put_large, get_large    one file of `--large-mb` MiB per session
+    mixed                   `--duration` seconds of a sync client like mix (PROPFIND 50%, GET 30%, PUT 20%)
+
+The results (throughput and p50/p95/p99 latency per phase) are written to `bench_results/`.
+"""
+
+import os
+import ssl
+import time
+import base64
+import random
+import argparse
+import threading
+import http.client
+import http.server
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+try:
+    import tomllib
+except ModuleNotFoundError:
+    import tomli as tomllib
+
+import deploymentutils as du
+
+from . import benchmarking
+from .fleet import config_fpath
+
+
+PROPFIND_BODY = (
+    '<?xml version="1.0"?><d:propfind xmlns:d="DAV:"><d:prop>'
+    "<d:getlastmodified/><d:getcontentlength/><d:resourcetype/><d:getetag/>"
+    "</d:prop></d:propfind>"
+)
+
+# operation weights of the mixed phase
+MIXED_WEIGHTS = {"propfind": 5, "get_small": 3, "put_small": 2}
+
+
+class DavError(Exception):
+    pass
+
+
+class DavSession:
+    """
+    One simulated user: a keep-alive connection (reconnected after errors) and a working directory.
+    """
+
+    def __init__(self, url: str, user: str, password: str, insecure=False, timeout=60):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.netloc = parts.netloc
+        self.base_path = f"{parts.path.rstrip('/')}/remote.php/dav/files/{urllib.parse.quote(user)}"
+        self.timeout = timeout
+        self.context = ssl._create_unverified_context() if insecure else None
+        self.headers = {"Authorization": "Basic " + base64.b64encode(f"{user}:{password}".encode()).decode()}
+        self.conn = None
+
+    def _connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout, context=self.context)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None, ok=(200, 201, 204, 207)):
+        """
+        Return the response body; raise DavError for an unexpected status code.
+        """
+        if self.conn is None:
+            self.conn = self._connect()
+        try:
+            self.conn.request(
+                method, f"{self.base_path}/{path.lstrip('/')}", body=body, headers={**self.headers, **(headers or {})}
+            )
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+        if response.status not in ok:
+            msg = f"{method} {path}: {response.status} {response.reason}"
+            raise DavError(msg)
+        return data
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class NextcloudBenchmark:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.run_dir = f"nst-bench-{time.strftime('%Y%m%d-%H%M%S')}"
+        self.recorder = benchmarking.LatencyRecorder()
+        self.small_data = os.urandom(args.small_kb * 1024)
+        self.large_data = os.urandom(args.large_mb * 2**20)
+
+    def new_session(self) -> DavSession:
+        return DavSession(self.args.url, self.args.user, self.args.password, insecure=self.args.insecure)
+
+    def for_all_sessions(self, phase: str, func):
+        """
+        Run `func(session, session_dir)` in every session concurrently (as phase `phase`).
+        """
+        with self.recorder.phase(phase), ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            futures = [
+                executor.submit(func, session, f"{self.run_dir}/s{i}") for i, session in enumerate(self.sessions)
+            ]
+            for future in futures:
+                future.result()
+
+    # operations (one measurement each) ---------------------------------------------------------------------
+
+    def put_small(self, session: DavSession, session_dir: str, i: int):
+        with self.recorder.measure("put_small", n_bytes=len(self.small_data)):
+            session.request("PUT", f"{session_dir}/small{i}.bin", body=self.small_data)
+
+    def get_small(self, session: DavSession, session_dir: str, i: int):
+        with self.recorder.measure("get_small", n_bytes=len(self.small_data)):
+            session.request("GET", f"{session_dir}/small{i}.bin", ok=(200,))
+
+    def propfind(self, session: DavSession, session_dir: str, name="propfind"):
+        with self.recorder.measure(name):
+            session.request(
+                "PROPFIND", f"{session_dir}/", body=PROPFIND_BODY.encode(),
+                headers={"Depth": "1", "Content-Type": "application/xml"}, ok=(207,),
+            )
+
+    # phases -------------------------------------------------------------------------------------------------
+
+    def phase_small_files(self):
+        def put(session, session_dir):
+            for i in range(self.args.small_files):
+                self.put_small(session, session_dir, i)
+
+        def get(session, session_dir):
+            for i in range(self.args.small_files):
+                self.get_small(session, session_dir, i)
+
+        self.for_all_sessions("put_small", put)
+        self.for_all_sessions("get_small", get)
+
+    def phase_propfind(self):
+        def listings(session, session_dir):
+            for _ in range(self.args.listings):
+                self.propfind(session, session_dir)
+
+        self.for_all_sessions("propfind", listings)
+
+    def phase_large_files(self):
+        def put(session, session_dir):
+            with self.recorder.measure("put_large", n_bytes=len(self.large_data)):
+                session.request("PUT", f"{session_dir}/large.bin", body=self.large_data)
+
+        def get(session, session_dir):
+            with self.recorder.measure("get_large", n_bytes=len(self.large_data)):
+                session.request("GET", f"{session_dir}/large.bin", ok=(200,))
+
+        self.for_all_sessions("put_large", put)
+        self.for_all_sessions("get_large", get)
+
+    def phase_mixed(self):
+        deadline = time.time() + self.args.duration
+        ops, weights = zip(*MIXED_WEIGHTS.items())
+
+        def mixed(session, session_dir):
+            rng = random.Random(session_dir)
+            while time.time() < deadline:
+                op = rng.choices(ops, weights)[0]
+                i = rng.randrange(self.args.small_files)
+                if op == "propfind":
+                    self.propfind(session, session_dir, name="mixed")
+                    continue
+                with self.recorder.measure("mixed", n_bytes=len(self.small_data)):
+                    if op == "get_small":
+                        session.request("GET", f"{session_dir}/small{i}.bin", ok=(200,))
+                    else:
+                        session.request("PUT", f"{session_dir}/small{i}.bin", body=self.small_data)
+
+        self.for_all_sessions("mixed", mixed)
+
+    def run(self) -> dict:
+        args = self.args
+        started = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.sessions = [self.new_session() for _ in range(args.concurrency)]
+        setup = self.sessions[0]
+        setup.request("MKCOL", f"{self.run_dir}/", ok=(201,))
+        for i in range(args.concurrency):
+            setup.request("MKCOL", f"{self.run_dir}/s{i}/", ok=(201,))
+        try:
+            self.phase_small_files()
+            self.phase_propfind()
+            if args.large_mb > 0:
+                self.phase_large_files()
+            if args.duration > 0:
+                self.phase_mixed()
+        finally:
+            setup.request("DELETE", f"{self.run_dir}/", ok=(200, 204, 404))
+            for session in self.sessions:
+                session.close()
+
+        params = {
+            key: getattr(args, key)
+            for key in ("concurrency", "small_files", "small_kb", "large_mb", "listings", "duration")
+        }
+        return {
+            "tool": "bench_nextcloud",
+            "target": args.url,
+            "started": started,
+            "params": params,
+            "phases": self.recorder.summary(),
+        }
+
+
+# ------------------------------------------------------------------------------------------------
+# local stand-in server (in-memory WebDAV subset: MKCOL, PUT, GET, PROPFIND, DELETE)
+
+
+class StandInDavHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately (no 40 ms delayed ack stalls)
+    disable_nagle_algorithm = True
+    # set by `serve`
+    store = {}
+    lock = threading.Lock()
+    latency_s = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes = b"", content_type="text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _key(self) -> str:
+        return urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).rstrip("/")
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _handle(self, method: str):
+        body = self._body()
+        time.sleep(self.latency_s)
+        key = self._key()
+        with self.lock:
+            if method == "MKCOL":
+                exists = key in self.store
+                self.store.setdefault(key, None)
+                return self._reply(405 if exists else 201)
+            if method == "PUT":
+                created = key not in self.store
+                self.store[key] = body
+                return self._reply(201 if created else 204)
+            if method == "GET":
+                data = self.store.get(key)
+                if data is None:
+                    return self._reply(404)
+                return self._reply(200, data, "application/octet-stream")
+            if method == "DELETE":
+                keys = [k for k in self.store if k == key or k.startswith(f"{key}/")]
+                for k in keys:
+                    del self.store[k]
+                return self._reply(204 if keys else 404)
+            if method == "PROPFIND":
+                if key not in self.store:
+                    return self._reply(404)
+                children = [k for k in self.store if k.startswith(f"{key}/") and "/" not in k[len(key) + 1:]]
+                responses = [
+                    f"<d:response><d:href>{escape(k)}</d:href><d:propstat><d:prop><d:getcontentlength>"
+                    f"{len(self.store[k] or b'')}</d:getcontentlength></d:prop>"
+                    "<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>"
+                    for k in [key, *children]
+                ]
+                xml = f'<?xml version="1.0"?><d:multistatus xmlns:d="DAV:">{"".join(responses)}</d:multistatus>'
+                return self._reply(207, xml.encode(), "application/xml")
+        return self._reply(405)
+
+    def do_MKCOL(self):
+        self._handle("MKCOL")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def do_PROPFIND(self):
+        self._handle("PROPFIND")
+
+
+def serve(port: int, latency_ms: float = 0.0):
+    StandInDavHandler.latency_s = latency_ms / 1000
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), StandInDavHandler)
+    print(f"stand-in WebDAV server on http://127.0.0.1:{port} (any user and password, ctrl+c to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+# ------------------------------------------------------------------------------------------------
+
+
+def _config_defaults() -> dict:
+    fpath = config_fpath("config.toml")
+    if not os.path.isfile(fpath):
+        return {}
+    with open(fpath, "rb") as fp:
+        config = tomllib.load(fp)
+    return {
+        "url": f"https://{config['server_name']}" if config.get("server_name") else None,
+        "user": config.get("nc_admin_user"),
+        "password": config.get("nc_admin_pw"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WebDAV load benchmark of a Nextcloud instance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmark and write the results")
+    run_parser.add_argument("--url", help="default: https://<server_name> from config.toml")
+    run_parser.add_argument("--user", help="default: nc_admin_user from config.toml")
+    run_parser.add_argument("--password", help="default: nc_admin_pw from config.toml")
+    run_parser.add_argument("--insecure", action="store_true", help="do not verify the tls certificate")
+    run_parser.add_argument("--concurrency", type=int, default=8, help="number of concurrent user sessions")
+    run_parser.add_argument("--small-files", type=int, default=50, help="small files per session")
+    run_parser.add_argument("--small-kb", type=int, default=16)
+    run_parser.add_argument("--large-mb", type=int, default=32, help="0: skip the large file phases")
+    run_parser.add_argument("--listings", type=int, default=50, help="PROPFIND requests per session")
+    run_parser.add_argument("--duration", type=float, default=30, help="seconds of the mixed phase (0: skip)")
+    run_parser.add_argument("--results-dir", default=benchmarking.RESULTS_DIR)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("old_results")
+    compare_parser.add_argument("new_results")
+    compare_parser.add_argument("--min-change", type=float, default=benchmarking.MIN_RELATIVE_CHANGE)
+
+    serve_parser = subparsers.add_parser("serve", help="local in-memory WebDAV server to test the benchmark")
+    serve_parser.add_argument("--port", type=int, default=8099)
+    serve_parser.add_argument("--latency-ms", type=float, default=0.0, help="added to every request")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.port, args.latency_ms)
+    elif args.command == "compare":
+        old, new = benchmarking.load_results(args.old_results), benchmarking.load_results(args.new_results)
+        print(benchmarking.compare(old, new, min_relative_change=args.min_change))
+    else:
+        defaults = _config_defaults()
+        for key in ("url", "user", "password"):
+            if getattr(args, key) is None:
+                setattr(args, key, defaults.get(key))
+            if getattr(args, key) is None:
+                msg = f"--{key} is required (no config.toml with the corresponding value found)"
+                raise SystemExit(msg)
+        results = NextcloudBenchmark(args).run()
+        print(benchmarking.format_phases(results["phases"]))
+        fpath = benchmarking.write_results(results, "nextcloud", args.results_dir)
+        print(du.dim(f"results written to {fpath}"))
+
+
+if __name__ == "__main__":
+    main()
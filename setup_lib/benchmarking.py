@@ -0,0 +1,195 @@
+"""
+Common parts of the load benchmarks (setup_lib/bench_nextcloud.py, setup_lib/bench_mattermost.py): latency
+recording, percentiles, results files and the comparison of two runs.
+
+Results file (json):
+
+    {"tool": ..., "target": ..., "started": ..., "params": {...},
+     "phases": {name: {"count", "errors", "error_rate", "duration_s", "ops_per_s", "mb_per_s",
+                       "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"}}, ...}
+"""
+
+import os
+import json
+import time
+import threading
+
+import deploymentutils as du
+
+
+RESULTS_DIR = "bench_results"
+
+# relative changes which are reported as regression/improvement by `compare`
+MIN_RELATIVE_CHANGE = 0.10
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """
+    Return the p-th percentile (0..100, linear interpolation) of an ascending list.
+    """
+    if not sorted_values:
+        return 0.0
+    pos = (len(sorted_values) - 1) * p / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (pos - lower)
+
+
+class LatencyRecorder:
+    """
+    Collects the latency of every operation per phase (thread safe, the sessions run concurrently).
+
+    Usage:
+
+        recorder = LatencyRecorder()
+        with recorder.phase("put_small"):
+            ...  # in each session:
+            with recorder.measure("put_small", n_bytes=len(data)):
+                ...
+        recorder.summary()
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.n_bytes = {}
+        self.durations = {}
+        self.error_samples = {}
+        self._lock = threading.Lock()
+
+    def phase(self, name: str):
+        return _Phase(self, name)
+
+    def measure(self, name: str, n_bytes: int = 0):
+        return _Measurement(self, name, n_bytes)
+
+    def record(self, name: str, latency_s: float, ok=True, n_bytes: int = 0, error: str = None):
+        with self._lock:
+            self.latencies.setdefault(name, [])
+            self.errors.setdefault(name, 0)
+            self.n_bytes.setdefault(name, 0)
+            if ok:
+                self.latencies[name].append(latency_s)
+                self.n_bytes[name] += n_bytes
+            else:
+                self.errors[name] += 1
+                samples = self.error_samples.setdefault(name, [])
+                if error and len(samples) < 3:
+                    samples.append(error)
+
+    def summary(self) -> dict:
+        res = {}
+        for name in self.latencies:
+            values = sorted(self.latencies[name])
+            count, errors = len(values), self.errors[name]
+            duration = self.durations.get(name) or sum(values) or 1e-9
+            res[name] = {
+                "count": count,
+                "errors": errors,
+                "error_rate": errors / (count + errors) if count + errors else 0.0,
+                "duration_s": round(duration, 3),
+                "ops_per_s": round(count / duration, 2),
+                "mb_per_s": round(self.n_bytes[name] / 2**20 / duration, 2),
+                "mean_ms": round(sum(values) / count * 1000, 2) if count else 0.0,
+                **{f"p{p}_ms": round(percentile(values, p) * 1000, 2) for p in (50, 95, 99)},
+                "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+            }
+            if self.error_samples.get(name):
+                res[name]["error_samples"] = self.error_samples[name]
+        return res
+
+
+class _Phase:
+    def __init__(self, recorder: LatencyRecorder, name: str):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.time()
+        print(du.dim(f"phase {self.name} ..."))
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.recorder._lock:
+            self.recorder.durations[self.name] = time.time() - self.t0
+        return False
+
+
+class _Measurement:
+    def __init__(self, recorder: LatencyRecorder, name: str, n_bytes: int):
+        self.recorder = recorder
+        self.name = name
+        self.n_bytes = n_bytes
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        ok = exc_type is None
+        error = None if ok else f"{exc_type.__name__}: {exc_value}"[:200]
+        self.recorder.record(self.name, time.perf_counter() - self.t0, ok=ok, n_bytes=self.n_bytes, error=error)
+        # errors are counted, the session continues
+        return exc_type is not None and issubclass(exc_type, Exception)
+
+
+def write_results(results: dict, tool: str, results_dir=RESULTS_DIR) -> str:
+    os.makedirs(results_dir, exist_ok=True)
+    fname = f"{time.strftime('%Y%m%d-%H%M%S')}-{tool}.json"
+    fpath = os.path.join(results_dir, fname)
+    with open(fpath, "w") as fp:
+        json.dump(results, fp, indent=1)
+    return fpath
+
+
+def load_results(fpath: str) -> dict:
+    with open(fpath) as fp:
+        return json.load(fp)
+
+
+def format_phases(phases: dict) -> str:
+    lines = [
+        f"  {'phase':<16} {'ops':>7} {'err%':>6} {'ops/s':>9} {'MB/s':>8} "
+        f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    ]
+    for name, stats in phases.items():
+        lines.append(
+            f"  {name:<16} {stats['count']:>7} {stats['error_rate'] * 100:>6.1f} {stats['ops_per_s']:>9.1f} "
+            f"{stats['mb_per_s']:>8.2f} {stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f} "
+            f"{stats['max_ms']:>9.1f}"
+        )
+        for sample in stats.get("error_samples", []):
+            lines.append(du.yellow(f"      error: {sample}"))
+    return "\n".join(lines)
+
+
+def compare(old: dict, new: dict, min_relative_change=MIN_RELATIVE_CHANGE) -> str:
+    """
+    Report throughput and latency percentiles of both runs per phase; changes of more than `min_relative_change`
+    are marked (higher ops/s and lower latencies are better).
+    """
+
+    def mark(old_value, new_value, higher_is_better):
+        if not old_value:
+            return ""
+        change = (new_value - old_value) / old_value
+        if abs(change) < min_relative_change:
+            return f"{change:+6.0%}"
+        better = (change > 0) == higher_is_better
+        return du.bgreen(f"{change:+6.0%}") if better else du.bred(f"{change:+6.0%}")
+
+    lines = [f"{old.get('target')} ({old.get('started')}) -> {new.get('target')} ({new.get('started')})"]
+    old_phases, new_phases = old.get("phases", {}), new.get("phases", {})
+    for name in [*old_phases, *(name for name in new_phases if name not in old_phases)]:
+        if name not in old_phases or name not in new_phases:
+            lines.append(f"  {name}: only in the {'new' if name in new_phases else 'old'} run")
+            continue
+        o, n = old_phases[name], new_phases[name]
+        lines.append(f"  {name}:")
+        for key, higher_is_better in (("ops_per_s", True), ("p50_ms", False), ("p95_ms", False), ("p99_ms", False)):
+            lines.append(
+                f"    {key:<9} {o[key]:>10.1f} -> {n[key]:>10.1f}  {mark(o[key], n[key], higher_is_better)}"
+            )
+        if o["error_rate"] or n["error_rate"]:
+            lines.append(f"    {'errors':<9} {o['error_rate']:>10.1%} -> {n['error_rate']:>10.1%}")
+    return "\n".join(lines)
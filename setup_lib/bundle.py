@@ -0,0 +1,303 @@
+"""
+"Compile" mode for step functions: record all operations into one self-contained shell script (bundle) which is
+uploaded once and executed on the host in a single round trip. The bundle also serves as reviewable plan.
+"""
+
+import io
+import os
+import time
+import gzip
+import json
+import shlex
+import base64
+import tarfile
+import contextlib
+
+import deploymentutils as du
+
+
+# applied on the remote host; same semantics as deploymentutils/multi_search_and_replace.py
+MULTI_EDIT_PY = r'''
+import sys, os, json, base64
+data = json.loads(base64.b64decode(sys.argv[1]).decode("utf8"))
+fpath = os.path.expanduser(data["target_file"])
+with open(fpath, "r", encoding="utf-8") as fp:
+    content = fp.read()
+for old, new in data["replacements"]:
+    n = content.count(old)
+    if n != 1:
+        sys.exit(f"[ERROR] {old!r} found {n} times in {fpath}, expected 1.")
+    content = content.replace(old, new, 1)
+with open(fpath, "w", encoding="utf-8") as fp:
+    fp.write(content)
+print(f"successfully made {len(data['replacements'])} edits to file {fpath}")
+'''
+
+BUNDLE_HEADER = """\
+#!/usr/bin/env bash
+# deployment bundle generated by setup_lib/bundle.py on {date}
+# steps: {step_names}
+#
+# This file contains all operations of the steps listed above (including secrets from config.toml).
+# Review it before running: `bash {fname}`
+
+nst_total={n_steps}
+nst_t_start=$(date +%s)
+
+nst_step_begin() {{
+    nst_current="$2"
+    nst_t0=$(date +%s)
+    echo "==> [$1/$nst_total] $2"
+}}
+
+nst_step_end() {{
+    echo "<== [$1/$nst_total] $2 done in $(( $(date +%s) - nst_t0 ))s"
+}}
+
+nst_op() {{
+    echo "-> ($1) $2"
+}}
+
+nst_fail() {{
+    echo "!!! step '$nst_current' failed at operation $1" >&2
+    exit 1
+}}
+
+nst_edit_py=$(mktemp)
+trap 'rm -f "$nst_edit_py"' EXIT
+cat > "$nst_edit_py" <<'NST_PY_EOF'
+{multi_edit_py}
+NST_PY_EOF
+"""
+
+BUNDLE_FOOTER = """
+echo "==> all $nst_total steps done in $(( $(date +%s) - nst_t_start ))s"
+"""
+
+
+# files which are larger are not embedded into the bundle but uploaded separately (before the bundle runs)
+MAX_EMBED_SIZE = 1 << 20
+
+
+class BundleRecorder:
+    """
+    Stand-in for du.StateConnection: step functions can be called with an instance of this class.
+    Instead of executing anything, every `run`, `chdir`, `set_env`, `string_to_file`, `multi_edit_file` and
+    `rsync_upload` is rendered to shell code.
+
+    Note: the return values of `run` are placeholders (empty output, exit code 0). Thus step functions which are
+    compiled should express conditional logic on the shell side (e.g. `test -e ... || ...`).
+    """
+
+    # allow helper code to detect that no real remote host is involved
+    records_only = True
+
+    # True while a step is only rendered for its fingerprint (see setup_lib/stepcache.py): steps skip their local
+    # side effects (downloads, repacking), the recorded operations are never executed
+    fingerprint_only = False
+
+    def __init__(self, remote=None, user=None):
+        self.remote = remote
+        self.user = user
+        self.target = "remote"
+        self.dir = None
+        self.env_variables = {}
+        self.steps = []
+        self.op_counter = 0
+        self._current_lines = None
+        # list of (local_fpath, remote_fpath) of large files
+        self.side_uploads = []
+        # values which could not be read from the host at compile time (estimated instead)
+        self.assumptions = []
+
+    @contextlib.contextmanager
+    def step(self, name: str):
+        assert self._current_lines is None, "steps cannot be nested"
+        self._current_lines = []
+        try:
+            yield self
+        finally:
+            self.steps.append((name, self._current_lines))
+            self._current_lines = None
+            self.dir = None
+            self.env_variables = {}
+
+    def record(self, step_func, *args, **kwargs):
+        """
+        Call `step_func(self, *args, **kwargs)` and store its operations as a step of the bundle.
+        """
+        with self.step(step_func.__name__):
+            step_func(self, *args, **kwargs)
+
+    def _emit(self, shell_code: str, description: str, warn="smart", use_dir=True):
+        assert self._current_lines is not None, "operations must be recorded inside a step"
+        self.op_counter += 1
+        n = self.op_counter
+
+        prefix = [f'export {name}="{value}"' for name, value in self.env_variables.items()]
+        if use_dir and self.dir is not None:
+            prefix.append(f"cd {self.dir}")
+        body = "\n".join([*prefix, shell_code])
+
+        if warn == "smart":
+            on_error = f"nst_fail {n}"
+        else:
+            on_error = "true"
+
+        first_line = description.strip().split("\n")[0][:100]
+        self._current_lines.append(f"nst_op {n} {shlex.quote(first_line)}")
+        self._current_lines.append(f"(\n{body}\n) || {on_error}")
+
+    # ------------------------------------------------------------------------------------------------
+    # StateConnection interface
+
+    def run(self, cmd, use_dir: bool = True, hide=False, warn="smart", **kwargs):
+        if isinstance(cmd, list):
+            cmd = " ".join(cmd)
+        self._emit(cmd, cmd, warn=warn, use_dir=use_dir)
+        return du.EContainer(exited=0, return_code=0, stdout="", stderr="", recorded=True)
+
+    def chdir(self, path, target_spec="both", tolerate_error=False):
+        if path is None:
+            self.dir = None
+        elif path[0] in ("/", "~", "$"):
+            self.dir = path
+        else:
+            if self.dir is None:
+                msg = "Relative path cannot be the first path specification"
+                raise ValueError(msg)
+            self.dir = f"{self.dir}/{path}"
+        return du.EContainer(exited=0)
+
+    def set_env(self, name: str, value: str, raw=False):
+        if not raw:
+            value = value.replace("~/", "$HOME/")
+        self.env_variables[name] = value
+
+    def string_to_file(self, txt: str, fpath, mode=">"):
+        txt_b64 = base64.encodebytes(txt.encode("utf8")).decode("utf8").strip()
+        code = f"base64 -d {mode} {fpath} <<'NST_B64_EOF'\n{txt_b64}\nNST_B64_EOF"
+        self._emit(code, f"string_to_file {mode} {fpath}")
+        return txt
+
+    def multi_edit_file(self, fpath: str, replacements: list, delete_aux_files=True):
+        rplmt_data = {"target_file": fpath, "replacements": [list(tup) for tup in replacements]}
+        data_b64 = base64.b64encode(json.dumps(rplmt_data).encode("utf8")).decode("utf8")
+        self._emit(f'python3 "$nst_edit_py" {data_b64}', f"multi_edit_file {fpath}")
+
+    def edit_file(self, fpath: str, old: str, new, delete_aux_files=True):
+        self.multi_edit_file(fpath, [(old, new)])
+        return old, new
+
+    def rsync_upload(self, source, dest, target_spec="default", filters="", **kwargs):
+        """
+        Embed the local file or directory `source` into the bundle (rsync trailing-slash semantics).
+        """
+        if target_spec == "local":
+            return du.EContainer(exited=0)
+
+        if os.path.isdir(source):
+            buffer = io.BytesIO()
+            # mtime=0: the same directory content results in the same bundle text (step fingerprints)
+            with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as gz, tarfile.open(fileobj=gz, mode="w") as tar:
+                if source.endswith("/"):
+                    for name in sorted(os.listdir(source)):
+                        tar.add(os.path.join(source, name), arcname=name)
+                else:
+                    tar.add(source, arcname=os.path.basename(source))
+            data_b64 = base64.encodebytes(buffer.getvalue()).decode("utf8").strip()
+            code = f"mkdir -p {dest}\nbase64 -d <<'NST_B64_EOF' | tar xzf - -C {dest}\n{data_b64}\nNST_B64_EOF"
+        elif os.path.getsize(source) > MAX_EMBED_SIZE:
+            if dest.endswith("/"):
+                dest = f"{dest}{os.path.basename(source)}"
+            self.side_uploads.append((source, dest))
+            code = f"# uploaded before the bundle runs ({os.path.getsize(source)} bytes)\ntest -f {dest}"
+        else:
+            with open(source, "rb") as fp:
+                data_b64 = base64.encodebytes(fp.read()).decode("utf8").strip()
+            if dest.endswith("/"):
+                dest = f"{dest}{os.path.basename(source)}"
+            code = f"base64 -d > {dest} <<'NST_B64_EOF'\n{data_b64}\nNST_B64_EOF"
+
+        self._emit(code, f"upload {source} -> {dest}", use_dir=False)
+        return du.EContainer(exited=0)
+
+    def rsync_download(self, source, dest, *args, **kwargs):
+        assert self._current_lines is not None
+        msg = f"rsync_download {source} -> {dest} cannot be part of a bundle and must be done separately"
+        self._current_lines.append(f"# NOTE: {msg}")
+        print(du.yellow(f"Warning: {msg}"))
+        return du.EContainer(exited=0)
+
+    def check_existence(self, path, target_spec="default", operator_flag="-e"):
+        """
+        The result cannot be known at compile time: emit a guard which aborts the bundle if `path` does not exist
+        and return True (the following operations only run if it exists). Steps which create a missing path must
+        use a shell-side test instead (`test -e ... || ...`).
+        """
+        self._emit(f"test {operator_flag} {path}", f"check_existence {operator_flag} {path}", use_dir=False)
+        return True
+
+    def assume(self, description: str):
+        """
+        Note a value which was estimated because the host cannot be queried at compile time. The assumptions are
+        listed as warning in the header of the bundle and printed when it runs.
+        """
+        if description not in self.assumptions:
+            self.assumptions.append(description)
+            if not self.fingerprint_only:
+                print(du.yellow(f"Warning: compiled with an estimate: {description}"))
+
+    # ------------------------------------------------------------------------------------------------
+
+    def render(self, fname="bundle.sh") -> str:
+        step_names = [name for name, _ in self.steps]
+        parts = [
+            BUNDLE_HEADER.format(
+                date=time.strftime("%Y-%m-%d %H:%M:%S"),
+                step_names=", ".join(step_names),
+                fname=fname,
+                n_steps=len(self.steps),
+                multi_edit_py=MULTI_EDIT_PY.strip(),
+            )
+        ]
+        if self.assumptions:
+            parts.append("# WARNING: the following values were estimated at compile time (not read from the host):")
+            parts.extend(f"#   - {description}" for description in self.assumptions)
+            parts.extend(
+                f"echo {shlex.quote(f'WARNING: compiled with an estimate: {description}')} >&2"
+                for description in self.assumptions
+            )
+        for i, (name, lines) in enumerate(self.steps, start=1):
+            parts.append(f"\n# {'-' * 30} step {i}: {name} {'-' * 30}\n")
+            parts.append(f"nst_step_begin {i} {name}")
+            parts.extend(lines)
+            parts.append(f"nst_step_end {i} {name}")
+        parts.append(BUNDLE_FOOTER)
+        return "\n".join(parts)
+
+    def write(self, fpath: str) -> str:
+        """
+        Write the bundle to a local file (readable only by the owner, because it contains secrets).
+        """
+        with open(os.open(fpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf8") as fp:
+            fp.write(self.render(os.path.basename(fpath)))
+        print(f"bundle with {len(self.steps)} steps and {self.op_counter} operations written to {fpath}")
+        return fpath
+
+    def execute(self, c: du.StateConnection, fpath: str, remote_dir="~/tmp"):
+        """
+        Write the bundle, upload it once and execute it on the host (output is streamed back).
+        Large files are uploaded separately before.
+        """
+        self.write(fpath)
+        remote_fpath = f"{remote_dir}/{os.path.basename(fpath)}"
+        c.run(f"mkdir -p {remote_dir}", use_dir=False)
+        for source, dest in self.side_uploads:
+            c.rsync_upload(source, dest, "remote", additional_flags="--partial")
+        c.rsync_upload(fpath, remote_fpath, "remote")
+        try:
+            res = c.run(f"bash {remote_fpath}", use_dir=False)
+        finally:
+            c.run(f"rm -f {remote_fpath}", use_dir=False, warn=True, hide=True)
+        return res
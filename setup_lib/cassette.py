@@ -0,0 +1,288 @@
+"""
+Record/replay of the remote operations of a deployment run (for tests of step functions without a VM).
+
+    NST_CASSETTE_MODE=record NST_CASSETTE=nc.cassette.jsonl python ubuntu24.04_v1.py
+    NST_CASSETTE_MODE=replay NST_CASSETTE=nc.cassette.jsonl python ubuntu24.04_v1.py
+
+Recording runs against the real host and stores every remote command (incl. `string_to_file` and `multi_edit_file`,
+which are remote commands), every rsync transfer and every piped upload with its output, exit code and duration.
+Replaying serves these results without any connection (in milliseconds). Remote commands which are not in the
+cassette are reported as diff at exit (with the most similar recorded command, if any) and get an empty successful
+result; with NST_CASSETTE_STRICT=1 they raise an error instead.
+
+Operations are matched by a normalized key: config secrets (`redact`, as in setup_lib/tracing.py) are replaced by
+"***" (the cassette does not contain them, it is only readable by the owner) and run specific temporary paths
+(`tempfile`/`mktemp` names, pids) by placeholders.
+
+Note: operations on the control machine (e.g. downloads into the artifact cache) are executed in both modes.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import atexit
+import difflib
+import tempfile
+import threading
+import collections
+
+import deploymentutils as du
+
+from .connection import MuxConnection
+
+
+MODE_ENV_VAR = "NST_CASSETTE_MODE"
+FPATH_ENV_VAR = "NST_CASSETTE"
+STRICT_ENV_VAR = "NST_CASSETTE_STRICT"
+
+DEFAULT_FPATH = "deployment.cassette.jsonl"
+
+# (pattern, placeholder) of run specific parts of the recorded commands
+VOLATILE_PATTERNS = [
+    # tempfile.NamedTemporaryFile/mkstemp on the control machine
+    (re.compile(re.escape(tempfile.gettempdir()) + r"/tmp[a-z0-9_]{8}"), "<tmpfile>"),
+    # mktemp on the host
+    (re.compile(r"/tmp/tmp\.[A-Za-z0-9]{10}"), "<mktemp>"),
+    # names which contain the pid of the deployment process
+    (re.compile(r"\b(nst-[a-z]+-)\d+"), r"\1<pid>"),
+]
+
+
+def open_connection(remote, user, redact=(), **kwargs) -> MuxConnection:
+    """
+    Return a MuxConnection, or a recording/replaying variant of it if the environment variables are set.
+
+    :param redact:  strings (e.g. passwords from the config) which are not stored in the cassette
+    """
+    mode = os.environ.get(MODE_ENV_VAR)
+    fpath = os.environ.get(FPATH_ENV_VAR, DEFAULT_FPATH)
+    if mode == "record":
+        return RecordingConnection(remote, user, cassette_fpath=fpath, redact=redact, **kwargs)
+    if mode == "replay":
+        strict = os.environ.get(STRICT_ENV_VAR) == "1"
+        return ReplayConnection(remote, user, cassette_fpath=fpath, strict=strict, redact=redact, **kwargs)
+    if mode:
+        msg = f"invalid value of {MODE_ENV_VAR}: {mode} (expected 'record' or 'replay')"
+        raise ValueError(msg)
+    return MuxConnection(remote, user, **kwargs)
+
+
+def redact_text(text: str, redact) -> str:
+    for value in redact:
+        if value:
+            text = text.replace(value, "***")
+    return text
+
+
+def normalize_key(key: str, redact=()) -> str:
+    """
+    Return the key under which an operation is stored (secrets and run specific temporary paths replaced).
+    """
+    key = redact_text(key, redact)
+    for pattern, placeholder in VOLATILE_PATTERNS:
+        key = pattern.sub(placeholder, key)
+    return key
+
+
+def _rsync_key(source, dest, delete, additional_flags) -> str:
+    flags = [*(["--delete"] if delete else []), *additional_flags.split()]
+    return " ".join([f"{source} -> {dest}", *flags])
+
+
+def _is_remote(c: MuxConnection, target_spec) -> bool:
+    if target_spec == "default":
+        target_spec = c.target
+    return c.target == "remote" and target_spec in ("remote", "both")
+
+
+class RecordingConnection(MuxConnection):
+    """
+    MuxConnection which appends every remote operation to a cassette file (JSON lines, written immediately, so
+    the cassette of a failed run can be used as well).
+    """
+
+    def __init__(self, remote, user, cassette_fpath=DEFAULT_FPATH, redact=(), **kwargs):
+        self.cassette_fpath = cassette_fpath
+        self.redact = [value for value in redact if value]
+        self._cassette_lock = threading.Lock()
+        # the outputs may still contain host specific data -> only readable by the owner
+        with open(os.open(cassette_fpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as fp:
+            meta = {"meta": {"remote": remote, "user": user, "script": sys.argv[0], "recorded": time.time()}}
+            fp.write(json.dumps(meta) + "\n")
+        print(du.dim(f"recording remote operations to {cassette_fpath}"))
+        super().__init__(remote, user, **kwargs)
+
+    def _append(self, interaction: dict):
+        interaction["key"] = normalize_key(interaction["key"], self.redact)
+        for name in ("stdout", "stderr"):
+            if name in interaction:
+                interaction[name] = redact_text(interaction[name], self.redact)
+        with self._cassette_lock, open(self.cassette_fpath, "a") as fp:
+            fp.write(json.dumps(interaction) + "\n")
+
+    def run_target_command(self, full_command_lists, hide, warn, target_spec):
+        t0 = time.time()
+        res = super().run_target_command(full_command_lists, hide, warn, target_spec)
+        # local commands (target "local") are not part of the cassette
+        if _is_remote(self, target_spec):
+            self._append({
+                "op": "run", "key": res.command, "exited": res.exited, "stdout": res.stdout, "stderr": res.stderr,
+                "duration": time.time() - t0,
+            })
+        return res
+
+    def _rsync_call(self, source, dest, target_spec, filters, printonly=False, tol_nonzero_exit=False,
+                    delete=False, additional_flags=""):
+        t0 = time.time()
+        res = super()._rsync_call(
+            source, dest, target_spec, filters, printonly, tol_nonzero_exit, delete, additional_flags
+        )
+        if not printonly:
+            self._append({
+                "op": "rsync", "key": _rsync_key(source, dest, delete, additional_flags), "exited": res.exited,
+                "duration": time.time() - t0,
+            })
+        return res
+
+    def pipe_file(self, local_fpath: str, remote_cmd: str, warn=False):
+        t0 = time.time()
+        res = super().pipe_file(local_fpath, remote_cmd, warn=warn)
+        self._append({"op": "pipe", "key": remote_cmd, "exited": res.exited, "duration": time.time() - t0})
+        return res
+
+
+def load_cassette(fpath: str) -> tuple:
+    """
+    Return (meta, interactions).
+    """
+    with open(fpath) as fp:
+        lines = [json.loads(line) for line in fp if line.strip()]
+    return lines[0]["meta"], lines[1:]
+
+
+class ReplayConnection(MuxConnection):
+    """
+    MuxConnection which does not connect but serves all remote operations from a cassette. Operations are
+    matched by their command (independent of the order, because steps may run concurrently; repeated commands
+    are served in the recorded order).
+    """
+
+    def __init__(self, remote, user, cassette_fpath=DEFAULT_FPATH, strict=False, redact=(), **kwargs):
+        self.cassette_fpath = cassette_fpath
+        self.strict = strict
+        self.redact = [value for value in redact if value]
+        self.cassette_meta, interactions = load_cassette(cassette_fpath)
+        self.recorded = collections.defaultdict(collections.deque)
+        for interaction in interactions:
+            self.recorded[(interaction["op"], interaction["key"])].append(interaction)
+        self.n_recorded = len(interactions)
+        self.new_operations = []
+        self.replayed = []
+        self._replay_lock = threading.Lock()
+        self.t_replay_start = time.time()
+        print(du.dim(f"replaying {self.n_recorded} remote operations from {cassette_fpath}"))
+        super().__init__(remote, user, **kwargs)
+        atexit.register(lambda: print(self.replay_report()))
+
+    def _open_master(self, remote, user):
+        # no connection; `close` does nothing because the handshake time remains 0
+        self.handshake_time = 0.0
+
+    def check_rsync(self):
+        pass
+
+    def _serve(self, op: str, key: str) -> dict:
+        key = normalize_key(key, self.redact)
+        with self._replay_lock:
+            queue = self.recorded.get((op, key))
+            if queue:
+                interaction = queue.popleft()
+                self.replayed.append(interaction)
+                return interaction
+            self.new_operations.append((op, key))
+        if self.strict:
+            msg = f"operation not in cassette {self.cassette_fpath}: {op} {key}"
+            raise ValueError(msg)
+        print(du.yellow(f"new {op} operation (not in cassette): {key[:200]}"))
+        return {"exited": 0, "stdout": "", "stderr": ""}
+
+    def run_target_command(self, full_command_lists, hide, warn, target_spec):
+        if not _is_remote(self, target_spec):
+            return super().run_target_command(full_command_lists, hide, warn, target_spec)
+
+        full_command_txt = "; ".join([" ".join(cmd_list) for cmd_list in full_command_lists])
+        self.last_full_command_txt = full_command_txt
+        self.count_op()
+        interaction = self._serve("run", full_command_txt)
+        if hide not in (True, "both", "out", "stdout") and interaction["stdout"]:
+            sys.stdout.write(interaction["stdout"])
+        if hide not in (True, "both", "err", "stderr") and interaction["stderr"]:
+            sys.stderr.write(interaction["stderr"])
+        exitcode = interaction["exited"]
+        return du.EContainer(
+            exited=exitcode,
+            return_code=exitcode,
+            ok=exitcode == 0,
+            failed=exitcode != 0,
+            command=full_command_txt,
+            stdout=interaction["stdout"],
+            stderr=interaction["stderr"],
+        )
+
+    def _rsync_call(self, source, dest, target_spec, filters, printonly=False, tol_nonzero_exit=False,
+                    delete=False, additional_flags=""):
+        if printonly or target_spec not in ("both", self.target):
+            return du.EContainer(exited=0)
+        self.count_op()
+        exitcode = self._serve("rsync", _rsync_key(source, dest, delete, additional_flags))["exited"]
+        if not tol_nonzero_exit and exitcode != 0:
+            msg = "rsync failed (replayed from cassette)."
+            raise ValueError(msg)
+        return du.EContainer(exited=exitcode)
+
+    def pipe_file(self, local_fpath: str, remote_cmd: str, warn=False):
+        self.count_op()
+        exitcode = self._serve("pipe", remote_cmd)["exited"]
+        if exitcode != 0 and not warn:
+            msg = f"remote command failed with exit code {exitcode} (replayed from cassette): {remote_cmd}"
+            raise ValueError(msg)
+        return du.EContainer(exited=exitcode, return_code=exitcode, command=remote_cmd)
+
+    def diff(self) -> list:
+        """
+        Return (op, recorded key or None, new key or None) for all operations which were not replayed exactly.
+        A new operation is paired with the most similar unused recorded operation (-> changed command).
+        """
+        unused = [(op, key) for (op, key), queue in self.recorded.items() for _ in queue]
+        res = []
+        for op, key in self.new_operations:
+            candidates = [other for other_op, other in unused if other_op == op]
+            match = difflib.get_close_matches(key, candidates, n=1, cutoff=0.6)
+            if match:
+                unused.remove((op, match[0]))
+                res.append((op, match[0], key))
+            else:
+                res.append((op, None, key))
+        res.extend((op, key, None) for op, key in unused)
+        return res
+
+    def replay_report(self) -> str:
+        recorded_time = sum(interaction.get("duration", 0) for interaction in self.replayed)
+        lines = [
+            f"replayed {len(self.replayed)}/{self.n_recorded} recorded operations in "
+            f"{time.time() - self.t_replay_start:.2f}s (recorded: {recorded_time:.1f}s remote time)"
+        ]
+        for op, old, new in self.diff():
+            if old is None:
+                lines.append(du.bred(f"+ new {op}: {new[:200]}"))
+            elif new is None:
+                lines.append(du.yellow(f"- not executed {op}: {old[:200]}"))
+            else:
+                lines.append(du.bred(f"~ changed {op}:"))
+                diff_lines = difflib.unified_diff(old.split("; "), new.split("; "), lineterm="", n=0)
+                lines.extend(f"    {line[:200]}" for line in diff_lines if not line.startswith(("---", "+++", "@@")))
+        if len(lines) == 1:
+            lines.append(du.bgreen("all remote operations match the cassette"))
+        return "\n".join(lines)
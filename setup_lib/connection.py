@@ -0,0 +1,190 @@
+"""
+Connection layer which sends all ssh traffic of a deployment through one multiplexed OpenSSH session.
+"""
+
+import os
+import sys
+import time
+import atexit
+import tempfile
+import threading
+import subprocess
+
+import deploymentutils as du
+
+
+class MuxConnection(du.StateConnection):
+    """
+    StateConnection which opens one OpenSSH ControlMaster socket and routes every remote command,
+    every `string_to_file` write (which is a remote command) and every rsync transfer through it.
+    Thus the ssh handshake (key exchange + authentication) is paid only once per run.
+    """
+
+    def __init__(self, remote, user, target="remote", control_persist="10m", **kwargs):
+        self.control_path = os.path.join(tempfile.gettempdir(), f"nst-mux-{os.getpid()}-%C")
+        self.control_persist = control_persist
+        self.handshake_time = 0.0
+        # mutable -> shared with copies of this connection (see setup_lib/scheduler.py); the lock as well
+        self.mux_stats = {"op_count": 0, "rsync_checked": False}
+        self.mux_lock = threading.Lock()
+
+        if target == "remote":
+            self._open_master(remote, user)
+            atexit.register(self.close)
+
+        super().__init__(remote, user, target=target, **kwargs)
+
+    def count_op(self):
+        # copies run steps concurrently -> `+=` on the shared dict is not atomic
+        with self.mux_lock:
+            self.mux_stats["op_count"] += 1
+
+    def ssh_options(self) -> list:
+        return [
+            "-o", f"ControlPath={self.control_path}",
+            "-o", "ControlMaster=auto",
+            "-o", f"ControlPersist={self.control_persist}",
+        ]
+
+    def ssh_command(self, *remote_args) -> list:
+        """
+        Return an argument list for `subprocess` which executes `remote_args` via the master socket.
+        """
+        return ["ssh", *self.ssh_options(), f"{self.user}@{self.remote}", *remote_args]
+
+    def _open_master(self, remote, user):
+        cmd = ["ssh", *self.ssh_options(), "-o", "ControlMaster=yes", "-f", "-N", f"{user}@{remote}"]
+        t0 = time.time()
+        res = subprocess.run(cmd)
+        self.handshake_time = time.time() - t0
+        if res.returncode != 0:
+            msg = "Could not open the ssh master connection. Ensure that ssh-agent is activated."
+            raise SystemExit(msg)
+        print(du.dim(f"ssh master connection established in {self.handshake_time:.2f}s"))
+
+    def run_target_command(self, full_command_lists, hide, warn, target_spec):
+
+        if target_spec == "default":
+            target_spec = self.target
+
+        if self.target != "remote" or target_spec not in ("remote", "both"):
+            return super().run_target_command(full_command_lists, hide, warn, target_spec)
+
+        full_command_txt = "; ".join([" ".join(cmd_list) for cmd_list in full_command_lists])
+        self.last_full_command_txt = full_command_txt
+
+        self.count_op()
+        proc = subprocess.Popen(
+            self.ssh_command(full_command_txt),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+
+        show_out = hide not in (True, "both", "out", "stdout")
+        show_err = hide not in (True, "both", "err", "stderr")
+        stdout_parts, stderr_parts = [], []
+        readers = [
+            threading.Thread(target=_pump, args=(proc.stdout, stdout_parts, sys.stdout if show_out else None)),
+            threading.Thread(target=_pump, args=(proc.stderr, stderr_parts, sys.stderr if show_err else None)),
+        ]
+        for reader in readers:
+            reader.start()
+        exitcode = proc.wait()
+        for reader in readers:
+            reader.join()
+
+        # mimic the attributes of invoke's Result which are used by the scripts
+        return du.EContainer(
+            exited=exitcode,
+            return_code=exitcode,
+            ok=exitcode == 0,
+            failed=exitcode != 0,
+            command=full_command_txt,
+            stdout="".join(stdout_parts),
+            stderr="".join(stderr_parts),
+        )
+
+    def pipe_file(self, local_fpath: str, remote_cmd: str, warn=False):
+        """
+        Run `remote_cmd` on the host with the content of `local_fpath` as stdin (no temporary file on the host).
+        """
+        self.count_op()
+        with open(local_fpath, "rb") as fp:
+            res = subprocess.run(self.ssh_command(remote_cmd), stdin=fp)
+        if res.returncode != 0 and not warn:
+            msg = f"remote command failed with exit code {res.returncode}: {remote_cmd}"
+            raise ValueError(msg)
+        return du.EContainer(exited=res.returncode, return_code=res.returncode, command=remote_cmd)
+
+    def check_rsync(self):
+        # the result does not change during a run -> check only once instead of before every transfer
+        if not self.mux_stats["rsync_checked"]:
+            super().check_rsync()
+            self.mux_stats["rsync_checked"] = True
+
+    def _rsync_call(
+        self,
+        source,
+        dest,
+        target_spec,
+        filters,
+        printonly=False,
+        tol_nonzero_exit=False,
+        delete=False,
+        additional_flags="",
+    ):
+        if self.target != "remote":
+            return super()._rsync_call(
+                source, dest, target_spec, filters, printonly, tol_nonzero_exit, delete, additional_flags
+            )
+
+        # this mirrors du.StateConnection._rsync_call but uses the master socket for the transport
+        d = " --delete" if delete else ""
+        if additional_flags:
+            additional_flags = f" {additional_flags.lstrip()}"
+        rsh = " ".join(["ssh", *self.ssh_options()])
+        cmd = f"rsync -pthrvz{d}{additional_flags} --rsh='{rsh}' {filters} {source} {dest}"
+
+        if printonly:
+            print("->:", cmd)
+            return du.EContainer(exited=0)
+        if target_spec not in ("both", self.target):
+            print(du.dim(f"> Omitting rsync command `{cmd}`\n> due to target_spec: {target_spec}."))
+            return du.EContainer(exited=0)
+
+        self.count_op()
+        exitcode = os.system(cmd)
+        if not tol_nonzero_exit and exitcode != 0:
+            msg = "rsync failed. See error message above."
+            raise ValueError(msg)
+        return du.EContainer(exited=exitcode)
+
+    def mux_report(self) -> str:
+        op_count = self.mux_stats["op_count"]
+        saved = self.handshake_time * max(op_count - 1, 0)
+        return (
+            f"{op_count} ssh operations shared one handshake of {self.handshake_time:.2f}s "
+            f"-> approx. {saved:.1f}s of handshake time saved"
+        )
+
+    def close(self):
+        """
+        Print the handshake statistics and terminate the master connection.
+        """
+        if self.target != "remote" or self.handshake_time == 0:
+            return
+        print(du.dim(self.mux_report()))
+        cmd = ["ssh", "-o", f"ControlPath={self.control_path}", "-O", "exit", f"{self.user}@{self.remote}"]
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.handshake_time = 0
+
+
+def _pump(stream, parts: list, echo_to=None):
+    for line in iter(stream.readline, ""):
+        parts.append(line)
+        if echo_to is not None:
+            echo_to.write(line)
+            echo_to.flush()
+    stream.close()
@@ -0,0 +1,161 @@
+"""
+Batched editing of remote (config) files: all target files are fetched in one transfer, the replacements are
+applied locally and all changed files are written back in one remote command.
+"""
+
+import io
+import gzip
+import shlex
+import base64
+import hashlib
+import tarfile
+import tempfile
+
+import deploymentutils as du
+
+
+# commands with a larger embedded payload (base64) are replaced by an upload via rsync
+# (limit of one argument: 128 KiB, MAX_ARG_STRLEN; the whole script is one argument of `bash -c`)
+MAX_INLINE_COMMAND = 100 * 1024
+
+BACKUP_SUFFIX = ".nst-bak"
+
+
+class EditBatch:
+    """
+    Collect search-and-replace edits for several remote files and apply them together. Usage:
+
+        edits = EditBatch(c)
+        edits.add("/etc/memcached.conf", [("-m 64", "-m 512")])
+        edits.add(pool_conf_fpath, replacements)
+        changed = edits.apply()  # list of files which actually changed
+
+    Each `old` string must occur exactly once. A replacement which was already applied (`old` missing, `new`
+    present exactly once) is skipped, thus re-running a step does not fail and does not touch unchanged files.
+    Before a file is replaced for the first time, a backup (`<fpath>.nst-bak`) is created (later edits keep it);
+    owner and mode are preserved.
+    """
+
+    def __init__(self, c: du.StateConnection):
+        self.c = c
+        # fpath -> list of (old, new) (insertion ordered)
+        self.edits = {}
+
+    def add(self, fpath: str, replacements: list):
+        self.edits.setdefault(fpath, []).extend(replacements)
+
+    def fetch(self) -> dict:
+        """
+        Return {fpath: content} of all target files (one remote command).
+        """
+        fpaths = " ".join(shlex.quote(fpath) for fpath in self.edits)
+        res = self.c.run(f"tar -czf - --absolute-names {fpaths} | base64 -w0", hide=True, use_dir=False)
+        contents = {}
+        with tarfile.open(fileobj=io.BytesIO(base64.b64decode(res.stdout)), mode="r:gz") as tar:
+            for member in tar.getmembers():
+                if member.isfile():
+                    contents[member.name] = tar.extractfile(member).read().decode("utf8")
+        missing = [fpath for fpath in self.edits if fpath not in contents]
+        if missing:
+            msg = f"could not fetch the following files: {missing}"
+            raise FileNotFoundError(msg)
+        return contents
+
+    @staticmethod
+    def apply_replacements(fpath: str, content: str, replacements: list) -> (str, list):
+        """
+        Return the new content and a list of error messages (empty if every replacement is valid).
+        """
+        errors = []
+        for old, new in replacements:
+            n_old = content.count(old)
+            n_new = content.count(new)
+            if n_new == 1 and n_old == (1 if old in new else 0):
+                # already applied
+                continue
+            if n_old != 1:
+                errors.append(f"{fpath}: {old!r} found {n_old} times, expected 1")
+                continue
+            content = content.replace(old, new, 1)
+        return content, errors
+
+    def apply(self) -> list:
+        """
+        Apply all edits and return the list of changed files. Nothing is written if any replacement is invalid.
+        """
+        if not self.edits:
+            return []
+
+        if getattr(self.c, "records_only", False):
+            # remote content is not available at compile time -> let the host apply the edits
+            for fpath, replacements in self.edits.items():
+                self.c.multi_edit_file(fpath, replacements)
+            return list(self.edits)
+
+        originals = self.fetch()
+        changed = {}
+        errors = []
+        for fpath, replacements in self.edits.items():
+            content, file_errors = self.apply_replacements(fpath, originals[fpath], replacements)
+            errors.extend(file_errors)
+            if content != originals[fpath]:
+                changed[fpath] = content
+
+        if errors:
+            msg = "invalid edits (no file was changed):\n  " + "\n  ".join(errors)
+            raise ValueError(msg)
+
+        for fpath in self.edits:
+            state = du.bgreen("changed") if fpath in changed else du.dim("unchanged")
+            print(f"{fpath}: {state}")
+        if changed:
+            self._write_back(changed, originals)
+        return list(changed)
+
+    def _write_back(self, changed: dict, originals: dict):
+        buffer = io.BytesIO()
+        # mtime=0: identical edits result in identical commands (see setup_lib/cassette.py)
+        with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as gz, tarfile.open(fileobj=gz, mode="w") as tar:
+            for i, content in enumerate(changed.values()):
+                data = content.encode("utf8")
+                info = tarfile.TarInfo(name=str(i))
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        payload = buffer.getvalue()
+
+        # 1. verify that no file changed since it was fetched, 2. backup and replace every file via `mv` (atomic)
+        check_lines, replace_lines = [], []
+        for i, fpath in enumerate(changed):
+            sha = hashlib.sha256(originals[fpath].encode("utf8")).hexdigest()
+            q = shlex.quote(fpath)
+            check_lines.append(f"echo {shlex.quote(f'{sha}  {fpath}')} | sha256sum --check --quiet -")
+            replace_lines.extend([
+                # the backup keeps the original state (it is not overwritten by later edits)
+                f"test -e {q}{BACKUP_SUFFIX} || cp -p {q} {q}{BACKUP_SUFFIX}",
+                f"cp $d/{i} {q}.nst-tmp",
+                f"chown --reference={q} {q}.nst-tmp",
+                f"chmod --reference={q} {q}.nst-tmp",
+                f"mv {q}.nst-tmp {q}",
+            ])
+
+        def render(source: str, cleanup="") -> str:
+            script = "\n".join([
+                "set -e",
+                *check_lines,
+                "d=$(mktemp -d)",
+                f"{source} | tar -xzf - -C $d",
+                *replace_lines,
+                f"rm -rf $d {cleanup}".rstrip(),
+            ])
+            return f"bash -c {shlex.quote(script)}"
+
+        cmd = render(f"echo {base64.b64encode(payload).decode('utf8')} | base64 -d")
+        if len(cmd) > MAX_INLINE_COMMAND:
+            # unique on the host (several fleet workers or forked connections may edit concurrently)
+            upload_fpath = self.c.run("mktemp --suffix=.tar.gz", hide=True, use_dir=False).stdout.strip()
+            with tempfile.NamedTemporaryFile(suffix=".tar.gz") as fp:
+                fp.write(payload)
+                fp.flush()
+                self.c.rsync_upload(fp.name, upload_fpath, "remote")
+            cmd = render(f"cat {upload_fpath}", cleanup=upload_fpath)
+        self.c.run(cmd, use_dir=False)
@@ -0,0 +1,147 @@
+"""
+Host facts (OS, cores, memory, installed packages, PHP version, k3s/helm state, ...) gathered with one remote command
+and cached for the run. Steps which change a fact (e.g. install packages) invalidate it; it is gathered again (with
+all other invalidated facts) on the next access.
+
+Usage:
+
+    facts = HostFacts(c)
+    if "mariadb-server" not in facts["packages"]:
+        ...
+    facts.invalidate("packages")
+"""
+
+import json
+import time
+import threading
+
+import deploymentutils as du
+
+from . import REMOTE_STATE_DIR
+
+
+def _text(output: str) -> str:
+    return output.strip()
+
+
+def _int(output: str) -> int:
+    output = output.strip()
+    return int(output) if output.isdigit() else 0
+
+
+def _lines(output: str) -> set:
+    return {line.strip() for line in output.splitlines() if line.strip()}
+
+
+def _json(output: str) -> dict:
+    try:
+        return json.loads(output)
+    except ValueError:
+        return {}
+
+
+# name -> (shell snippet which prints the fact, parser); snippets must not fail (missing tools -> empty output)
+PROBES = {
+    "os": ("lsb_release -ds", _text),
+    "os_codename": ("lsb_release -cs", _text),
+    "arch": ("dpkg --print-architecture", _text),
+    "nproc": ("nproc", _int),
+    "mem_total_mb": ("awk '/^MemTotal:/ {print int($2 / 1024)}' /proc/meminfo", _int),
+    "innodb_buffer_pool_mb": ("mysql -NBe 'SELECT @@innodb_buffer_pool_size DIV 1048576'", _int),
+    "php_version": ("php -r 'echo PHP_MAJOR_VERSION, \".\", PHP_MINOR_VERSION;'", _text),
+    "packages": ("dpkg-query -W -f='${db:Status-Abbrev} ${Package}\\n' | awk '$1 == \"ii\" {print $2}'", _lines),
+    "active_services": (
+        "systemctl list-units --type=service --state=active --no-legend --plain | awk '{print $1}'", _lines
+    ),
+    "k3s_version": ("k3s --version | awk 'NR == 1 {print $3}'", _text),
+    "helm_version": ("helm version --short", _text),
+    "helm_releases": ("timeout 10 helm list -A -q", _lines),
+    "namespaces": ("timeout 10 kubectl get namespaces -o name | cut -d/ -f2", _lines),
+    # stored results of setup_lib/preflight.py
+    "preflight": (f"cat {REMOTE_STATE_DIR}/preflight.json", _json),
+}
+
+MARKER = "@@nst_fact"
+
+
+def probe_script(names, probes: dict = PROBES) -> str:
+    """
+    Return one shell command which prints all facts (each after a marker line).
+    """
+    return "; ".join(f"echo '{MARKER} {name}'; ( {probes[name][0]} ) 2>/dev/null" for name in names)
+
+
+def parse_output(output: str, probes: dict = PROBES) -> dict:
+    """
+    Return {name: value} from the output of `probe_script`.
+    """
+    raw = {}
+    name = None
+    for line in output.splitlines():
+        if line.startswith(f"{MARKER} "):
+            name = line[len(MARKER) + 1:].strip()
+            raw[name] = []
+        elif name is not None:
+            raw[name].append(line)
+    return {name: probes[name][1]("\n".join(lines)) for name, lines in raw.items()}
+
+
+class HostFacts:
+    """
+    Lazily gathered, cached facts of the host of `c` (thread safe, steps may run concurrently).
+    """
+
+    def __init__(self, c: du.StateConnection, probes: dict = None):
+        self.c = c
+        self.probes = probes or PROBES
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def gather(self, names=None):
+        """
+        Gather the given facts (default: all facts which are not cached) with one remote command.
+        """
+        with self._lock:
+            if names is None:
+                names = [name for name in self.probes if name not in self._values]
+            if not names:
+                return
+            if getattr(self.c, "records_only", False):
+                # a BundleRecorder: the bundle does not rely on the facts of compile time (no remote command)
+                values = {}
+            else:
+                t0 = time.time()
+                res = self.c.run(probe_script(names, self.probes), hide=True, warn=True, use_dir=False)
+                values = parse_output(res.stdout, self.probes)
+                print(du.dim(f"gathered {len(names)} host facts with one remote command ({time.time() - t0:.2f}s)"))
+            # missing output -> empty values instead of missing keys
+            for name in names:
+                self._values[name] = values.get(name, self.probes[name][1](""))
+
+    def __getitem__(self, name: str):
+        if name not in self.probes:
+            msg = f"unknown host fact: {name}"
+            raise KeyError(msg)
+        if name not in self._values:
+            self.gather()
+        return self._values[name]
+
+    def get(self, name: str, default=None):
+        value = self[name]
+        return value if value else default
+
+    def invalidate(self, *names):
+        """
+        Forget the given facts (all facts if no name is given) -> they are gathered again on the next access.
+        """
+        with self._lock:
+            if not names:
+                self._values.clear()
+            for name in names:
+                self._values.pop(name, None)
+
+    def sizing(self) -> dict:
+        """
+        Return the facts used by setup_lib/sizing.py and setup_lib/mariadb.py.
+        """
+        return {name: self[name] for name in ("nproc", "mem_total_mb", "innodb_buffer_pool_mb")}
@@ -0,0 +1,276 @@
+"""
+Fleet mode: run one of the deployment scripts for many hosts concurrently.
+
+usage (from the root directory of this repo):
+
+    python -m setup_lib.fleet fleet.toml
+
+See `fleet-example.toml` for the format. Each host gets its own process (and thus its own ssh master connection),
+its own config file (base config + host overrides) and its own log file.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tomllib
+except ModuleNotFoundError:
+    import tomli as tomllib
+
+import deploymentutils as du
+
+
+# environment variables which are set for every per-host process
+CONFIG_ENV_VAR = "NC_SETUP_CONFIG"
+WORKER_ENV_VAR = "NC_SETUP_FLEET_WORKER"
+HOST_DIR_ENV_VAR = "NC_SETUP_HOST_DIR"
+
+POLICIES = ("continue", "fail-fast")
+
+
+def config_fpath(default="config.toml") -> str:
+    """
+    Return the config file to be used by a deployment script (fleet mode passes a host specific file).
+    """
+    return os.environ.get(CONFIG_ENV_VAR, default)
+
+
+def host_dir(default: str) -> str:
+    """
+    Return the directory for local files of the current host (work directory, bundle): fleet mode passes the
+    directory of the host (all workers run the script from the same directory concurrently).
+    """
+    return os.environ.get(HOST_DIR_ENV_VAR, default)
+
+
+def is_fleet_worker() -> bool:
+    """
+    Return True if the current script was started by fleet mode (-> no interactive debugging, run all steps).
+    """
+    return os.environ.get(WORKER_ENV_VAR) == "1"
+
+
+class HostJob:
+    def __init__(self, name: str, settings: dict, run_dir: str):
+        self.name = name
+        self.settings = settings
+        self.host_dir = os.path.join(run_dir, name)
+        self.config_fpath = os.path.join(self.host_dir, "config.toml")
+        self.log_fpath = os.path.join(self.host_dir, "log.txt")
+        self.state = "queued"
+        self.t_start = None
+        self.t_end = None
+        self.exitcode = None
+        self.proc = None
+
+    @property
+    def elapsed(self) -> float:
+        if self.t_start is None:
+            return 0.0
+        return (self.t_end or time.time()) - self.t_start
+
+    def last_log_line(self, width=60) -> str:
+        try:
+            with open(self.log_fpath, "rb") as fp:
+                fp.seek(max(0, os.path.getsize(self.log_fpath) - 2000))
+                lines = [line for line in fp.read().decode("utf8", "replace").splitlines() if line.strip()]
+        except FileNotFoundError:
+            return ""
+        return lines[-1].strip()[:width] if lines else ""
+
+
+class Fleet:
+    """
+    Deploy a script to a list of hosts from a bounded worker pool.
+    """
+
+    def __init__(self, fleet_fpath: str):
+        with open(fleet_fpath, "rb") as fp:
+            fleet_data = tomllib.load(fp)
+        fleet_dir = os.path.dirname(os.path.abspath(fleet_fpath))
+
+        self.script = os.path.join(fleet_dir, fleet_data.get("script", "ubuntu24.04_v1.py"))
+        self.script_args = fleet_data.get("script_args", [])
+        self.policy = fleet_data.get("policy", "continue")
+        if self.policy not in POLICIES:
+            msg = f"invalid policy `{self.policy}` (valid values: {POLICIES})"
+            raise ValueError(msg)
+
+        with open(os.path.join(fleet_dir, fleet_data.get("base_config", "config.toml")), "rb") as fp:
+            base_config = tomllib.load(fp)
+
+        hosts = fleet_data.get("hosts", [])
+        if not hosts:
+            msg = f"no [[hosts]] defined in {fleet_fpath}"
+            raise ValueError(msg)
+        self.max_workers = min(fleet_data.get("max_workers", 16), len(hosts))
+
+        run_dir = os.path.join(fleet_dir, "fleet_runs", time.strftime("%Y-%m-%d__%H-%M-%S"))
+        self.jobs = []
+        for host_overrides in hosts:
+            settings = merge_settings(base_config, host_overrides)
+            name = host_overrides.get("name", settings["remote"])
+            self.jobs.append(HostJob(name, settings, run_dir))
+
+        names = [job.name for job in self.jobs]
+        if len(set(names)) != len(names):
+            msg = "host names must be unique (use the `name` key to distinguish hosts with the same address)"
+            raise ValueError(msg)
+
+        self._abort = threading.Event()
+
+    def _run_job(self, job: HostJob):
+        if self._abort.is_set():
+            job.state = "cancelled"
+            return
+
+        os.makedirs(job.host_dir, exist_ok=True)
+        # the config contains secrets -> only readable by the owner
+        with open(os.open(job.config_fpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as fp:
+            fp.write(dump_toml(job.settings))
+
+        env = dict(os.environ)
+        env[CONFIG_ENV_VAR] = os.path.abspath(job.config_fpath)
+        env[WORKER_ENV_VAR] = "1"
+        env[HOST_DIR_ENV_VAR] = os.path.abspath(job.host_dir)
+        env["PYTHONUNBUFFERED"] = "1"
+
+        job.state = "running"
+        job.t_start = time.time()
+        with open(job.log_fpath, "w") as log_file:
+            job.proc = subprocess.Popen(
+                [sys.executable, self.script, *self.script_args],
+                cwd=os.path.dirname(self.script),
+                stdin=subprocess.DEVNULL,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                env=env,
+            )
+            if self._abort.is_set():
+                # abort happened between the state change and the start of the process
+                job.proc.terminate()
+            job.exitcode = job.proc.wait()
+        job.t_end = time.time()
+
+        if self._abort.is_set() and job.exitcode != 0:
+            job.state = "cancelled"
+        elif job.exitcode == 0:
+            job.state = "ok"
+        else:
+            job.state = "failed"
+            if self.policy == "fail-fast":
+                self.abort()
+
+    def abort(self):
+        self._abort.set()
+        for job in self.jobs:
+            if job.state == "running" and job.proc is not None:
+                job.proc.terminate()
+
+    def status_table(self) -> str:
+        colors = {"ok": du.bgreen, "failed": du.bred, "running": du.bright, "cancelled": du.yellow}
+        name_width = max(len("host"), *(len(job.name) for job in self.jobs))
+        lines = [f"{'host':<{name_width}}  {'state':<9}  {'time':>7}  last output"]
+        for job in self.jobs:
+            state = colors.get(job.state, du.dim)(f"{job.state:<9}")
+            lines.append(f"{job.name:<{name_width}}  {state}  {job.elapsed:6.0f}s  {du.dim(job.last_log_line())}")
+        return "\n".join(lines)
+
+    def run(self, refresh_interval=1.0) -> bool:
+        """
+        Deploy to all hosts and show a live status table. Return True if all hosts succeeded.
+        """
+        print(f"deploying {os.path.basename(self.script)} to {len(self.jobs)} hosts "
+              f"({self.max_workers} workers, policy: {self.policy})")
+        print(f"logs: {os.path.dirname(self.jobs[0].host_dir)}\n")
+
+        interactive = sys.stdout.isatty()
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._run_job, job) for job in self.jobs]
+            last_states = None
+            try:
+                while not all(future.done() for future in futures):
+                    states = [job.state for job in self.jobs]
+                    if interactive:
+                        # redraw the table in place
+                        print("\033[H\033[J" + self.status_table(), flush=True)
+                    elif states != last_states:
+                        print(self.status_table() + "\n", flush=True)
+                    last_states = states
+                    time.sleep(refresh_interval)
+            except KeyboardInterrupt:
+                print("interrupted -> terminating all running deployments")
+                self.abort()
+            for future in futures:
+                # propagate unexpected errors from the worker threads
+                future.result()
+
+        print(self.status_table())
+        n_ok = sum(job.state == "ok" for job in self.jobs)
+        slowest = max(job.elapsed for job in self.jobs)
+        print(f"\n{n_ok}/{len(self.jobs)} hosts succeeded; total time: {time.time() - t0:.0f}s "
+              f"(slowest host: {slowest:.0f}s, sum of all hosts: {sum(job.elapsed for job in self.jobs):.0f}s)")
+        return n_ok == len(self.jobs)
+
+
+def merge_settings(base: dict, overrides: dict) -> dict:
+    """
+    Return a copy of `base` where the (possibly nested) values of `overrides` are replaced.
+    """
+    res = dict(base)
+    for key, value in overrides.items():
+        if key == "name":
+            continue
+        if isinstance(value, dict) and isinstance(res.get(key), dict):
+            res[key] = merge_settings(res[key], value)
+        else:
+            res[key] = value
+    return res
+
+
+def dump_toml(data: dict, _table_path=()) -> str:
+    """
+    Minimal toml serializer for the config files (scalars, lists of scalars and nested tables).
+    """
+    lines = []
+    tables = []
+    for key, value in data.items():
+        if isinstance(value, dict):
+            tables.append((key, value))
+        else:
+            # json string/list/bool/number literals are valid toml
+            lines.append(f"{key} = {json.dumps(value)}")
+
+    for key, value in tables:
+        table_path = (*_table_path, key)
+        lines.append(f"\n[{'.'.join(table_path)}]")
+        lines.append(dump_toml(value, table_path))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="deploy to multiple hosts concurrently")
+    parser.add_argument("fleet_file", help="toml file with the host list (see fleet-example.toml)")
+    parser.add_argument("--policy", choices=POLICIES, help="override the policy of the fleet file")
+    parser.add_argument("--max-workers", type=int, help="override the number of concurrent deployments")
+    args = parser.parse_args()
+
+    fleet = Fleet(args.fleet_file)
+    if args.policy:
+        fleet.policy = args.policy
+    if args.max_workers:
+        fleet.max_workers = args.max_workers
+
+    success = fleet.run()
+    sys.exit(0 if success else 1)
+
+
+if __name__ == "__main__":
+    main()
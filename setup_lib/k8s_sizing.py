@@ -0,0 +1,194 @@
+"""
+Resource requests and limits for the mattermost stack derived from the allocatable capacity of the node (instead of
+fixed values which waste large nodes and overcommit small ones).
+
+Model (cpu in millicores, memory in MiB, node: smallest node of the cluster):
+
+    usable              = node allocatable - SYSTEM_RESERVE (k3s system pods, cert-manager)
+    limit               = clamp(share * usable, MIN_LIMITS, MAX_LIMITS)
+                          (shares: DEFAULT_SHARES or `mattermost::resource_shares`; the memory of ingress-nginx is
+                          capped because it hardly grows with the load, the rest is left to the page cache)
+    cpu request         = limit * CPU_REQUEST_RATIO (bursting is allowed)
+    memory request      = limit * MEMORY_REQUEST_RATIO, postgres: = limit (its settings assume this memory)
+
+Mattermost connection pool (per replica, `replicas`: 1 or the maximum of the HorizontalPodAutoscaler):
+
+    without PgBouncer:  max_open = (postgres max_connections - 10) // replicas (10 for admin and migrations)
+    with PgBouncer:     max_open = min(300, (max_client_conn - 10) // replicas) (client connections are cheap)
+    max_idle            = clamp(max_open // 4, 2, 20)
+"""
+
+from textwrap import dedent
+
+import deploymentutils as du
+
+
+SYSTEM_RESERVE = {"cpu_m": 300, "memory_mb": 768}
+
+DEFAULT_SHARES = {"mattermost": 0.55, "postgres": 0.30, "ingress-nginx": 0.10}
+
+MIN_LIMITS = {
+    "mattermost": {"cpu_m": 500, "memory_mb": 1024},
+    "postgres": {"cpu_m": 250, "memory_mb": 256},
+    "ingress-nginx": {"cpu_m": 100, "memory_mb": 128},
+}
+
+MAX_LIMITS = {
+    "ingress-nginx": {"memory_mb": 512},
+}
+
+CPU_REQUEST_RATIO = 0.5
+MEMORY_REQUEST_RATIO = 0.75
+
+# used if the cluster cannot be queried (compile mode without `mattermost::node_allocatable`)
+NODE_ESTIMATE = {"cpu_m": 2000, "memory_mb": 4096}
+
+
+def parse_cpu(value: str) -> int:
+    """
+    Return the number of millicores of a kubernetes cpu quantity (e.g. "4" or "3900m").
+    """
+    if value.endswith("m"):
+        return int(value[:-1])
+    return int(float(value) * 1000)
+
+
+_MEMORY_UNITS = {
+    "Ki": 2**10, "Mi": 2**20, "Gi": 2**30, "Ti": 2**40, "k": 10**3, "M": 10**6, "G": 10**9, "T": 10**12,
+}
+
+
+def parse_memory(value: str) -> int:
+    """
+    Return the MiB of a kubernetes memory quantity (e.g. "16318412Ki" or "16Gi").
+    """
+    for suffix, factor in _MEMORY_UNITS.items():
+        if value.endswith(suffix) and value[: -len(suffix)].isdigit():
+            return int(value[: -len(suffix)]) * factor // 2**20
+    return int(value) // 2**20
+
+
+def read_node_allocatable(c: du.StateConnection, allocatable: dict = None) -> dict:
+    """
+    Return the allocatable cpu and memory of the smallest node (one remote command). Explicit values
+    (`allocatable`, e.g. {"cpu": "3900m", "memory": "16Gi"}) are used instead of the query (needed in compile mode).
+    """
+    if allocatable is not None:
+        return {"cpu_m": parse_cpu(str(allocatable["cpu"])), "memory_mb": parse_memory(str(allocatable["memory"]))}
+    if getattr(c, "records_only", False):
+        c.assume(
+            f"node allocatable: {NODE_ESTIMATE['cpu_m']}m cpu, {NODE_ESTIMATE['memory_mb']} MiB "
+            "(requests and limits; set mattermost::node_allocatable)"
+        )
+        return dict(NODE_ESTIMATE)
+    cmd = (
+        "kubectl get nodes -o "
+        "jsonpath='{range .items[*]}{.status.allocatable.cpu} {.status.allocatable.memory}{\"\\n\"}{end}'"
+    )
+    res = c.run(cmd, hide=True, use_dir=False)
+    nodes = [line.split() for line in res.stdout.splitlines() if line.strip()]
+    return {
+        "cpu_m": min(parse_cpu(cpu) for cpu, _ in nodes),
+        "memory_mb": min(parse_memory(memory) for _, memory in nodes),
+    }
+
+
+def size_components(node: dict, shares: dict = None) -> du.EContainer:
+    """
+    Compute requests and limits (see module docstring). The returned container has the attribute `components`
+    (dict: name -> {"cpu_request_m", "cpu_limit_m", "memory_request_mb", "memory_limit_mb"}) and `reasoning`.
+    """
+    shares = {**DEFAULT_SHARES, **(shares or {})}
+    unknown = set(shares) - set(DEFAULT_SHARES)
+    if unknown:
+        msg = f"unknown components in the resource shares: {', '.join(sorted(unknown))}"
+        raise ValueError(msg)
+    if sum(shares.values()) > 1:
+        msg = f"the resource shares must not sum up to more than 1: {shares}"
+        raise ValueError(msg)
+
+    usable_cpu = max(node["cpu_m"] - SYSTEM_RESERVE["cpu_m"], 0)
+    usable_memory = max(node["memory_mb"] - SYSTEM_RESERVE["memory_mb"], 0)
+    reasoning = [
+        f"node allocatable: {node['cpu_m']}m cpu, {node['memory_mb']} MiB -> usable (without system pods): "
+        f"{usable_cpu}m, {usable_memory} MiB",
+    ]
+
+    components = {}
+    for name, share in shares.items():
+        max_limits = MAX_LIMITS.get(name, {})
+        cpu_limit = max(min(int(share * usable_cpu), max_limits.get("cpu_m", usable_cpu)), MIN_LIMITS[name]["cpu_m"])
+        memory_limit = max(
+            min(int(share * usable_memory), max_limits.get("memory_mb", usable_memory)), MIN_LIMITS[name]["memory_mb"]
+        )
+        memory_ratio = 1 if name == "postgres" else MEMORY_REQUEST_RATIO
+        components[name] = {
+            "cpu_request_m": int(cpu_limit * CPU_REQUEST_RATIO),
+            "cpu_limit_m": cpu_limit,
+            "memory_request_mb": int(memory_limit * memory_ratio),
+            "memory_limit_mb": memory_limit,
+        }
+        reasoning.append(
+            f"{name} ({share:.0%}): cpu {components[name]['cpu_request_m']}m..{cpu_limit}m, "
+            f"memory {components[name]['memory_request_mb']}..{memory_limit} MiB"
+        )
+
+    if sum(res["memory_request_mb"] for res in components.values()) > usable_memory:
+        reasoning.append("WARNING: the node has not enough memory for the minimum requests")
+    return du.EContainer(components=components, reasoning=reasoning)
+
+
+def helm_resource_args(resources: dict, prefix="controller.resources") -> str:
+    """
+    Return the `--set` arguments for the resources of a helm chart (e.g. ingress-nginx).
+    """
+    return (
+        f"--set {prefix}.requests.cpu={resources['cpu_request_m']}m "
+        f"--set {prefix}.requests.memory={resources['memory_request_mb']}Mi "
+        f"--set {prefix}.limits.cpu={resources['cpu_limit_m']}m "
+        f"--set {prefix}.limits.memory={resources['memory_limit_mb']}Mi"
+    )
+
+
+def hpa_yaml(name: str, namespace: str, max_replicas: int, cpu_utilization=75) -> str:
+    """
+    Return a HorizontalPodAutoscaler for the Deployment `name` (cpu utilization relative to the request; the
+    metrics-server is part of k3s).
+    """
+    return dedent(f"""
+    ---
+    apiVersion: autoscaling/v2
+    kind: HorizontalPodAutoscaler
+    metadata:
+      name: {name}
+      namespace: {namespace}
+    spec:
+      scaleTargetRef:
+        apiVersion: apps/v1
+        kind: Deployment
+        name: {name}
+      minReplicas: 1
+      maxReplicas: {max_replicas}
+      metrics:
+      - type: Resource
+        resource:
+          name: cpu
+          target:
+            type: Utilization
+            averageUtilization: {cpu_utilization}
+    """)
+
+
+def sql_pool_settings(max_connections: int, replicas: int = 1, pgbouncer_max_client_conn: int = None):
+    """
+    Return a container with `max_open`, `max_idle` (per Mattermost replica) and `reasoning`.
+    """
+    if pgbouncer_max_client_conn is None:
+        max_open = max((max_connections - 10) // replicas, 2)
+        basis = f"postgres max_connections {max_connections}"
+    else:
+        max_open = max(min(300, (pgbouncer_max_client_conn - 10) // replicas), 2)
+        basis = f"pgbouncer max_client_conn {pgbouncer_max_client_conn}"
+    max_idle = max(2, min(max_open // 4, 20))
+    reasoning = [f"mattermost sql pool: {basis}, {replicas} replica(s) -> max_open {max_open}, max_idle {max_idle}"]
+    return du.EContainer(max_open=max_open, max_idle=max_idle, reasoning=reasoning)
@@ -0,0 +1,120 @@
+"""
+Manifest pipeline for kubernetes objects: all objects are rendered and hashed locally, compared with the live
+objects (one `kubectl get`) and only the changed objects are sent with one server-side apply.
+
+The hash of the rendered object is stored in the annotation `HASH_ANNOTATION` of the live object. Changes made by
+other tools (e.g. `kubectl edit`) are therefore not detected; use `force=True` to apply all objects.
+"""
+
+import json
+import base64
+import hashlib
+
+import yaml
+import deploymentutils as du
+
+
+HASH_ANNOTATION = "nextcloud-setup-tool/manifest-hash"
+FIELD_MANAGER = "nextcloud-setup-tool"
+
+
+def object_key(obj: dict) -> tuple:
+    metadata = obj["metadata"]
+    return obj["kind"], metadata.get("namespace", ""), metadata["name"]
+
+
+def object_hash(obj: dict) -> str:
+    """
+    Hash of the canonical JSON representation (without the hash annotation itself).
+    """
+    obj = json.loads(json.dumps(obj))
+    obj["metadata"].get("annotations", {}).pop(HASH_ANNOTATION, None)
+    txt = json.dumps(obj, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(txt.encode("utf8")).hexdigest()[:16]
+
+
+def _b64_pipe(txt: str) -> str:
+    return f"echo {base64.b64encode(txt.encode('utf8')).decode('utf8')} | base64 -d"
+
+
+class ManifestSet:
+    """
+    Usage:
+
+        manifests = ManifestSet()
+        manifests.add(storage_yaml)
+        manifests.add(deployment_yaml)
+        manifests.apply(c)
+
+    Objects are applied in the order in which they were added (e.g. a Namespace before its content).
+    """
+
+    def __init__(self):
+        self.objects = {}
+
+    def add(self, yaml_txt: str):
+        """
+        Add all objects of a (multi-document) YAML string.
+        """
+        for obj in yaml.safe_load_all(yaml_txt):
+            if not obj:
+                continue
+            key = object_key(obj)
+            if key in self.objects:
+                msg = f"duplicate manifest object: {'/'.join(key)}"
+                raise ValueError(msg)
+            obj.setdefault("metadata", {}).setdefault("annotations", {})[HASH_ANNOTATION] = object_hash(obj)
+            self.objects[key] = obj
+
+    def to_yaml(self, keys=None) -> str:
+        if keys is None:
+            keys = list(self.objects)
+        return yaml.safe_dump_all([self.objects[key] for key in keys], sort_keys=False)
+
+    def live_hashes(self, c: du.StateConnection) -> dict:
+        """
+        Return {key: hash annotation} of the live objects (one `kubectl get` for all objects; objects which do not
+        exist yet are missing in the result).
+        """
+        cmd = f"{_b64_pipe(self.to_yaml())} | kubectl get -f - -o json --ignore-not-found"
+        res = c.run(cmd, hide=True, use_dir=False)
+        if not res.stdout.strip():
+            return {}
+        doc = json.loads(res.stdout)
+        items = doc["items"] if doc.get("kind") == "List" else [doc]
+        return {
+            object_key(item): item["metadata"].get("annotations", {}).get(HASH_ANNOTATION) for item in items
+        }
+
+    def diff(self, c: du.StateConnection) -> list:
+        """
+        Return the keys of all objects which are missing or differ from the live objects (in the order of `add`).
+        """
+        if getattr(c, "records_only", False):
+            # no live state available while recording a bundle
+            return list(self.objects)
+        live = self.live_hashes(c)
+        return [
+            key for key, obj in self.objects.items()
+            if live.get(key) != obj["metadata"]["annotations"][HASH_ANNOTATION]
+        ]
+
+    def apply(self, c: du.StateConnection, force=False) -> list:
+        """
+        Apply the changed objects with one server-side apply and return their keys.
+        """
+        changed = list(self.objects) if force else self.diff(c)
+        n_unchanged = len(self.objects) - len(changed)
+        if not changed:
+            print(du.bgreen(f"all {len(self.objects)} manifest objects are unchanged"))
+            return changed
+
+        if not getattr(c, "records_only", False):
+            print(du.dim(f"{n_unchanged} unchanged, applying {len(changed)}:"))
+            print(du.dim("\n".join(f"  {kind} {ns}/{name}".replace(" /", " ") for kind, ns, name in changed)))
+        c.run(
+            f"{_b64_pipe(self.to_yaml(changed))} | "
+            f"kubectl apply --server-side --force-conflicts --field-manager={FIELD_MANAGER} -f -",
+            use_dir=False,
+        )
+        return changed
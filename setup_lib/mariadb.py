@@ -0,0 +1,93 @@
+"""
+MariaDB profile derived from the host resources and the expected php-fpm concurrency (instead of the distro
+defaults, e.g. a 128 MiB buffer pool).
+
+Model (values in MiB):
+
+    innodb_buffer_pool_size = clamp(25% of MemTotal rounded down to 128, 128, 32768)
+                              (MariaDB shares the host with php-fpm, caches and the OS)
+    innodb_log_file_size    = clamp(buffer_pool / 4, 64, 2048) (fewer checkpoints for write bursts)
+    max_connections         = php-fpm max_children + 25 (cron, occ, admin sessions)
+    tmp_table_size          = max_heap_table_size = 64 (in-memory temporary tables for the larger queries)
+    transaction_isolation   = READ-COMMITTED (recommended by Nextcloud)
+    innodb_flush_method, innodb_io_capacity(_max): from the pre-flight disk tests (see setup_lib/preflight.py)
+"""
+
+import deploymentutils as du
+
+
+PROFILE_FPATH = "/etc/mysql/mariadb.conf.d/90-nextcloud.cnf"
+
+# the Nextcloud DB connection uses the socket (no tcp overhead)
+MARIADB_SOCKET = "/run/mysqld/mysqld.sock"
+
+
+def _clamp(value, lower, upper):
+    return max(lower, min(value, upper))
+
+
+def buffer_pool_mb(facts: dict) -> int:
+    return _clamp(facts["mem_total_mb"] // 4 // 128 * 128, 128, 32768)
+
+
+def mariadb_profile(facts: dict, fpm_max_children: int, io: du.EContainer = None) -> du.EContainer:
+    """
+    Compute the settings (see module docstring). The returned container has the attributes `buffer_pool_mb`,
+    `log_file_size_mb`, `max_connections`, `tmp_table_mb`, `io` and `reasoning`.
+
+    :param io:  result of `preflight.innodb_io_settings` (None: the defaults of MariaDB)
+    """
+    buffer_pool = buffer_pool_mb(facts)
+    log_file_size = _clamp(buffer_pool // 4, 64, 2048)
+    max_connections = fpm_max_children + 25
+    reasoning = [
+        f"mariadb: innodb_buffer_pool_size = {buffer_pool} MiB (25% of {facts['mem_total_mb']} MiB), "
+        f"innodb_log_file_size = {log_file_size} MiB",
+        f"mariadb: max_connections = {fpm_max_children} php-fpm workers + 25 = {max_connections}",
+    ]
+    if io is not None and io.io_capacity is None:
+        io = None
+    if io is not None:
+        reasoning.extend(io.reasoning)
+    return du.EContainer(
+        buffer_pool_mb=buffer_pool,
+        log_file_size_mb=log_file_size,
+        max_connections=max_connections,
+        tmp_table_mb=64,
+        io=io,
+        reasoning=reasoning,
+    )
+
+
+def profile_cnf(profile: du.EContainer) -> str:
+    io_lines = []
+    if profile.io is not None:
+        io_lines = [
+            f"innodb_flush_method = {profile.io.flush_method}",
+            f"innodb_io_capacity = {profile.io.io_capacity}",
+            f"innodb_io_capacity_max = {profile.io.io_capacity_max}",
+        ]
+    return "\n".join([
+        "# generated by nextcloud_setup_tool (see setup_lib/mariadb.py)",
+        "[mysqld]",
+        f"innodb_buffer_pool_size = {profile.buffer_pool_mb}M",
+        f"innodb_log_file_size = {profile.log_file_size_mb}M",
+        f"max_connections = {profile.max_connections}",
+        f"tmp_table_size = {profile.tmp_table_mb}M",
+        f"max_heap_table_size = {profile.tmp_table_mb}M",
+        "transaction_isolation = READ-COMMITTED",
+        *io_lines,
+        "",
+    ])
+
+
+def apply_profile(c: du.StateConnection, profile: du.EContainer):
+    """
+    Write the drop-in file and restart MariaDB (only if the file changed).
+    """
+    c.string_to_file(profile_cnf(profile), f"{PROFILE_FPATH}.new")
+    c.run(
+        f"if cmp -s {PROFILE_FPATH}.new {PROFILE_FPATH}; then rm {PROFILE_FPATH}.new; "
+        f"else mv {PROFILE_FPATH}.new {PROFILE_FPATH} && systemctl restart mariadb; fi",
+        use_dir=False,
+    )
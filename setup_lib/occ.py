@@ -0,0 +1,63 @@
+"""
+Nextcloud configuration via `occ config:import`: all values are collected into one JSON document and applied
+with a single invocation of occ (instead of one PHP bootstrap per `config:system:set`).
+"""
+
+import json
+import base64
+
+import deploymentutils as du
+
+
+OCC_BASE_CMD = "sudo -u www-data php /var/www/nextcloud/occ"
+
+
+class OccConfig:
+    """
+    Usage:
+
+        occ_config = OccConfig()
+        occ_config.set_system("overwrite.cli.url", "https://cloud.example.org")
+        occ_config.set_system("trusted_domains", ["localhost", "cloud.example.org"])
+        occ_config.set_app("files", "default_quota", "10 GB")
+        occ_config.apply(c)
+
+    Note: `config:import` merges the document into the existing config: keys which are not mentioned remain
+    unchanged, but list values (e.g. `trusted_domains`) are replaced as a whole. App config values must be strings.
+    """
+
+    def __init__(self, occ_base_cmd: str = OCC_BASE_CMD):
+        self.occ_base_cmd = occ_base_cmd
+        self.system = {}
+        self.apps = {}
+
+    def set_system(self, key: str, value):
+        self.system[key] = value
+
+    def update_system(self, values: dict):
+        self.system.update(values)
+
+    def set_app(self, app: str, key: str, value: str):
+        if not isinstance(value, str):
+            msg = f"app config values must be strings ({app}.{key}: {value!r})"
+            raise TypeError(msg)
+        self.apps.setdefault(app, {})[key] = value
+
+    def to_json(self) -> str:
+        document = {}
+        if self.system:
+            document["system"] = self.system
+        if self.apps:
+            document["apps"] = self.apps
+        return json.dumps(document, indent=2, sort_keys=True)
+
+    def apply(self, c: du.StateConnection):
+        """
+        Apply all collected values with one `occ config:import` (the document is passed via stdin).
+        """
+        if not self.system and not self.apps:
+            return
+        doc_b64 = base64.b64encode(self.to_json().encode("utf8")).decode("utf8")
+        n_values = len(self.system) + sum(len(values) for values in self.apps.values())
+        print(du.dim(f"importing {n_values} config values with one occ call"))
+        c.run(f"echo {doc_b64} | base64 -d | {self.occ_base_cmd} config:import", use_dir=False)
@@ -0,0 +1,94 @@
+"""
+Package planning: steps declare the apt packages they need, the plan installs all of them in one transaction.
+"""
+
+import re
+
+import deploymentutils as du
+
+
+def expand_braces(spec: str) -> list:
+    """
+    Expand shell-like brace groups, e.g. "php8.3-{cli,curl}" -> ["php8.3-cli", "php8.3-curl"].
+    """
+    match = re.search(r"\{([^{}]*)\}", spec)
+    if match is None:
+        return [spec]
+    res = []
+    for part in match.group(1).split(","):
+        res.extend(expand_braces(f"{spec[:match.start()]}{part}{spec[match.end():]}"))
+    return res
+
+
+class PackagePlan:
+    """
+    Collect the packages required by the step functions. Usage:
+
+        package_plan = PackagePlan()
+
+        @package_plan.requires("apache2 php8.3-{fpm,cli}")
+        def nc_prep02(c):
+            ...
+
+        package_plan.apply(c)  # one dpkg-query call + (at most) one apt-get update and one install transaction
+    """
+
+    def __init__(self):
+        # package name -> names of the steps which need it (insertion ordered)
+        self.requirements = {}
+
+    def require(self, step_name: str, packages):
+        if isinstance(packages, str):
+            packages = packages.split()
+        for spec in packages:
+            for package in expand_braces(spec):
+                self.requirements.setdefault(package, []).append(step_name)
+
+    def requires(self, packages):
+        """
+        Decorator to declare the packages of a step function.
+        """
+        def decorator(step_func):
+            self.require(step_func.__name__, packages)
+            return step_func
+        return decorator
+
+    @property
+    def packages(self) -> list:
+        return list(self.requirements)
+
+    def apply(self, c: du.StateConnection, upgrade=False, facts=None):
+        """
+        Install all missing packages in one apt transaction. The check which packages are missing (one
+        `dpkg-query` call) happens on the host in the same remote command, which therefore also works in a bundle.
+
+        :param upgrade:     also upgrade the already installed packages (after the same `apt-get update`)
+        :param facts:       optional `HostFacts` of the host: no remote command at all if all packages are installed
+                            (the fact `packages` is invalidated after an installation)
+        """
+        if facts is not None and not upgrade and not getattr(c, "records_only", False):
+            if set(self.packages) <= facts["packages"]:
+                print(du.dim(f"all {len(self.packages)} planned packages are already installed"))
+                return
+        packages = " ".join(self.packages)
+        apt = "sudo DEBIAN_FRONTEND=noninteractive apt-get -q"
+        if upgrade:
+            install_cmd = f"{apt} update && {apt} upgrade -y && {{ [ -z \"$missing\" ] || {apt} install -y $missing; }}"
+        else:
+            install_cmd = f"{apt} update && {apt} install -y $missing"
+
+        cmd = (
+            f"installed=$(dpkg-query -W -f='${{Package}} ${{db:Status-Abbrev}}\\n' {packages} 2>/dev/null"
+            " | awk '$2 == \"ii\" {print $1}'); "
+            f"missing=''; for p in {packages}; do "
+            'echo "$installed" | grep -qx "$p" || missing="$missing $p"; done; '
+            'if [ -n "$missing" ]; then echo "missing packages:$missing"; '
+            f"else echo 'all {len(self.packages)} planned packages are already installed'; fi; "
+        )
+        if upgrade:
+            cmd += install_cmd
+        else:
+            cmd += f'if [ -n "$missing" ]; then {install_cmd}; fi'
+        c.run(cmd, use_dir=False)
+        if facts is not None and not getattr(c, "records_only", False):
+            facts.invalidate("packages", "php_version", "active_services")
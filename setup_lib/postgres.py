@@ -0,0 +1,186 @@
+"""
+PostgreSQL settings for Mattermost derived from the available memory (pgtune-like, profile "web application")
+and an optional PgBouncer tier (transaction pooling) in front of the database.
+
+Model (mem: memory limit of the container or the share of the host RAM, values in MiB):
+
+    shared_buffers        = mem / 4
+    effective_cache_size  = mem * 3 / 4
+    maintenance_work_mem  = min(mem / 16, 2048)
+    work_mem              = max((mem - shared_buffers) / (3 * max_connections), 1) (each query may use several)
+    wal_buffers           = clamp(shared_buffers * 3%, 1, 16)
+    max_parallel_workers  = cpus, max_parallel_workers_per_gather = max(cpus // 2, 1), max_worker_processes >= 2
+    random_page_cost      = 1.1 for ssd storage, else 4 (ssd: see setup_lib/preflight.py)
+    effective_io_concurrency = 200 for ssd storage, else 2
+    + fixed values for the checkpoints
+"""
+
+import base64
+import hashlib
+from textwrap import dedent, indent
+
+import deploymentutils as du
+
+
+PGBOUNCER_IMAGE = "edoburu/pgbouncer:latest"
+PGBOUNCER_PORT = 5432
+
+
+def pgtune(memory_mb: int, cpus: int = 1, max_connections: int = 100, ssd=True) -> du.EContainer:
+    """
+    Return a container with the attributes `settings` (dict: name -> value as in postgresql.conf) and `reasoning`.
+    """
+    shared_buffers = memory_mb // 4
+    work_mem = max((memory_mb - shared_buffers) // (3 * max_connections), 1)
+    settings = {
+        "max_connections": max_connections,
+        "shared_buffers": f"{shared_buffers}MB",
+        "effective_cache_size": f"{memory_mb * 3 // 4}MB",
+        "maintenance_work_mem": f"{min(memory_mb // 16, 2048)}MB",
+        "work_mem": f"{work_mem}MB",
+        "wal_buffers": f"{max(1, min(shared_buffers * 3 // 100, 16))}MB",
+        "min_wal_size": "1GB",
+        "max_wal_size": "4GB",
+        "checkpoint_completion_target": 0.9,
+        "default_statistics_target": 100,
+        "random_page_cost": 1.1 if ssd else 4,
+        "effective_io_concurrency": 200 if ssd else 2,
+        "max_worker_processes": max(cpus, 2),
+        "max_parallel_workers": cpus,
+        "max_parallel_workers_per_gather": max(cpus // 2, 1),
+    }
+    reasoning = [
+        f"postgres: {memory_mb} MiB, {cpus} cpu(s), max_connections {max_connections} -> "
+        f"shared_buffers {settings['shared_buffers']}, effective_cache_size {settings['effective_cache_size']}, "
+        f"work_mem {settings['work_mem']}{'' if ssd else ', storage: hdd'}",
+    ]
+    return du.EContainer(settings=settings, reasoning=reasoning)
+
+
+def postgresql_conf(settings: dict, listen_all=False) -> str:
+    lines = ["# generated by nextcloud_setup_tool (see setup_lib/postgres.py)"]
+    if listen_all:
+        # this file replaces the default config of the container image (which listens on all interfaces)
+        lines.append("listen_addresses = '*'")
+    for name, value in settings.items():
+        if isinstance(value, str):
+            value = f"'{value}'"
+        lines.append(f"{name} = {value}")
+    return "\n".join(lines) + "\n"
+
+
+def config_hash(txt: str) -> str:
+    return hashlib.sha256(txt.encode("utf8")).hexdigest()[:16]
+
+
+def postgres_configmap_yaml(conf_txt: str, namespace="mattermost", name="postgres-config") -> str:
+    """
+    Return a ConfigMap which contains `postgresql.conf` (to be used with `-c config_file=...`).
+    """
+    return dedent(f"""
+    ---
+    apiVersion: v1
+    kind: ConfigMap
+    metadata:
+      name: {name}
+      namespace: {namespace}
+    data:
+      postgresql.conf: |
+    """) + indent(conf_txt, " " * 4)
+
+
+def pgbouncer_yaml(namespace="mattermost", pool_size=20, max_client_conn=500, image_pull_policy="Always") -> str:
+    """
+    Return a Deployment and a Service `pgbouncer` (transaction pooling) in front of the Service `postgres`.
+    The credentials are taken from the Secret `postgres-secret`.
+    """
+    return dedent(f"""
+    ---
+    apiVersion: apps/v1
+    kind: Deployment
+    metadata:
+      name: pgbouncer
+      namespace: {namespace}
+    spec:
+      replicas: 1
+      selector:
+        matchLabels:
+          app: pgbouncer
+      template:
+        metadata:
+          labels:
+            app: pgbouncer
+        spec:
+          containers:
+          - name: pgbouncer
+            image: {PGBOUNCER_IMAGE}
+            imagePullPolicy: {image_pull_policy}
+            ports:
+            - containerPort: {PGBOUNCER_PORT}
+            env:
+            - name: DB_HOST
+              value: "postgres"
+            - name: DB_NAME
+              value: "mattermost"
+            - name: DB_USER
+              valueFrom:
+                secretKeyRef:
+                  name: postgres-secret
+                  key: POSTGRES_USER
+            - name: DB_PASSWORD
+              valueFrom:
+                secretKeyRef:
+                  name: postgres-secret
+                  key: POSTGRES_PASSWORD
+            - name: AUTH_TYPE
+              value: "scram-sha-256"
+            - name: POOL_MODE
+              value: "transaction"
+            - name: DEFAULT_POOL_SIZE
+              value: "{pool_size}"
+            - name: MAX_CLIENT_CONN
+              value: "{max_client_conn}"
+            resources:
+              requests:
+                memory: "32Mi"
+                cpu: "50m"
+              limits:
+                memory: "128Mi"
+                cpu: "250m"
+    ---
+    apiVersion: v1
+    kind: Service
+    metadata:
+      name: pgbouncer
+      namespace: {namespace}
+    spec:
+      selector:
+        app: pgbouncer
+      ports:
+      - port: {PGBOUNCER_PORT}
+        targetPort: {PGBOUNCER_PORT}
+    """)
+
+
+def datasource(user: str, password: str, host="postgres", port=5432, pgbouncer=False) -> str:
+    """
+    Return the value of MM_SQLSETTINGS_DATASOURCE.
+    """
+    params = "sslmode=disable&connect_timeout=10"
+    if pgbouncer:
+        # no server side prepared statements (they do not work with transaction pooling)
+        host, port = "pgbouncer", PGBOUNCER_PORT
+        params = f"{params}&binary_parameters=yes"
+    return f"postgres://{user}:{password}@{host}:{port}/mattermost?{params}"
+
+
+def write_conf_d(c: du.StateConnection, conf_txt: str, fname="90-mattermost.conf"):
+    """
+    Write the settings to the conf.d directory of the distro package (all installed versions) and restart.
+    """
+    b64_cmd = f"echo {base64.b64encode(conf_txt.encode('utf8')).decode('utf8')} | base64 -d"
+    c.run(
+        f"for d in /etc/postgresql/*/main/conf.d; do {b64_cmd} > $d/{fname}; done && "
+        "systemctl restart postgresql",
+        use_dir=False,
+    )
@@ -0,0 +1,313 @@
+"""
+Pre-flight benchmark of the host before the installation: short, bounded disk tests on the paths which will hold the
+data (Nextcloud data directory, k3s `local-path` storage root) and a cpu and memory bandwidth probe. The results
+are stored on the host (`REMOTE_STATE_DIR/preflight.json`, part of the host facts, see setup_lib/facts.py) and are
+reused by later runs; `force=True` runs the benchmark again.
+
+Tests per path (in the nearest existing directory, `size_mb` test file, each test at most `runtime_s`):
+
+    fio (if installed)      seq_write/seq_read (1 MiB blocks), sync_write (4 KiB random writes, fsync after each
+                            write like the InnoDB redo log), rand_read (4 KiB, queue depth 16)
+    dd (fallback)           seq_write/seq_read (1 MiB blocks), sync_write (4 KiB sequential writes with O_DSYNC);
+                            no random read test
+    cpu, memory             sha256 throughput of one core, memory copy bandwidth (python3 on the host)
+
+Decisions (values in MiB/s, IOPS):
+
+    host rejected           if below one of MIN_REQUIREMENTS (`preflight::allow_slow_host = true`: warning only)
+    innodb_flush_method     O_DIRECT if direct I/O works on the data path, else fsync (e.g. tmpfs)
+    innodb_io_capacity      clamp(sync_write_iops / 2 rounded down to 100, 200, 20000)
+                            (the background flushing should use about half of what the device sustains)
+    innodb_io_capacity_max  clamp(2 * innodb_io_capacity, 2000, 40000)
+    ssd                     rand_read_iops >= 2000 (fio) or sync_write_iops >= 500 (dd)
+                            -> postgres random_page_cost and effective_io_concurrency (see setup_lib/postgres.py)
+    separate data volume    recommended if the data path is on the root filesystem and has less than
+                            MIN_DATA_FREE_GB free, or if another mounted volume offers more free space
+"""
+
+import re
+import json
+import time
+import shlex
+
+import deploymentutils as du
+
+from . import REMOTE_STATE_DIR
+
+
+RESULTS_FPATH = f"{REMOTE_STATE_DIR}/preflight.json"
+
+NEXTCLOUD_DATA_DIR = "/var/www/nextcloud/data"
+LOCAL_PATH_STORAGE_DIR = "/var/lib/rancher/k3s/storage"
+
+MIN_REQUIREMENTS = {
+    "seq_write_mb_s": 50,
+    "seq_read_mb_s": 50,
+    "sync_write_iops": 100,
+    "cpu_sha256_mb_s": 100,
+    "mem_copy_gb_s": 0.5,
+}
+
+MIN_DATA_FREE_GB = 50
+
+MARKER = "@@nst_preflight"
+
+CPU_PROBE = (
+    "import hashlib, time; b = bytes(2**20); t = time.time(); "
+    "n = sum(1 for _ in iter(lambda: hashlib.sha256(b).digest() and time.time() - t < 1, False)); "
+    "print(round(n / (time.time() - t)))"
+)
+MEMORY_PROBE = (
+    # 8 copies of 128 MiB -> 1 GiB
+    "import time; b = bytearray(2**27); t = time.time(); [bytes(b) for _ in range(8)]; "
+    "print(round(1 / (time.time() - t), 2))"
+)
+
+# name -> fio arguments
+FIO_TESTS = {
+    "seq_write": "--rw=write --bs=1M --ioengine=psync",
+    "seq_read": "--rw=read --bs=1M --ioengine=psync",
+    "sync_write": "--rw=randwrite --bs=4k --ioengine=psync --fsync=1",
+    "rand_read": "--rw=randread --bs=4k --ioengine=libaio --iodepth=16",
+}
+
+
+def _path_script(i: int, path: str, runtime_s: int, size_mb: int) -> str:
+    """
+    Return the shell snippet which tests one path (output lines: `MARKER p<i> <name> <value>`).
+    """
+    out = f"echo {MARKER} p{i}"
+    fio_tests = "; ".join(
+        f"echo {MARKER} p{i} fio_{name} $(fio --name=nst --filename=\"$f\" --size={size_mb}M --runtime={runtime_s} "
+        f"--time_based --direct=$direct {args} --output-format=json 2>/dev/null | tr -d '\\n')"
+        for name, args in FIO_TESTS.items()
+    )
+    timeout = 3 * runtime_s
+    dd_tests = "; ".join([
+        f"{out} dd_seq_write $(timeout {timeout} dd if=/dev/zero of=\"$f\" bs=1M count={size_mb} $oflag "
+        "conv=fdatasync 2>&1 | tail -1)",
+        f"{out} dd_seq_read $(timeout {timeout} dd if=\"$f\" of=/dev/null bs=1M $iflag 2>&1 | tail -1)",
+        f"{out} dd_sync_write $(timeout {timeout} dd if=/dev/zero of=\"$f.sync\" bs=4k count=1000 oflag=dsync "
+        "2>&1 | tail -1)",
+    ])
+    return "; ".join([
+        f"d={shlex.quote(path)}",
+        'while [ ! -d "$d" ]; do d=$(dirname "$d"); done',
+        'f="$d/.nst-preflight.$$"',
+        f"{out} dir $d",
+        f"{out} df $(df -P -k \"$d\" | awk 'NR == 2 {{print $1, $4, $6}}')",
+        "if dd if=/dev/zero of=\"$f\" bs=4k count=1 oflag=direct 2>/dev/null; "
+        "then direct=1; oflag=oflag=direct; iflag=iflag=direct; else direct=0; oflag=; iflag=; fi",
+        f"{out} direct_io $direct",
+        f"if command -v fio >/dev/null; then {fio_tests}; else {dd_tests}; fi",
+        'rm -f "$f" "$f.sync"',
+    ])
+
+
+def preflight_script(paths: list, runtime_s=5, size_mb=256) -> str:
+    """
+    Return one shell command which runs all tests (sudo: the paths may belong to root).
+    """
+    parts = [
+        f"echo {MARKER} host cpu_sha256_mb_s $(python3 -c {shlex.quote(CPU_PROBE)} 2>/dev/null)",
+        f"echo {MARKER} host mem_copy_gb_s $(python3 -c {shlex.quote(MEMORY_PROBE)} 2>/dev/null)",
+        f"echo {MARKER} host mounts $(df -P -k -x tmpfs -x devtmpfs -x overlay -x squashfs "
+        "| awk 'NR > 1 {printf \"%s,%s,%s;\", $1, $4, $6}')",
+        *(_path_script(i, path, runtime_s, size_mb) for i, path in enumerate(paths)),
+    ]
+    return f"sudo LC_ALL=C bash -c {shlex.quote('; '.join(parts))}"
+
+
+def _float(value: str):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _fio_metrics(name: str, output: str) -> dict:
+    try:
+        job = json.loads(output)["jobs"][0]
+    except (ValueError, KeyError, IndexError):
+        return {}
+    io = job["read"] if name.endswith("read") else job["write"]
+    if name.startswith("seq"):
+        return {f"{name}_mb_s": round(io["bw"] / 1024, 1)}
+    res = {f"{name}_iops": round(io["iops"])}
+    percentiles = io.get("clat_ns", {}).get("percentile", {})
+    if "99.000000" in percentiles:
+        res[f"{name}_p99_ms"] = round(percentiles["99.000000"] / 1e6, 2)
+    return res
+
+
+_DD_RE = re.compile(r"^(\d+) bytes .* copied, ([\d.]+) s")
+
+
+def _dd_metrics(name: str, output: str) -> dict:
+    match = _DD_RE.match(output)
+    if not match or float(match.group(2)) == 0:
+        return {}
+    n_bytes, seconds = int(match.group(1)), float(match.group(2))
+    if name == "sync_write":
+        return {"sync_write_iops": round(n_bytes / 4096 / seconds)}
+    return {f"{name}_mb_s": round(n_bytes / 2**20 / seconds, 1)}
+
+
+def parse_output(output: str, paths: list) -> dict:
+    results = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "tool": "dd", "paths": {}, "mounts": []}
+    path_results = [{} for _ in paths]
+    for line in output.splitlines():
+        if not line.startswith(f"{MARKER} "):
+            continue
+        fields = line.split(maxsplit=3)
+        if len(fields) < 3:
+            continue
+        scope, name, value = fields[1], fields[2], fields[3] if len(fields) > 3 else ""
+        if scope == "host":
+            if name == "mounts":
+                for mount in filter(None, value.split(";")):
+                    source, avail_kb, target = mount.split(",")
+                    results["mounts"].append({"source": source, "avail_gb": int(avail_kb) // 2**20, "target": target})
+            else:
+                results[name] = _float(value)
+            continue
+        res = path_results[int(scope[1:])]
+        if name == "dir":
+            res["tested_dir"] = value
+        elif name == "df":
+            source, avail_kb, mountpoint = value.split()
+            res.update(source=source, avail_gb=int(avail_kb) // 2**20, mountpoint=mountpoint)
+        elif name == "direct_io":
+            res["direct_io"] = value == "1"
+        elif name.startswith("fio_"):
+            results["tool"] = "fio"
+            res.update(_fio_metrics(name[4:], value))
+        elif name.startswith("dd_"):
+            res.update(_dd_metrics(name[3:], value))
+    results["paths"] = dict(zip(paths, path_results))
+    return results
+
+
+def run_preflight(c: du.StateConnection, facts, paths: list, runtime_s=5, size_mb=256, force=False) -> dict:
+    """
+    Return the stored results (if they cover `paths`) or run the benchmark with one remote command (about
+    4 * runtime_s per path) and store the results on the host. `facts`: HostFacts of `c`.
+    """
+    if getattr(c, "records_only", False):
+        return {}
+    stored = facts["preflight"]
+    missing = [path for path in paths if path not in stored.get("paths", {})]
+    if not force and not missing:
+        print(du.dim(f"pre-flight: using the results of {stored['date']} (stored on the host)"))
+        return stored
+    paths = paths if force else missing
+    print(f"pre-flight: benchmarking {', '.join(paths)} (about {4 * runtime_s * len(paths)}s)")
+    res = c.run(preflight_script(paths, runtime_s, size_mb), hide=True, warn=True, use_dir=False)
+    results = parse_output(res.stdout, paths)
+    results["paths"] = {**stored.get("paths", {}), **results["paths"]}
+
+    c.run(f"mkdir -p {REMOTE_STATE_DIR}", use_dir=False)
+    c.string_to_file(json.dumps(results, indent=1), RESULTS_FPATH, mode=">")
+    facts.invalidate("preflight")
+    print(du.dim(summary(results)))
+    return results
+
+
+def summary(results: dict) -> str:
+    lines = [
+        f"pre-flight ({results.get('tool')}): cpu {results.get('cpu_sha256_mb_s')} MB/s sha256 (one core), "
+        f"memory copy {results.get('mem_copy_gb_s')} GB/s"
+    ]
+    for path, res in results.get("paths", {}).items():
+        metrics = ", ".join(
+            f"{key} {res[key]}" for key in (
+                "seq_write_mb_s", "seq_read_mb_s", "sync_write_iops", "sync_write_p99_ms", "rand_read_iops"
+            ) if key in res
+        )
+        lines.append(f"  {path} (tested in {res.get('tested_dir')} on {res.get('source')}): {metrics}")
+    return "\n".join(lines)
+
+
+def check_host(results: dict, allow_slow=False) -> list:
+    """
+    Return the reasoning; raise SystemExit if the host is too slow (see MIN_REQUIREMENTS) and not `allow_slow`.
+    """
+    problems = []
+    measured = [results, *results.get("paths", {}).values()]
+    for key, minimum in MIN_REQUIREMENTS.items():
+        for values in measured:
+            # missing values (e.g. no python3 on the host) are not held against the host
+            if values.get(key) is not None and values[key] < minimum:
+                problems.append(f"{key} = {values[key]} < {minimum}")
+    if not problems:
+        return ["pre-flight: the host meets the minimum requirements"]
+    msg = f"pre-flight: the host is too slow: {'; '.join(problems)}"
+    if not allow_slow:
+        raise SystemExit(f"{msg} (set `preflight::allow_slow_host = true` in the config to continue anyway)")
+    return [f"WARNING: {msg} (allowed by the config)"]
+
+
+def _clamp(value, lower, upper):
+    return max(lower, min(value, upper))
+
+
+def innodb_io_settings(results: dict, data_path=NEXTCLOUD_DATA_DIR) -> du.EContainer:
+    """
+    Return a container with `flush_method`, `io_capacity`, `io_capacity_max` and `reasoning` (None values if the
+    path was not benchmarked, e.g. in compile mode).
+    """
+    res = results.get("paths", {}).get(data_path)
+    if not res or not res.get("sync_write_iops"):
+        return du.EContainer(flush_method=None, io_capacity=None, io_capacity_max=None, reasoning=[])
+    flush_method = "O_DIRECT" if res.get("direct_io") else "fsync"
+    io_capacity = _clamp(res["sync_write_iops"] // 2 // 100 * 100, 200, 20000)
+    io_capacity_max = _clamp(2 * io_capacity, 2000, 40000)
+    reasoning = [
+        f"mariadb: innodb_flush_method = {flush_method} (direct I/O {'works' if res.get('direct_io') else 'fails'}), "
+        f"innodb_io_capacity = {io_capacity} (sync writes: {res['sync_write_iops']} IOPS), "
+        f"innodb_io_capacity_max = {io_capacity_max}",
+    ]
+    return du.EContainer(
+        flush_method=flush_method, io_capacity=io_capacity, io_capacity_max=io_capacity_max, reasoning=reasoning
+    )
+
+
+def is_ssd(results: dict, path: str) -> bool:
+    """
+    Return whether the storage of `path` behaves like an ssd (True if it was not benchmarked).
+    """
+    res = results.get("paths", {}).get(path)
+    if not res:
+        return True
+    if "rand_read_iops" in res:
+        return res["rand_read_iops"] >= 2000
+    return res.get("sync_write_iops", 0) >= 500
+
+
+def data_volume_advice(results: dict, data_path=NEXTCLOUD_DATA_DIR) -> du.EContainer:
+    """
+    Return a container with `separate` (bool: a separate volume is recommended) and `reasoning`.
+    """
+    res = results.get("paths", {}).get(data_path)
+    if not res or "mountpoint" not in res:
+        return du.EContainer(separate=False, reasoning=[])
+    if res["mountpoint"] != "/":
+        return du.EContainer(
+            separate=False, reasoning=[f"data: {data_path} is on its own volume ({res['mountpoint']})"]
+        )
+    reasons = []
+    if res["avail_gb"] < MIN_DATA_FREE_GB:
+        reasons.append(f"only {res['avail_gb']} GB free on the root filesystem (< {MIN_DATA_FREE_GB} GB)")
+    larger = [
+        mount for mount in results.get("mounts", [])
+        if mount["target"] not in ("/", "/boot", "/boot/efi") and mount["avail_gb"] > res["avail_gb"]
+    ]
+    if larger:
+        best = max(larger, key=lambda mount: mount["avail_gb"])
+        reasons.append(f"{best['target']} ({best['source']}) has {best['avail_gb']} GB free")
+    if not reasons:
+        return du.EContainer(separate=False, reasoning=[f"data: {data_path} on the root filesystem is fine"])
+    return du.EContainer(
+        separate=True,
+        reasoning=[f"WARNING: consider a separate volume for {data_path}: {'; '.join(reasons)}"],
+    )
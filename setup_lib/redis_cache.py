@@ -0,0 +1,69 @@
+"""
+Redis as backend for Nextcloud's transactional file locking (memcached may evict locks under memory pressure) and
+optionally for the distributed cache. Redis listens only on a unix socket which is accessible for the group `redis`
+(www-data is added to it). APCu remains the local cache.
+
+Locks must never be evicted (`noeviction`). Nextcloud uses one redis connection for all its redis caches, thus
+locks and distributed cache cannot be split into two redis instances with different eviction policies:
+
+    locking only (distributed cache in memcached, LRU eviction):  no memory limit (locks are few and expire)
+    locking + distributed cache:  `maxmemory` must be large enough for both (a full instance rejects new entries)
+"""
+
+import deploymentutils as du
+
+
+REDIS_SOCKET = "/run/redis/redis-server.sock"
+
+# included at the end of /etc/redis/redis.conf -> overrides the defaults of the package
+REDIS_CONF_FPATH = "/etc/redis/nextcloud.conf"
+
+
+def redis_packages(php_version: str) -> list:
+    return ["redis-server", f"php{php_version}-redis"]
+
+
+def redis_conf(maxmemory_mb=0) -> str:
+    return "\n".join([
+        "# generated by nextcloud_setup_tool (see setup_lib/redis_cache.py)",
+        # no tcp listener
+        "port 0",
+        f"unixsocket {REDIS_SOCKET}",
+        "unixsocketperm 770",
+        # 0: no limit (only locks)
+        f"maxmemory {maxmemory_mb}mb",
+        # never evict keys (this could drop file locks)
+        "maxmemory-policy noeviction",
+        # locks and cache entries need no persistence (no fork for snapshots)
+        'save ""',
+        "appendonly no",
+        "",
+    ])
+
+
+def setup_redis(c: du.StateConnection, php_version: str, maxmemory_mb=0):
+    """
+    Configure redis-server (the packages must be installed already) and give www-data access to the socket.
+    """
+    c.string_to_file(redis_conf(maxmemory_mb), REDIS_CONF_FPATH)
+    include = f"include {REDIS_CONF_FPATH}"
+    c.run(f"grep -qxF '{include}' /etc/redis/redis.conf || echo '{include}' >> /etc/redis/redis.conf")
+    c.run("usermod -a -G redis www-data")
+    c.run("systemctl restart redis-server")
+    # the new group membership of the workers becomes effective after a restart
+    c.run(f"systemctl restart php{php_version}-fpm")
+    c.run(f"sudo -u www-data redis-cli -s {REDIS_SOCKET} ping")
+
+
+def nextcloud_redis_config(distributed=True) -> dict:
+    """
+    Return the system config values for Nextcloud (see setup_lib/occ.py).
+
+    :param distributed:  use redis for the distributed cache as well (False: memcached)
+    """
+    return {
+        "memcache.local": r"\OC\Memcache\APCu",
+        "memcache.distributed": r"\OC\Memcache\Redis" if distributed else r"\OC\Memcache\Memcached",
+        "memcache.locking": r"\OC\Memcache\Redis",
+        "redis": {"host": REDIS_SOCKET, "port": 0, "timeout": 1.5},
+    }
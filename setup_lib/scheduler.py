@@ -0,0 +1,171 @@
+"""
+Dependency-aware step scheduler: steps declare the steps they depend on and independent steps run concurrently
+(each on its own channel of the same host).
+"""
+
+import copy
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import deploymentutils as du
+
+
+class Step:
+    def __init__(self, func, depends=()):
+        self.func = func
+        self.name = func.__name__
+        self.depends = [dep if isinstance(dep, str) else dep.__name__ for dep in depends]
+        self.t_start = None
+        self.t_end = None
+
+    @property
+    def duration(self) -> float:
+        if self.t_start is None or self.t_end is None:
+            return 0.0
+        return self.t_end - self.t_start
+
+
+def fork_connection(c: du.StateConnection) -> du.StateConnection:
+    """
+    Return a copy of `c` with its own working directory and environment which shares the underlying transport
+    (MuxConnection: ssh master socket, du.StateConnection: fabric/paramiko connection). Each command then runs in
+    its own channel.
+    """
+    forked = copy.copy(c)
+    forked.dir = None
+    forked.cwd = None
+    forked.env_variables = dict(c.env_variables)
+    # deploymentutils' result shelf and --first-step mechanism rely on a linear step order
+    forked.first_step = 1
+    forked.store_result = lambda res, key=None: None
+    return forked
+
+
+class StepScheduler:
+    """
+    Run steps as DAG. Example:
+
+        scheduler = StepScheduler(c)
+        scheduler.add(nc_prep01)
+        scheduler.add(nc_prep03, depends=[nc_prep01])
+        scheduler.run()
+
+    :param runner:  callable `runner(step_func, connection)` which executes a step
+                    (default: `step_func(connection)`, see also `StepCache.run_step`)
+    """
+
+    def __init__(self, c: du.StateConnection, max_workers=4, runner=None):
+        self.c = c
+        self.max_workers = max_workers
+        self.runner = runner or (lambda step_func, connection: step_func(connection))
+        self.steps = {}
+
+    def add(self, func, depends=()):
+        step = Step(func, depends)
+        if step.name in self.steps:
+            msg = f"step `{step.name}` was already added"
+            raise ValueError(msg)
+        self.steps[step.name] = step
+        return func
+
+    def _check(self):
+        for step in self.steps.values():
+            for dep in step.depends:
+                if dep not in self.steps:
+                    msg = f"step `{step.name}` depends on unknown step `{dep}`"
+                    raise ValueError(msg)
+
+        # detect cycles (depth first search)
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                msg = f"dependency cycle: {' -> '.join([*path, name])}"
+                raise ValueError(msg)
+            state[name] = "visiting"
+            for dep in self.steps[name].depends:
+                visit(dep, [*path, name])
+            state[name] = "done"
+
+        for name in self.steps:
+            visit(name, [])
+
+    def _run_step(self, step: Step):
+        connection = fork_connection(self.c)
+        step.t_start = time.time()
+        print(du.bright(f"▶ start {step.name}"))
+        try:
+            self.runner(step.func, connection)
+        finally:
+            step.t_end = time.time()
+        print(du.bgreen(f"✓ finished {step.name} ({step.duration:.1f}s)"))
+
+    def run(self):
+        self._check()
+        pending = dict(self.steps)
+        done = set()
+        running = {}
+        t0 = time.time()
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    for name, step in list(pending.items()):
+                        if all(dep in done for dep in step.depends):
+                            running[executor.submit(self._run_step, step)] = name
+                            del pending[name]
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None and error is None:
+                        # do not start further steps, but let the running ones finish
+                        error = future.exception()
+                        print(du.bred(f"step {name} failed: {error}"))
+                    else:
+                        done.add(name)
+
+        if error is not None:
+            raise error
+
+        print(self.critical_path_report(wall_time=time.time() - t0))
+
+    def critical_path(self) -> list:
+        """
+        Return the chain of steps with the latest finish time if every step started as soon as its dependencies
+        were done (based on the measured durations).
+        """
+        finish = {}
+
+        def earliest_finish(name):
+            if name not in finish:
+                step = self.steps[name]
+                start = max((earliest_finish(dep) for dep in step.depends), default=0.0)
+                finish[name] = start + step.duration
+            return finish[name]
+
+        if not self.steps:
+            return []
+        name = max(self.steps, key=earliest_finish)
+        path = [name]
+        while self.steps[name].depends:
+            name = max(self.steps[name].depends, key=earliest_finish)
+            path.insert(0, name)
+        return [self.steps[name] for name in path]
+
+    def critical_path_report(self, wall_time: float) -> str:
+        path = self.critical_path()
+        total = sum(step.duration for step in path)
+        sequential = sum(step.duration for step in self.steps.values())
+        chain = " -> ".join(f"{step.name} ({step.duration:.1f}s)" for step in path)
+        return (
+            f"critical path ({total:.1f}s): {chain}\n"
+            f"wall time: {wall_time:.1f}s (sum of all steps: {sequential:.1f}s)"
+        )
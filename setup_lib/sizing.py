@@ -0,0 +1,233 @@
+"""
+Hardware-aware sizing of the PHP-FPM pool (instead of fixed numbers which are too large for small VMs and too
+small for large hosts).
+
+Model (all values in MiB):
+
+    available    = MemTotal - os_reserve - mariadb - memcached/redis - opcache - jit_buffer
+    os_reserve   = max(512, 5% of MemTotal)
+    mariadb      = max(innodb_buffer_pool_size, 128) + 256 (connections, sort and join buffers, ...)
+                   (the buffer pool planned by setup_lib/mariadb.py or the current one)
+    max_children = min(available // child_mb, 8 * nproc), at least 2
+                   (child_mb: typical resident memory of a Nextcloud FPM worker; more than ~8 workers per core
+                   only increase contention because a request is mostly CPU bound PHP + DB time)
+    pm           = "ondemand" for hosts with less than 2 GiB (idle workers return their memory), else "dynamic"
+    min_spare    = clamp(nproc, 1, max_children // 4)
+    max_spare    = clamp(2 * nproc, min_spare + 1, max_children // 2)
+    start        = min_spare + (max_spare - min_spare) // 2 (the php-fpm default formula)
+    max_requests = 500 (recycle workers to contain memory leaks of long running processes)
+
+Note: `memory_limit` in php.ini is a per-request ceiling, not the typical footprint. It is thus not used here.
+
+The caches are sized after the extraction of Nextcloud from the number and size of its PHP files (incl. apps):
+
+    opcache budget           = clamp(MemTotal / 8, 128, 1024) (assumed by the pool sizing above)
+    max_accelerated_files    = next opcache hash size (prime) >= 1.5 * n_files (headroom for apps installed later)
+    memory_consumption       = clamp(1.5 * php_source_size rounded up to 64, 128, opcache budget)
+    interned_strings_buffer  = clamp(next power of 2 >= 1.5 * n_files / 1000, 16, memory_consumption / 4)
+    apc.shm_size             = clamp(MemTotal / 64 rounded to 32, 32, 256)
+    memcached budget         = clamp(MemTotal / 16, 64, 1024) (assumed by the pool sizing above)
+    memcached memory         = clamp(php_source_size rounded up to 64, 64, memcached budget) (if configured as
+                               "auto"; the distributed cache mostly holds per-app data like routes, translations and
+                               app metadata, which grows with the installed code)
+    redis memory             = memcached budget (cache_backend "redis" with redis_memory "auto": locks and
+                               distributed cache in one instance which never evicts)
+"""
+
+import deploymentutils as du
+
+from .facts import HostFacts
+
+
+def read_host_facts(c: du.StateConnection) -> dict:
+    """
+    Read the facts relevant for sizing with one remote command (use `HostFacts(c).sizing()` if other facts are
+    needed as well).
+    """
+    facts = HostFacts(c)
+    facts.gather(["nproc", "mem_total_mb", "innodb_buffer_pool_mb"])
+    return facts.sizing()
+
+
+def _clamp(value, lower, upper):
+    return max(lower, min(value, upper))
+
+
+def size_fpm_pool(
+    facts: dict, memcached_mb: int, opcache_mb: int, jit_buffer_mb=0, child_mb=96, innodb_buffer_pool_mb=None
+) -> du.EContainer:
+    """
+    Compute the pool settings from the host facts (see the module docstring for the model).
+    `innodb_buffer_pool_mb` is the planned buffer pool (default: the current value of the host).
+    The returned container has the attributes `pm`, `max_children`, `start_servers`, `min_spare_servers`,
+    `max_spare_servers`, `max_requests` and `reasoning` (list of strings).
+    """
+    total = facts["mem_total_mb"]
+    nproc = facts["nproc"]
+    os_reserve = max(512, total // 20)
+    if innodb_buffer_pool_mb is None:
+        innodb_buffer_pool_mb = facts["innodb_buffer_pool_mb"]
+    mariadb = max(innodb_buffer_pool_mb, 128) + 256
+    available = total - os_reserve - mariadb - memcached_mb - opcache_mb - jit_buffer_mb
+
+    mem_bound = max(available, 0) // child_mb
+    cpu_bound = 8 * nproc
+    max_children = max(2, min(mem_bound, cpu_bound))
+
+    pm = "ondemand" if total < 2048 else "dynamic"
+    min_spare = _clamp(nproc, 1, max(1, max_children // 4))
+    max_spare = _clamp(2 * nproc, min_spare + 1, max(min_spare + 1, max_children // 2))
+    start = min_spare + (max_spare - min_spare) // 2
+
+    reasoning = [
+        f"host: {nproc} cores, {total} MiB RAM",
+        f"reserved: os {os_reserve} + mariadb {mariadb} + cache {memcached_mb} + opcache {opcache_mb} "
+        f"+ jit {jit_buffer_mb} MiB -> {available} MiB available for php-fpm workers",
+        f"memory bound: {available} // {child_mb} MiB per worker = {mem_bound}, cpu bound: 8 * {nproc} = {cpu_bound}"
+        f" -> max_children = {max_children}",
+        f"pm = {pm} (threshold for dynamic: 2048 MiB RAM), "
+        f"spare servers {min_spare}..{max_spare}, start {start}, max_requests 500",
+    ]
+    if mem_bound < 2:
+        reasoning.append("WARNING: the host has not enough memory for this setup")
+
+    return du.EContainer(
+        pm=pm,
+        max_children=max_children,
+        start_servers=start,
+        min_spare_servers=min_spare,
+        max_spare_servers=max_spare,
+        max_requests=500,
+        reasoning=reasoning,
+    )
+
+
+def fpm_pool_replacements(sizing: du.EContainer) -> list:
+    """
+    Return the replacements for the default pool config (`pool.d/www.conf` of the Ubuntu package).
+    """
+    return [
+        ("\npm = dynamic\n", f"\npm = {sizing.pm}\n"),
+        ("max_children = 5\n", f"max_children = {sizing.max_children}\n"),
+        ("start_servers = 2\n", f"start_servers = {sizing.start_servers}\n"),
+        ("min_spare_servers = 1\n", f"min_spare_servers = {sizing.min_spare_servers}\n"),
+        ("max_spare_servers = 3\n", f"max_spare_servers = {sizing.max_spare_servers}\n"),
+        (";pm.max_requests = 500\n", f"pm.max_requests = {sizing.max_requests}\n"),
+    ]
+
+
+# hash table sizes used by opcache (zend_accelerator_hash.c); `max_accelerated_files` is rounded up to these
+OPCACHE_PRIMES = [
+    223, 463, 983, 1979, 3907, 7963, 16229, 32531, 65407, 130987, 262237, 524521, 1048793,
+]
+
+# used if the extracted release cannot be inspected (compile mode); approximately Nextcloud 32 incl. shipped apps
+NEXTCLOUD_PHP_ESTIMATE = {"n_files": 25000, "source_mb": 200}
+
+# optional: compile the core classes when php-fpm starts (`opcache.preload`); unlinkable classes are skipped by php
+PRELOAD_PHP = """<?php
+// generated by nextcloud_setup_tool (opcache.preload)
+foreach (['lib/public', 'lib/private'] as $dir) {
+    $it = new RecursiveIteratorIterator(new RecursiveDirectoryIterator('/var/www/nextcloud/' . $dir));
+    foreach ($it as $file) {
+        if ($file->getExtension() === 'php') {
+            @opcache_compile_file($file->getPathname());
+        }
+    }
+}
+"""
+
+
+def _round_up(value, step):
+    return -(-int(value) // step) * step
+
+
+def _next_power_of_2(value):
+    res = 1
+    while res < value:
+        res *= 2
+    return res
+
+
+def opcache_budget_mb(facts: dict) -> int:
+    return _clamp(facts["mem_total_mb"] // 8, 128, 1024)
+
+
+def cache_memory_mb(value, facts: dict, php_stats: dict = None) -> int:
+    """
+    Resolve the config value `memcached_memory` or `redis_memory` (MiB or "auto"). Without `php_stats` "auto" means the budget
+    (upper bound, see the module docstring).
+    """
+    if value != "auto":
+        return int(value)
+    budget = _clamp(facts["mem_total_mb"] // 16, 64, 1024)
+    if php_stats is None:
+        return budget
+    return _clamp(_round_up(php_stats["source_mb"], 64), 64, budget)
+
+
+def read_php_source_stats(c: du.StateConnection, root="/var/www/nextcloud") -> dict:
+    """
+    Return the number and total size of the PHP files below `root` (one remote command).
+    """
+    if getattr(c, "records_only", False):
+        c.assume(
+            f"php files below {root}: {NEXTCLOUD_PHP_ESTIMATE['n_files']} files, "
+            f"{NEXTCLOUD_PHP_ESTIMATE['source_mb']} MiB (opcache, APCu and memcached sizes)"
+        )
+        return dict(NEXTCLOUD_PHP_ESTIMATE)
+    cmd = f"find {root} -type f -name '*.php' -printf '%s\\n' | awk '{{n++; s+=$1}} END {{print n+0, s+0}}'"
+    res = c.run(cmd, hide=True, use_dir=False)
+    n_files, size = res.stdout.split()[:2]
+    return {"n_files": int(n_files), "source_mb": int(size) // 2**20}
+
+
+def size_caches(facts: dict, php_stats: dict, memcached_memory="auto") -> du.EContainer:
+    """
+    Compute opcache, APCu and memcached settings (see the module docstring for the model).
+    `memcached_memory` is the config value (MiB or "auto"; None: memcached is not used).
+    """
+    n_files = php_stats["n_files"]
+    target_files = int(n_files * 1.5)
+    max_files = next((p for p in OPCACHE_PRIMES if p >= target_files), OPCACHE_PRIMES[-1])
+    # php accepts at most 1000000 (and uses the next prime internally)
+    max_files = min(max_files, 1000000)
+
+    budget = opcache_budget_mb(facts)
+    opcache_mb = _clamp(_round_up(php_stats["source_mb"] * 1.5, 64), 128, budget)
+    interned_mb = _clamp(_next_power_of_2(n_files * 1.5 / 1000), 16, opcache_mb // 4)
+    apcu_mb = _clamp(_round_up(facts["mem_total_mb"] // 64, 32), 32, 256)
+    memcached_mb = None if memcached_memory is None else cache_memory_mb(memcached_memory, facts, php_stats)
+
+    reasoning = [
+        f"php files: {n_files} ({php_stats['source_mb']} MiB) -> max_accelerated_files = {max_files}",
+        f"opcache.memory_consumption = {opcache_mb} MiB (budget {budget} MiB), "
+        f"interned_strings_buffer = {interned_mb} MiB",
+        f"apc.shm_size = {apcu_mb} MiB ({facts['mem_total_mb']} MiB RAM)",
+    ]
+    if memcached_mb is not None:
+        reasoning.append(f"memcached memory = {memcached_mb} MiB ({memcached_memory})")
+    return du.EContainer(
+        max_accelerated_files=max_files,
+        memory_consumption=opcache_mb,
+        interned_strings_buffer=interned_mb,
+        apcu_shm_size=apcu_mb,
+        memcached_mb=memcached_mb,
+        reasoning=reasoning,
+    )
+
+
+def cache_ini(sizing: du.EContainer, preload_fpath: str = None) -> str:
+    """
+    Return the content of a php conf.d drop-in file with the cache settings.
+    """
+    lines = [
+        "; generated by nextcloud_setup_tool (see setup_lib/sizing.py)",
+        f"opcache.memory_consumption={sizing.memory_consumption}",
+        f"opcache.interned_strings_buffer={sizing.interned_strings_buffer}",
+        f"opcache.max_accelerated_files={sizing.max_accelerated_files}",
+        f"apc.shm_size={sizing.apcu_shm_size}M",
+    ]
+    if preload_fpath is not None:
+        lines.extend([f"opcache.preload={preload_fpath}", "opcache.preload_user=www-data"])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,141 @@
+"""
+Fingerprint-based step cache: steps whose rendered operations and config values did not change since their last
+successful run on a host are skipped.
+"""
+
+import json
+import hashlib
+import threading
+
+import deploymentutils as du
+
+from . import REMOTE_STATE_DIR
+from .bundle import BundleRecorder
+
+
+class TrackingConfig:
+    """
+    Wrapper around a deploymentutils config object which remembers which keys have been read (and their values).
+    The record is kept per thread because steps may run concurrently (see setup_lib/scheduler.py).
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._local = threading.local()
+
+    @property
+    def accessed(self) -> dict:
+        if not hasattr(self._local, "accessed"):
+            self._local.accessed = {}
+        return self._local.accessed
+
+    @accessed.setter
+    def accessed(self, value: dict):
+        self._local.accessed = value
+
+    def __call__(self, key, *args, **kwargs):
+        value = self._config(key, *args, **kwargs)
+        self.accessed[key] = value
+        return value
+
+    def get(self, key, *args, **kwargs):
+        return self(key, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._config, name)
+
+
+class StepCache:
+    """
+    Run step functions only if their fingerprint differs from the one stored on the remote host.
+
+    The fingerprint of a step is computed from its rendered operations (commands, file contents, uploaded files),
+    from the config values it reads and from the host facts the operations are derived from (`facts`, e.g. the
+    sizing facts; values which a recorder cannot read are estimated and thus not covered). To obtain the operations,
+    the step function is first called with a `BundleRecorder` (i.e. nothing is executed remotely; a step which runs
+    is thus called twice). The recorder has `fingerprint_only = True`: steps must skip their local side effects
+    (downloads etc.) then, otherwise they are paid before the skip decision.
+    """
+
+    def __init__(self, c: du.StateConnection, config: TrackingConfig = None, remote_dir=None, facts: dict = None):
+        self.c = c
+        self.config = config
+        self.facts = facts
+        self.remote_dir = remote_dir or f"{REMOTE_STATE_DIR}/steps"
+        self._done = None
+        self._lock = threading.Lock()
+
+    @property
+    def done(self) -> dict:
+        """
+        Mapping step name -> fingerprint of all completed steps (loaded with one remote command).
+        """
+        with self._lock:
+            if self._done is None:
+                self._load()
+        return self._done
+
+    def _load(self):
+        res = self.c.run(
+            f"mkdir -p {self.remote_dir} && cd {self.remote_dir} && grep -H . * 2>/dev/null || true",
+            hide=True,
+            use_dir=False,
+        )
+        self._done = {}
+        for line in res.stdout.splitlines():
+            name, _, fingerprint = line.partition(":")
+            self._done[name] = fingerprint.strip()
+
+    def fingerprint(self, step_func, *args, **kwargs) -> str:
+        if self.config is not None:
+            self.config.accessed = {}
+        recorder = BundleRecorder(self.c.remote, self.c.user)
+        recorder.fingerprint_only = True
+        recorder.record(step_func, *args, **kwargs)
+        _, lines = recorder.steps[0]
+
+        h = hashlib.sha256()
+        h.update(step_func.__name__.encode("utf8"))
+        for line in lines:
+            h.update(line.encode("utf8"))
+        if self.config is not None:
+            h.update(json.dumps(self.config.accessed, sort_keys=True, default=str).encode("utf8"))
+        if self.facts is not None:
+            h.update(json.dumps(self.facts, sort_keys=True, default=str).encode("utf8"))
+        return h.hexdigest()
+
+    def run_step(self, step_func, *args, force=False, connection=None, **kwargs):
+        """
+        Execute `step_func(c, *args, **kwargs)` unless an identical version was already completed on the host.
+
+        :param force:       run the step even if its fingerprint is unchanged
+        :param connection:  connection to use instead of `self.c` (e.g. a forked connection of the scheduler)
+        """
+        c = connection or self.c
+        name = step_func.__name__
+        fingerprint = self.fingerprint(step_func, *args, **kwargs)
+
+        if not force and self.done.get(name) == fingerprint:
+            print(du.bgreen(f"✓ {name}: unchanged since last run (fingerprint {fingerprint[:12]}), skipping"))
+            return None
+
+        print(du.bright(f"▶ {name} (fingerprint {fingerprint[:12]})"))
+        res = step_func(c, *args, **kwargs)
+
+        # only reached if the step did not raise an exception
+        c.run(f"echo {fingerprint} > {self.remote_dir}/{name}", hide=True, use_dir=False)
+        self.done[name] = fingerprint
+        return res
+
+    def invalidate(self, *step_names):
+        """
+        Forget the fingerprints of the given steps (all steps if no name is given) -> they will run again.
+        """
+        if not step_names:
+            self.c.run(f"rm -f {self.remote_dir}/*", use_dir=False)
+            self._done = {}
+            return
+        paths = " ".join(f"{self.remote_dir}/{name}" for name in step_names)
+        self.c.run(f"rm -f {paths}", use_dir=False)
+        for name in step_names:
+            self.done.pop(name, None)
@@ -0,0 +1,322 @@
+"""
+Timing of all connection operations (`run`, `string_to_file`, `multi_edit_file`, `rsync_upload`, ...), tagged with
+the enclosing step function, and export as Chrome trace (open it with chrome://tracing or https://ui.perfetto.dev).
+
+usage (from the root directory of this repo):
+
+    python -m setup_lib.tracing summary traces/<trace>.json
+    python -m setup_lib.tracing compare traces/<old>.json traces/<new>.json
+
+The step of an operation is the outermost function of the deployment script (`__main__`) on the call stack, unless
+it is set explicitly with `tracer.step(name)`.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import argparse
+import threading
+import contextlib
+
+import deploymentutils as du
+
+
+TRACE_DIR = "traces"
+
+TRACED_METHODS = (
+    "run", "string_to_file", "multi_edit_file", "edit_file", "rsync_upload", "rsync_download", "pipe_file",
+)
+
+# operations which take less time are not reported by `compare`
+MIN_DELTA_S = 1.0
+
+
+class Tracer:
+    """
+    Collects one event per connection operation (thread safe, steps may run concurrently).
+
+    :param redact:  strings (e.g. passwords from the config) which are replaced by "***" in the recorded commands
+    """
+
+    def __init__(self, redact=(), max_detail_len=200):
+        self.t0 = time.time()
+        self.redact = [value for value in redact if value]
+        self.max_detail_len = max_detail_len
+        self.events = []
+        self.thread_names = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def step(self, name: str):
+        previous = getattr(self._local, "step", None)
+        self._local.step = name
+        try:
+            yield
+        finally:
+            self._local.step = previous
+
+    def current_step(self) -> str:
+        explicit = getattr(self._local, "step", None)
+        if explicit is not None:
+            return explicit
+        step = "<module>"
+        frame = sys._getframe(1)
+        while frame is not None:
+            name = frame.f_code.co_name
+            if frame.f_globals.get("__name__") == "__main__" and not name.startswith("<"):
+                # keep searching: helper functions are called by the step function
+                step = name
+            frame = frame.f_back
+        return step
+
+    def _clean(self, detail: str) -> str:
+        for value in self.redact:
+            detail = detail.replace(value, "***")
+        detail = " ".join(detail.split())
+        if len(detail) > self.max_detail_len:
+            detail = f"{detail[:self.max_detail_len]}…"
+        return detail
+
+    def record(self, op: str, detail: str, t_start: float, t_end: float, ok=True):
+        thread = threading.current_thread()
+        event = {
+            "op": op,
+            "detail": self._clean(detail),
+            "step": self.current_step(),
+            "start": t_start - self.t0,
+            "duration": t_end - t_start,
+            "ok": ok,
+            "tid": thread.ident,
+        }
+        with self._lock:
+            self.thread_names.setdefault(thread.ident, thread.name)
+            self.events.append(event)
+
+    # ------------------------------------------------------------------------------------------------
+
+    def step_spans(self) -> dict:
+        """
+        Return {step: (start, end)} (from the first to the last operation of each step).
+        """
+        spans = {}
+        for event in self.events:
+            start, end = spans.get(event["step"], (event["start"], event["start"] + event["duration"]))
+            spans[event["step"]] = (min(start, event["start"]), max(end, event["start"] + event["duration"]))
+        return spans
+
+    def to_chrome_trace(self, metadata: dict = None) -> dict:
+        tids = {tid: i + 1 for i, tid in enumerate(self.thread_names)}
+        trace_events = [
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": "steps"}},
+            *(
+                {"name": "thread_name", "ph": "M", "pid": 1, "tid": tids[tid], "args": {"name": name}}
+                for tid, name in self.thread_names.items()
+            ),
+        ]
+        for step, (start, end) in self.step_spans().items():
+            trace_events.append({
+                "name": step, "cat": "step", "ph": "X", "pid": 1, "tid": 0,
+                "ts": int(start * 1e6), "dur": int((end - start) * 1e6),
+            })
+        for event in self.events:
+            trace_events.append({
+                "name": f"{event['op']}: {event['detail'][:60]}",
+                "cat": event["op"],
+                "ph": "X",
+                "pid": 1,
+                "tid": tids[event["tid"]],
+                "ts": int(event["start"] * 1e6),
+                "dur": int(event["duration"] * 1e6),
+                "args": {"step": event["step"], "detail": event["detail"], "ok": event["ok"]},
+            })
+        start_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.t0))
+        return {
+            "traceEvents": trace_events,
+            "displayTimeUnit": "ms",
+            "otherData": {"start_time": start_time, **(metadata or {})},
+        }
+
+    def write(self, fpath: str, metadata: dict = None):
+        os.makedirs(os.path.dirname(fpath) or ".", exist_ok=True)
+        with open(fpath, "w") as fp:
+            json.dump(self.to_chrome_trace(metadata), fp, indent=1)
+
+    def summary(self, top=15) -> str:
+        return summary(events_from_chrome_trace(self.to_chrome_trace()), top=top)
+
+
+def _describe(method_name: str, args: tuple, kwargs: dict) -> str:
+    if method_name in ("rsync_upload", "rsync_download"):
+        source = args[0] if args else kwargs.get("source", "")
+        dest = args[1] if len(args) > 1 else kwargs.get("dest", "")
+        return f"{source} -> {dest}"
+    if method_name in ("string_to_file",):
+        return str(args[1] if len(args) > 1 else kwargs.get("fpath", ""))
+    if args:
+        cmd = args[0]
+        return " ".join(cmd) if isinstance(cmd, list) else str(cmd)
+    return str(next(iter(kwargs.values()), ""))
+
+
+def _traced_method(method_name: str, method):
+    def traced_method(self, *args, **kwargs):
+        tracer = self.tracer
+        # operations which are implemented with other operations (e.g. string_to_file -> run) count once
+        depth = getattr(tracer._local, "depth", 0)
+        if depth > 0:
+            return method(self, *args, **kwargs)
+        tracer._local.depth = 1
+        t_start = time.time()
+        ok = False
+        try:
+            res = method(self, *args, **kwargs)
+            ok = getattr(res, "exited", 0) in (0, None)
+            return res
+        finally:
+            tracer._local.depth = 0
+            tracer.record(method_name, _describe(method_name, args, kwargs), t_start, time.time(), ok)
+
+    traced_method.__name__ = method_name
+    traced_method.__doc__ = method.__doc__
+    return traced_method
+
+
+_traced_classes = {}
+
+
+def traced_class(cls):
+    """
+    Return a subclass of `cls` (created once) which times all methods of `TRACED_METHODS`.
+    """
+    if cls not in _traced_classes:
+        namespace = {
+            name: _traced_method(name, getattr(cls, name)) for name in TRACED_METHODS if hasattr(cls, name)
+        }
+        _traced_classes[cls] = type(f"Traced{cls.__name__}", (cls,), namespace)
+    return _traced_classes[cls]
+
+
+def install(c: du.StateConnection, redact=(), trace_dir=TRACE_DIR) -> Tracer:
+    """
+    Trace all operations of `c` (and of its copies, see setup_lib/scheduler.py). At exit, the trace is written to
+    `trace_dir` and the summary is printed.
+    """
+    tracer = Tracer(redact=redact)
+    c.tracer = tracer
+    c.__class__ = traced_class(type(c))
+
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    fname = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(tracer.t0))}-{c.remote}-{script}.json"
+    fpath = os.path.join(trace_dir, fname)
+
+    def finish():
+        if not tracer.events:
+            return
+        tracer.write(fpath, metadata={"host": c.remote, "script": script})
+        print(tracer.summary())
+        print(du.dim(f"trace written to {fpath}"))
+
+    atexit.register(finish)
+    return tracer
+
+
+# ------------------------------------------------------------------------------------------------
+# evaluation of stored traces
+
+
+def events_from_chrome_trace(trace: dict) -> list:
+    return [
+        {
+            "op": event["cat"],
+            "detail": event["args"]["detail"],
+            "step": event["args"]["step"],
+            "duration": event["dur"] / 1e6,
+        }
+        for event in trace["traceEvents"]
+        if event["ph"] == "X" and event.get("cat") != "step"
+    ]
+
+
+def load_events(fpath: str) -> list:
+    with open(fpath) as fp:
+        return events_from_chrome_trace(json.load(fp))
+
+
+def step_totals(events: list) -> dict:
+    totals = {}
+    for event in events:
+        totals[event["step"]] = totals.get(event["step"], 0.0) + event["duration"]
+    return totals
+
+
+def summary(events: list, top=15) -> str:
+    lines = ["time per step (sum of its operations):"]
+    for step, total in sorted(step_totals(events).items(), key=lambda item: -item[1]):
+        n_ops = sum(event["step"] == step for event in events)
+        lines.append(f"  {total:8.1f}s  {step} ({n_ops} operations)")
+    lines.append(f"top {top} slowest operations:")
+    for event in sorted(events, key=lambda event: -event["duration"])[:top]:
+        lines.append(f"  {event['duration']:8.1f}s  {event['step']:<24} {event['op']:<16} {event['detail'][:70]}")
+    return "\n".join(lines)
+
+
+def compare(old_events: list, new_events: list, min_delta_s=MIN_DELTA_S) -> str:
+    """
+    Report steps and operations whose duration changed by more than `min_delta_s` (operations are matched by
+    step, type and command; repeated commands are summed up).
+    """
+
+    def op_totals(events):
+        totals = {}
+        for event in events:
+            key = (event["step"], event["op"], event["detail"])
+            totals[key] = totals.get(key, 0.0) + event["duration"]
+        return totals
+
+    lines = ["steps:"]
+    old_steps, new_steps = step_totals(old_events), step_totals(new_events)
+    steps = sorted(set(old_steps) | set(new_steps), key=lambda s: -abs(new_steps.get(s, 0) - old_steps.get(s, 0)))
+    for step in steps:
+        old, new = old_steps.get(step, 0.0), new_steps.get(step, 0.0)
+        lines.append(f"  {old:8.1f}s -> {new:8.1f}s  ({new - old:+7.1f}s)  {step}")
+
+    old_ops, new_ops = op_totals(old_events), op_totals(new_events)
+    changed = [
+        (key, old_ops.get(key, 0.0), new_ops.get(key, 0.0))
+        for key in set(old_ops) | set(new_ops)
+        if abs(new_ops.get(key, 0.0) - old_ops.get(key, 0.0)) >= min_delta_s
+    ]
+    lines.append(f"operations with a difference of at least {min_delta_s:.1f}s:")
+    for (step, op, detail), old, new in sorted(changed, key=lambda item: item[1] - item[2]):
+        marker = du.bred("slower") if new > old else du.bgreen("faster")
+        lines.append(f"  {old:8.1f}s -> {new:8.1f}s  {marker}  {step:<24} {op:<16} {detail[:60]}")
+    if not changed:
+        lines.append("  (none)")
+    total_old, total_new = sum(old_steps.values()), sum(new_steps.values())
+    lines.append(f"total: {total_old:.1f}s -> {total_new:.1f}s ({total_new - total_old:+.1f}s)")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="evaluate traces of deployment runs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="time per step and the slowest operations")
+    summary_parser.add_argument("trace")
+    summary_parser.add_argument("--top", type=int, default=15)
+    compare_parser = subparsers.add_parser("compare", help="differences between two runs")
+    compare_parser.add_argument("old_trace")
+    compare_parser.add_argument("new_trace")
+    compare_parser.add_argument("--min-delta", type=float, default=MIN_DELTA_S, help="threshold in seconds")
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        print(summary(load_events(args.trace), top=args.top))
+    else:
+        print(compare(load_events(args.old_trace), load_events(args.new_trace), min_delta_s=args.min_delta))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Readiness waits for kubernetes resources based on `kubectl wait` (the api server notifies kubectl, no polling
+via ssh). All waits of one call run in one remote command and share a total deadline.
+"""
+
+import time
+import shlex
+
+import deploymentutils as du
+
+
+class WaitSpec:
+    """
+    :param resource:    e.g. "deployment/mattermost" or "certificate/mattermost-tls"
+    :param condition:   value of `kubectl wait --for=...`, e.g. "condition=Available" or "jsonpath={.status.x}"
+    :param namespace:   None for cluster scoped resources
+    """
+
+    def __init__(self, resource: str, condition: str, namespace: str = None):
+        self.resource = resource
+        self.condition = condition
+        self.namespace = namespace
+
+    def __repr__(self):
+        return f"<WaitSpec {self.resource} ({self.condition})>"
+
+
+def wait_script(specs: list, deadline_s: int) -> str:
+    """
+    Return a bash script which waits for the resources one after another (until the common deadline).
+    For each resource, "nst_ready <resource> <milliseconds since start>" is printed.
+    """
+    lines = [
+        f"nst_deadline=$(( $(date +%s) + {deadline_s} ))",
+        "nst_t0=$(date +%s%N)",
+        "nst_remaining() { r=$(( nst_deadline - $(date +%s) )); [ $r -gt 0 ] && echo $r || echo 0; }",
+    ]
+    for spec in specs:
+        ns = f" -n {spec.namespace}" if spec.namespace else ""
+        resource = shlex.quote(spec.resource)
+        condition = shlex.quote(f"--for={spec.condition}")
+        lines.extend([
+            # the resource might not exist yet (e.g. a certificate created by cert-manager): `--for=create`
+            # (kubectl >= 1.31) with a fallback for older versions and not yet registered resource types
+            f"kubectl wait --for=create {resource}{ns} --timeout=$(nst_remaining)s >/dev/null 2>&1 || "
+            f"until kubectl get {resource}{ns} >/dev/null 2>&1; do "
+            f"[ $(nst_remaining) -gt 0 ] || {{ echo 'timeout: {spec.resource} does not exist' >&2; exit 1; }}; "
+            "sleep 1; done",
+            f"kubectl wait {condition} {resource}{ns} --timeout=$(nst_remaining)s >/dev/null || "
+            f"{{ echo 'timeout: {spec.resource} ({spec.condition})' >&2; exit 1; }}",
+            f'echo "nst_ready {spec.resource} $(( ($(date +%s%N) - nst_t0) / 1000000 ))"',
+        ])
+    return "\n".join(lines)
+
+
+def wait_ready(c: du.StateConnection, specs: list, deadline_s: int = 600, required=True) -> dict:
+    """
+    Wait until all resources fulfill their condition (total deadline `deadline_s`) and print the time to ready.
+
+    :param required:    raise ValueError if a resource is not ready in time (False: only report it)
+    :return:            dict {resource: seconds until ready} (empty if nothing was executed, e.g. in a bundle)
+    """
+    t0 = time.time()
+    records_only = getattr(c, "records_only", False)
+    # live: the missing "nst_ready" lines are evaluated below; bundle: a required wait aborts the bundle
+    warn = "smart" if records_only and required else True
+    res = c.run(f"bash -c {shlex.quote(wait_script(specs, deadline_s))}", hide=True, warn=warn, use_dir=False)
+
+    ready = {}
+    for line in res.stdout.splitlines():
+        if line.startswith("nst_ready "):
+            _, resource, ms = line.split()
+            ready[resource] = int(ms) / 1000
+    if records_only:
+        return ready
+
+    for spec in specs:
+        if spec.resource in ready:
+            print(du.bgreen(f"✓ {spec.resource} ready after {ready[spec.resource]:.1f}s"))
+        else:
+            print(du.bred(f"✗ {spec.resource} not ready ({spec.condition})"))
+    print(du.dim(f"waited {time.time() - t0:.1f}s in total (deadline {deadline_s}s)"))
+
+    not_ready = [spec for spec in specs if spec.resource not in ready]
+    if not_ready and required:
+        msg = f"not ready within {deadline_s}s: {', '.join(map(repr, not_ready))}"
+        raise ValueError(msg)
+    return ready
@@ -0,0 +1,65 @@
+"""
+Record the remote operations against a fake connection (local bash instead of ssh) and replay them.
+"""
+
+import os
+import stat
+import tempfile
+
+from setup_lib import cassette
+
+
+SECRET = "s3cret-pw"
+
+
+class FakeTransport:
+    # no ssh master; the remote commands run in a local shell
+    def _open_master(self, remote, user):
+        self.handshake_time = 0.0
+
+    def ssh_command(self, *remote_args) -> list:
+        return ["bash", "-c", *remote_args]
+
+
+class FakeRecordingConnection(FakeTransport, cassette.RecordingConnection):
+    pass
+
+
+def deployment_steps(c):
+    # the upload path differs in every run (like EditBatch and the artifact uploads)
+    with tempfile.NamedTemporaryFile(suffix=".tar.gz") as fp:
+        upload_fpath = fp.name
+    c.run(f"echo {SECRET} > /dev/null && echo db created", hide=True)
+    c.run(f"test -e {upload_fpath} || echo missing", hide=True)
+    c.run(f"echo /tmp/nst-edits-{os.getpid()}", hide=True)
+    return c.run("echo 42", hide=True).stdout.strip()
+
+
+def test_record_and_replay(tmp_path, monkeypatch):
+    # deploymentutils stores its result shelf in the cwd
+    monkeypatch.chdir(tmp_path)
+    fpath = str(tmp_path / "test.cassette.jsonl")
+
+    recording = FakeRecordingConnection("host", "user", cassette_fpath=fpath, redact=[SECRET])
+    assert deployment_steps(recording) == "42"
+
+    assert stat.S_IMODE(os.stat(fpath).st_mode) == 0o600
+    with open(fpath) as fp:
+        assert SECRET not in fp.read()
+
+    # another process (-> other temporary paths) replays the unchanged steps
+    monkeypatch.setattr(os, "getpid", lambda: 1)
+    replay = cassette.ReplayConnection("host", "user", cassette_fpath=fpath, strict=True, redact=[SECRET])
+    assert deployment_steps(replay) == "42"
+    assert replay.diff() == []
+
+
+def test_changed_command_is_reported(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fpath = str(tmp_path / "test.cassette.jsonl")
+    recording = FakeRecordingConnection("host", "user", cassette_fpath=fpath)
+    recording.run("echo 1", hide=True)
+
+    replay = cassette.ReplayConnection("host", "user", cassette_fpath=fpath)
+    replay.run("echo 2", hide=True)
+    assert replay.diff() == [("run", "echo 1", "echo 2")]
@@ -6,8 +6,8 @@ https://claude.ai/public/artifacts/231822ef-fd8b-49e5-9c7c-ef4b8f848535?fullscre
 
 import time
 import os
+import shutil
 import sys
-import os
 from os.path import join as pjoin
 from textwrap import dedent
 
@@ -27,18 +27,37 @@ try:
 except ImportError as err:
     print("You need to install the package `deploymentutils` to run this script.")
 
-
-# call this before running the script:
+from setup_lib.bundle import BundleRecorder
+from setup_lib import fleet
+from setup_lib import tracing
+from setup_lib import cassette
+from setup_lib import preflight
+from setup_lib.packages import PackagePlan
+from setup_lib.facts import HostFacts
+from setup_lib.postgres import (
+    pgtune, postgresql_conf, postgres_configmap_yaml, pgbouncer_yaml, datasource, config_hash, PGBOUNCER_IMAGE,
+)
+from setup_lib.waiting import WaitSpec, wait_ready
+from setup_lib.manifests import ManifestSet
+from setup_lib.artifacts import ArtifactCache
+from setup_lib.airgap import AirgapBundle, HELM_VERSION
+from setup_lib.k8s_sizing import (
+    read_node_allocatable, size_components, helm_resource_args, hpa_yaml, sql_pool_settings,
+)
+
+
+# call this before running the script (all ssh traffic is multiplexed over one master connection):
 # eval $(ssh-agent); ssh-add -t 10m
 
 
-# simplify debugging
-activate_ips_on_exception()
+# simplify debugging (not in fleet mode where the script runs without terminal)
+if not fleet.is_fleet_worker():
+    activate_ips_on_exception()
 
 
 # -------------------------- Essential Config section  ------------------------
 
-config = du.get_nearest_config("config.toml")
+config = du.get_nearest_config(fleet.config_fpath("config.toml"))
 
 remote = config("remote")
 user = config("user")
@@ -48,21 +67,48 @@ user = config("user")
 
 PHP_VERSION = "8.3"
 
+POSTGRES_IMAGE = "postgres:15-alpine"
+MATTERMOST_IMAGE = "mattermost/mattermost-team-edition:latest"
+
 # this is the root dir of the project (where setup.py lies)
 # if you maintain more than one instance (and deploy.py lives outside the project dir, this has to change)
 project_src_path = os.path.dirname(du.get_dir_of_this_file())
 
-temp_workdir = pjoin(du.get_dir_of_this_file(), "tmp_workdir")  # this will be deleted/overwritten
+# this will be deleted/overwritten (fleet mode: one per host)
+temp_workdir = pjoin(fleet.host_dir(du.get_dir_of_this_file()), "tmp_workdir")
 
 # ensure clean workdir
-os.system(f"rm -rf {temp_workdir}")
+shutil.rmtree(temp_workdir, ignore_errors=True)
 os.makedirs(temp_workdir)
 
-c = du.StateConnection(remote, user=user, target="remote", parse_args=True)
+du.argparser.add_argument(
+    "--compile", metavar="FPATH", help="record all steps into one shell script (bundle), upload and run it"
+)
+du.argparser.add_argument("--plan-only", action="store_true", help="together with --compile: only write the bundle")
+
+args = du.parse_args()
+
+# config secrets are not stored in the cassette and in the trace
+secrets = [config("mattermost::psql_password")]
 
-c.run(f"echo hello new vm with os:")
-# get name of Linux distribution
-res = c.run(f"lsb_release -a")
+if args.compile and args.plan_only:
+    # only write the bundle: no connection to the host and no remote fact gathering
+    c = None
+    bundle = BundleRecorder(remote, user)
+    facts = HostFacts(bundle)
+else:
+    # NST_CASSETTE_MODE=record|replay: record the remote operations or replay them offline (see setup_lib/cassette.py)
+    c = cassette.open_connection(remote, user=user, target="remote", parse_args=True, redact=secrets)
+    # time every operation (per step); the trace is written to traces/ at exit (see setup_lib/tracing.py)
+    tracing.install(c, redact=secrets)
+
+    # os, cores, memory, installed packages, k3s/helm state etc. (one remote command, see setup_lib/facts.py)
+    facts = HostFacts(c)
+    print(f"host: {facts['os']} ({facts['arch']}), {facts['nproc']} cores, {facts['mem_total_mb']} MiB RAM")
+
+# results of the pre-flight disk, cpu and memory tests (set before the installation, see setup_lib/preflight.py);
+# empty in compile mode (a bundle does not depend on the host it was compiled for)
+preflight_results = {}
 
 
 # ssh key handling:
@@ -74,7 +120,11 @@ res = c.run(f"lsb_release -a")
 # f"ssh-keyscan {config("remote")} >> ~/.ssh/known_hosts"
 # f"ssh-keyscan -t ed25519 {config("remote")} >> ~/.ssh/known_hosts"
 
+# the steps declare their apt packages; they are installed together in one transaction
+package_plan = PackagePlan()
 
+
+@package_plan.requires("tmux rsync mc")
 def install_starship_tmux_mc(c: du.StateConnection):
     """
     Install some tools which are not strictly necessary, but significantly simplify interactive debugging
@@ -83,8 +133,7 @@ def install_starship_tmux_mc(c: du.StateConnection):
     c.run(f"mkdir -p ~/bin")
     c.chdir("~/tmp")
 
-    if not c.check_existence("install_starship.sh"):
-        c.run(f"curl  https://starship.rs/install.sh > install_starship.sh")
+    c.run(f"test -e install_starship.sh || curl  https://starship.rs/install.sh > install_starship.sh")
     c.run(f"sh install_starship.sh --bin-dir ~/bin --yes")
 
 
@@ -107,21 +156,21 @@ def install_starship_tmux_mc(c: du.StateConnection):
 
     c.string_to_file(bashrc_content, "~/.bashrc", mode=">>")
 
-    c.run(f"sudo apt update && sudo apt upgrade -y")
-    c.run(f"apt install --assume-yes tmux rsync")
+    # one `apt-get update` for upgrade and installation of all planned packages
+    package_plan.apply(c, upgrade=True)
 
     # midnight commander with lynx like motion
-    c.run(f"apt install --assume-yes mc")
     c.run(f"mkdir -p ~/.config/mc")
     # trailing slash at source is important
     c.rsync_upload("config_files/mc/", "~/.config/mc", "remote")
 
+@package_plan.requires("curl wget git apt-transport-https ca-certificates ufw")
 def install_mattermost_with_helm(c: du.StateConnection):
 
     # ensure that we have left possible subdirectories
     c.dir = None
-    c.run("sudo apt update && sudo apt upgrade -y")
-    c.run("sudo apt install -y curl wget git apt-transport-https ca-certificates ufw")
+    # no-op (no remote command) if install_starship_tmux_mc already installed all planned packages
+    package_plan.apply(c, facts=facts)
 
     # firewall
     c.run("sudo ufw allow 22/tcp")  # ssh
@@ -137,14 +186,45 @@ def install_mattermost_with_helm(c: du.StateConnection):
     c.run("sudo swapoff -a")
     c.run("sudo sed -i '/ swap / s/^/#/' /etc/fstab")
 
-    c.run("""curl -sfL https://get.k3s.io | sh -s - \\
-        --write-kubeconfig-mode 644 \\
-        --disable traefik""")
+    # airgap mode: k3s, helm, charts and all images come from the local artifact cache (see setup_lib/airgap.py)
+    airgap = None
+    if config("mattermost::airgap", ignore_undefined=True, default=False):
+        images = [POSTGRES_IMAGE, MATTERMOST_IMAGE]
+        if config("mattermost::pgbouncer", ignore_undefined=True, default=False):
+            images.append(PGBOUNCER_IMAGE)
+        airgap = AirgapBundle(ArtifactCache(), images=images)
+        # the images must be in place before k3s starts (they are imported at startup)
+        airgap.push(c)
+        airgap.install_k3s(c, "--write-kubeconfig-mode 644 --disable traefik")
+    else:
+        c.run("""curl -sfL https://get.k3s.io | sh -s - \\
+            --write-kubeconfig-mode 644 \\
+            --disable traefik""")
 
     # verify installation
     c.run("sudo systemctl status k3s")
     c.run("kubectl get nodes")
 
+    # requests and limits of all components derived from the allocatable capacity (see setup_lib/k8s_sizing.py)
+    # (`mattermost::node_allocatable` replaces the query, e.g. for compile mode)
+    allocatable = config("mattermost::node_allocatable", ignore_undefined=True, default=None)
+    node_sizing = size_components(
+        read_node_allocatable(c, allocatable),
+        shares=config("mattermost::resource_shares", ignore_undefined=True, default=None),
+    )
+    if not getattr(c, "records_only", False):
+        print(du.dim("\n".join(node_sizing.reasoning)))
+    mm_res = node_sizing.components["mattermost"]
+    pg_res = node_sizing.components["postgres"]
+
+    # optional: HorizontalPodAutoscaler for mattermost
+    hpa_max_replicas = config("mattermost::hpa_max_replicas", ignore_undefined=True, default=1)
+    if hpa_max_replicas > 1:
+        print(du.yellow(
+            "Warning: the Team Edition does not support high availability (clustering requires an Enterprise "
+            "license); with several replicas, websocket events only reach the clients of the same pod."
+        ))
+
     # Set Up kubectl for Your User
     c.run("mkdir -p ~/.kube")
     c.run("sudo cp /etc/rancher/k3s/k3s.yaml ~/.kube/config")
@@ -153,49 +233,56 @@ def install_mattermost_with_helm(c: du.StateConnection):
     c.set_env("KUBECONFIG", "~/.kube/config")
     c.run("echo 'export KUBECONFIG=~/.kube/config' >> ~/.bashrc")
 
-    # install helm
-    c.run("curl https://raw.githubusercontent.com/helm/helm/main/scripts/get-helm-3 | bash")
+    # install helm (skipped if the host already has it; a bundle does not rely on the facts of compile time)
+    helm_installed = bool(facts["helm_version"]) and not getattr(c, "records_only", False)
+    if airgap:
+        if not helm_installed or not facts["helm_version"].startswith(HELM_VERSION):
+            airgap.install_helm(c)
+        ingress_nginx_chart = airgap.chart("ingress-nginx")
+        cert_manager_chart = airgap.chart("cert-manager")
+    else:
+        if not helm_installed:
+            c.run("curl https://raw.githubusercontent.com/helm/helm/main/scripts/get-helm-3 | bash")
+        # both repos with one `helm repo update`
+        c.run("helm repo add ingress-nginx https://kubernetes.github.io/ingress-nginx")
+        c.run("helm repo add jetstack https://charts.jetstack.io")
+        c.run("helm repo update")
+        ingress_nginx_chart = "ingress-nginx/ingress-nginx"
+        cert_manager_chart = "jetstack/cert-manager"
     c.run("helm version")
+    facts.invalidate("helm_version")
 
     # Install NGINX Ingress Controller
-    c.run("helm repo add ingress-nginx https://kubernetes.github.io/ingress-nginx")
-    c.run("helm repo update")
-
     # Verify kubectl configuration before running helm (NEW!!)
     c.run("echo 'Current KUBECONFIG:' && echo $KUBECONFIG")
     c.run("kubectl config current-context")
     c.run("kubectl cluster-info")
 
-    # Check if ingress-nginx is already installed
-    helm_check = c.run("helm list -n ingress-nginx", warn=True, hide=True)
-    if "ingress-nginx" in helm_check.stdout:
-        print("ingress-nginx already installed, skipping installation")
-    else:
-        c.run(
-            "helm install ingress-nginx ingress-nginx/ingress-nginx "
-            "--namespace ingress-nginx "
-            "--create-namespace "
-            "--set controller.service.type=LoadBalancer"
-        )
+    # `upgrade --install` is idempotent (no need to check whether ingress-nginx is already installed)
+    c.run(
+        f"helm upgrade --install ingress-nginx {ingress_nginx_chart} "
+        "--namespace ingress-nginx "
+        "--create-namespace "
+        "--set controller.service.type=LoadBalancer "
+        f"{helm_resource_args(node_sizing.components['ingress-nginx'])}"
+    )
 
     c.run("kubectl get pods -n ingress-nginx")
     c.run("kubectl get svc -n ingress-nginx")
 
     # Install cert-manager (For HTTPS)
-    c.run("helm repo add jetstack https://charts.jetstack.io")
-    c.run("helm repo update")
-
-    # Check if cert-manager is already installed
-    cert_manager_check = c.run("helm list -n cert-manager", warn=True, hide=True)
-    if "cert-manager" in cert_manager_check.stdout:
-        print("cert-manager already installed, skipping installation")
-    else:
-        c.run(
-            "helm install cert-manager jetstack/cert-manager "
-            "--namespace cert-manager "
-            "--create-namespace "
-            "--set crds.enabled=true"
-        )
+    c.run(
+        f"helm upgrade --install cert-manager {cert_manager_chart} "
+        "--namespace cert-manager "
+        "--create-namespace "
+        "--set crds.enabled=true"
+    )
+
+    # the webhook must be available before cert-manager resources (ClusterIssuer) can be applied
+    wait_ready(c, [
+        WaitSpec(f"deployment/{name}", "condition=Available", namespace="cert-manager")
+        for name in ("cert-manager", "cert-manager-webhook", "cert-manager-cainjector")
+    ], deadline_s=300)
 
     # Check if certificate backup exists locally and restore if available
     backup_dir = "./lets_encrypt_backup"
@@ -209,17 +296,18 @@ def install_mattermost_with_helm(c: du.StateConnection):
 
         # Restore certificates on remote machine (3 steps)
 
-        # Apply the cluster issuer first (tells cert-manager how to communicate with Let's Encrypt)
+        # Apply the account secret first
+        # (Restores the Let's Encrypt account private key)
+        # Critical for avoiding rate limits - if the issuer is created without it, cert-manager registers a
+        # new account (while the issuer becomes ready) and potentially hits duplicate certificate limits
+        c.run(f"kubectl apply -f ~/{backup_dir}/letsencrypt-prod-secret.yaml")
+
+        # Apply the cluster issuer (tells cert-manager how to communicate with Let's Encrypt)
         # Contains the ACME server URL, your email, and challenge solver configuration
         # Does NOT trigger new certificate requests - it just sets up the issuer for future use
+        # (it becomes ready with the restored account)
         c.run(f"kubectl apply -f ~/{backup_dir}/letsencrypt-prod-clusterissuer.yaml")
-        c.run("sleep 5")  # Wait for cert-manager to be ready
-
-        # Apply the account secret
-        # (Restores the Let's Encrypt account private key)
-        # Critical for avoiding rate limits - without this, cert-manager would create a
-        # new account and potentially hit duplicate certificate limits
-        c.run(f"kubectl apply -f ~/{backup_dir}/letsencrypt-prod-secret.yaml")
+        wait_ready(c, [WaitSpec("clusterissuer/letsencrypt-prod", "condition=Ready")], deadline_s=120)
 
         # Apply the TLS secret
         # Restores the actual TLS certificate and private key
@@ -251,16 +339,21 @@ def install_mattermost_with_helm(c: du.StateConnection):
         c.string_to_file(cluster_issuer, "~/cluster-issuer.yaml", mode=">")
         c.run("kubectl apply -f cluster-issuer.yaml")
 
+    # Parts 6 - 9: all objects are rendered first and then applied together (only the changed ones, see
+    # setup_lib/manifests.py)
+    manifests = ManifestSet()
+    # ("Always" is the default for the tag `latest`; in airgap mode the imported images must be used)
+    image_pull_policy = "IfNotPresent" if airgap else "Always"
+
     # Part 6: Create Mattermost Namespace & Storage
-    # Check if namespace exists
-    ns_check = c.run("kubectl get namespace mattermost", warn=True, hide=True)
-    if ns_check.return_code != 0:
-        c.run("kubectl create namespace mattermost")
-    else:
-        print("mattermost namespace already exists, skipping creation")
     mattermost_storage = dedent(f"""
     ---
     apiVersion: v1
+    kind: Namespace
+    metadata:
+      name: mattermost
+    ---
+    apiVersion: v1
     kind: PersistentVolumeClaim
     metadata:
       name: mattermost-data
@@ -286,11 +379,24 @@ def install_mattermost_with_helm(c: du.StateConnection):
         requests:
           storage: 10Gi
     """)
-    c.string_to_file(mattermost_storage, "~/mattermost-storage.yaml", mode=">")
-    c.run("kubectl apply -f mattermost-storage.yaml")
+    manifests.add(mattermost_storage)
 
     # Part 7: Deploy PostgreSQL
 
+    # settings derived from the memory limit of the container (see setup_lib/postgres.py);
+    # with PgBouncer (transaction pooling) postgres needs only a few server connections
+    use_pgbouncer = config("mattermost::pgbouncer", ignore_undefined=True, default=False)
+    pgbouncer_pool_size = 20
+    pgbouncer_max_client_conn = 500
+    # (without PgBouncer: the default of postgres)
+    max_connections = pgbouncer_pool_size + 10 if use_pgbouncer else 100
+    tuning = pgtune(
+        pg_res["memory_limit_mb"], cpus=max(1, pg_res["cpu_limit_m"] // 1000), max_connections=max_connections,
+        ssd=preflight.is_ssd(preflight_results, preflight.LOCAL_PATH_STORAGE_DIR),
+    )
+    print(du.dim("\n".join(tuning.reasoning)))
+    postgres_conf = postgresql_conf(tuning.settings, listen_all=True)
+
     postgres_config = dedent(f"""
     ---
     apiVersion: v1
@@ -311,6 +417,9 @@ def install_mattermost_with_helm(c: du.StateConnection):
       namespace: mattermost
     spec:
       replicas: 1
+      # the old postmaster must stop before a new pod mounts the same data directory (RWO volume, one node)
+      strategy:
+        type: Recreate
       selector:
         matchLabels:
           app: postgres
@@ -318,10 +427,14 @@ def install_mattermost_with_helm(c: du.StateConnection):
         metadata:
           labels:
             app: postgres
+          annotations:
+            # a changed config results in a new pod
+            checksum/config: "{config_hash(postgres_conf)}"
         spec:
           containers:
           - name: postgres
-            image: postgres:15-alpine
+            image: {POSTGRES_IMAGE}
+            args: ["-c", "config_file=/etc/postgresql/postgresql.conf"]
             ports:
             - containerPort: 5432
             envFrom:
@@ -331,17 +444,23 @@ def install_mattermost_with_helm(c: du.StateConnection):
             - name: postgres-storage
               mountPath: /var/lib/postgresql/data
               subPath: postgres
+            - name: postgres-config
+              mountPath: /etc/postgresql/postgresql.conf
+              subPath: postgresql.conf
             resources:
               requests:
-                memory: "512Mi"
-                cpu: "250m"
+                memory: "{pg_res['memory_request_mb']}Mi"
+                cpu: "{pg_res['cpu_request_m']}m"
               limits:
-                memory: "1Gi"
-                cpu: "500m"
+                memory: "{pg_res['memory_limit_mb']}Mi"
+                cpu: "{pg_res['cpu_limit_m']}m"
           volumes:
           - name: postgres-storage
             persistentVolumeClaim:
               claimName: postgres-data
+          - name: postgres-config
+            configMap:
+              name: postgres-config
     ---
     apiVersion: v1
     kind: Service
@@ -356,12 +475,26 @@ def install_mattermost_with_helm(c: du.StateConnection):
         targetPort: 5432
 
     """)
-    c.string_to_file(postgres_config, "~/postgres.yaml", mode=">")
-    c.run("kubectl apply -f postgres.yaml")
-    c.run("kubectl get pods -n mattermost")
+    postgres_config = postgres_configmap_yaml(postgres_conf) + postgres_config
+    if use_pgbouncer:
+        postgres_config += pgbouncer_yaml(
+            pool_size=pgbouncer_pool_size, max_client_conn=pgbouncer_max_client_conn,
+            image_pull_policy=image_pull_policy,
+        )
+    manifests.add(postgres_config)
 
     # Part 8: Deploy Mattermost
-    MM_SQLSETTINGS_DATASOURCE = f"postgres://{config('mattermost::psql_user')}:{config('mattermost::psql_password')}@postgres:5432/mattermost?sslmode=disable&connect_timeout=10"
+    MM_SQLSETTINGS_DATASOURCE = datasource(
+        config("mattermost::psql_user"), config("mattermost::psql_password"), pgbouncer=use_pgbouncer
+    )
+    # connection pool of each replica aligned with max_connections of postgres (or PgBouncer)
+    sql_pool = sql_pool_settings(
+        max_connections, replicas=hpa_max_replicas,
+        pgbouncer_max_client_conn=pgbouncer_max_client_conn if use_pgbouncer else None,
+    )
+    print(du.dim("\n".join(sql_pool.reasoning)))
+    # with the autoscaler, the number of replicas is not part of the manifest (it would be reset on every apply)
+    replicas_spec = "replicas: 1" if hpa_max_replicas <= 1 else "# replicas: managed by the HorizontalPodAutoscaler"
     mattermost_config = dedent(f"""
     ---
     apiVersion: v1
@@ -379,7 +512,7 @@ def install_mattermost_with_helm(c: du.StateConnection):
       name: mattermost
       namespace: mattermost
     spec:
-      replicas: 1
+      {replicas_spec}
       selector:
         matchLabels:
           app: mattermost
@@ -390,7 +523,8 @@ def install_mattermost_with_helm(c: du.StateConnection):
         spec:
           containers:
           - name: mattermost
-            image: mattermost/mattermost-team-edition:latest
+            image: {MATTERMOST_IMAGE}
+            imagePullPolicy: {image_pull_policy}
             ports:
             - containerPort: 8065
             env:
@@ -400,6 +534,10 @@ def install_mattermost_with_helm(c: du.StateConnection):
               value: "{config('mattermost::site_url')}"
             - name: MM_SERVICESETTINGS_LISTENADDRESS
               value: ":8065"
+            - name: MM_SQLSETTINGS_MAXOPENCONNS
+              value: "{sql_pool.max_open}"
+            - name: MM_SQLSETTINGS_MAXIDLECONNS
+              value: "{sql_pool.max_idle}"
             - name: MM_FILESETTINGS_DIRECTORY
               value: "/mattermost/data"
             envFrom:
@@ -410,11 +548,11 @@ def install_mattermost_with_helm(c: du.StateConnection):
               mountPath: /mattermost/data
             resources:
               requests:
-                memory: "1Gi"
-                cpu: "500m"
+                memory: "{mm_res['memory_request_mb']}Mi"
+                cpu: "{mm_res['cpu_request_m']}m"
               limits:
-                memory: "2Gi"
-                cpu: "1000m"
+                memory: "{mm_res['memory_limit_mb']}Mi"
+                cpu: "{mm_res['cpu_limit_m']}m"
             livenessProbe:
               httpGet:
                 path: /api/v4/system/ping
@@ -444,8 +582,9 @@ def install_mattermost_with_helm(c: du.StateConnection):
       - port: 8065
         targetPort: 8065
     """)
-    c.string_to_file(mattermost_config, "~/mattermost.yaml", mode=">")
-    c.run("kubectl apply -f mattermost.yaml")
+    if hpa_max_replicas > 1:
+        mattermost_config += hpa_yaml("mattermost", "mattermost", hpa_max_replicas)
+    manifests.add(mattermost_config)
 
     # Configure Ingress with TLS
 
@@ -479,12 +618,23 @@ def install_mattermost_with_helm(c: du.StateConnection):
                 port:
                   number: 8065
     """)
-    c.string_to_file(mattermost_ingress_config, "~/mattermost-ingress.yaml", mode=">")
+    manifests.add(mattermost_ingress_config)
 
-    c.run("kubectl apply -f mattermost-ingress.yaml")
+    # one `kubectl get` for the comparison and one server-side apply for the changed objects
+    manifests.apply(c)
 
     # Part 10: Verify Deployment
 
+    # returns as soon as the pods are ready and the ingress controller has published an address
+    ready_specs = [
+        WaitSpec("deployment/postgres", "condition=Available", namespace="mattermost"),
+        WaitSpec("deployment/mattermost", "condition=Available", namespace="mattermost"),
+        WaitSpec("ingress/mattermost-ingress", "jsonpath={.status.loadBalancer.ingress}", namespace="mattermost"),
+    ]
+    if use_pgbouncer:
+        ready_specs.insert(1, WaitSpec("deployment/pgbouncer", "condition=Available", namespace="mattermost"))
+    wait_ready(c, ready_specs, deadline_s=600)
+
     c.run("kubectl get all -n mattermost")
     c.run("kubectl get ingress -n mattermost")
     c.run("kubectl get certificate -n mattermost")
@@ -500,16 +650,11 @@ def install_mattermost_with_helm(c: du.StateConnection):
     if not os.path.exists(backup_dir) or not os.path.exists(f"{backup_dir}/mattermost-tls-secret.yaml"):
         print("Waiting for certificate to be ready...")
 
-        # Wait up to 10 minutes for certificate to be ready
-        for i in range(60):  # 60 attempts, 10 seconds each = 10 minutes max
-            cert_status = c.run("kubectl get certificate mattermost-tls -n mattermost -o jsonpath='{.status.conditions[?(@.type==\"Ready\")].status}'", warn=True, hide=True)
-            if cert_status.stdout.strip() == "True":
-                print("Certificate is ready!")
-                break
-            print(f"Certificate not ready yet, waiting... (attempt {i+1}/60)")
-            time.sleep(10)
-        else:
-            print("Warning: Certificate may not be ready yet, but proceeding with backup attempt")
+        # Wait up to 10 minutes for certificate to be ready (returns as soon as the ACME challenge succeeded)
+        wait_ready(
+            c, [WaitSpec("certificate/mattermost-tls", "condition=Ready", namespace="mattermost")],
+            deadline_s=600,
+        )
 
         # Create remote backup directory and generate certificate files
         c.run(f"mkdir -p ~/{backup_dir}")
@@ -528,11 +673,27 @@ def install_mattermost_with_helm(c: du.StateConnection):
     # 10.4 Access Mattermost
     # Navigate to https://chat.yourdomain.com and create your admin account.
 
-    time.sleep(10)
     print(f'Now you should be able to access the Mattermost UI at {config("mattermost::site_url")}')
     # IPS()
 
 
-install_starship_tmux_mc(c)
-install_mattermost_with_helm(c)
+if args.compile:
+    if not args.plan_only:
+        bundle = BundleRecorder(remote, user)
+    bundle.record(install_starship_tmux_mc)
+    bundle.record(install_mattermost_with_helm)
+    # the bundle contains secrets of the host (fleet mode: one file per host)
+    bundle_fpath = pjoin(fleet.host_dir("."), args.compile)
+    if args.plan_only:
+        bundle.write(bundle_fpath)
+    else:
+        bundle.execute(c, bundle_fpath)
+else:
+    # pre-flight: short disk tests of the local-path storage (postgres volume), cpu and memory (once per host,
+    # stored with the facts); a too slow host is rejected
+    preflight_results = preflight.run_preflight(c, facts, [preflight.LOCAL_PATH_STORAGE_DIR])
+    allow_slow_host = config("preflight::allow_slow_host", ignore_undefined=True, default=False)
+    print(du.dim("\n".join(preflight.check_host(preflight_results, allow_slow=allow_slow_host))))
+    install_starship_tmux_mc(c)
+    install_mattermost_with_helm(c)
 exit()
@@ -30,8 +30,12 @@ try:
 except ImportError as err:
     print("You need to install the package `deploymentutils` to run this script.")
 
+from setup_lib.connection import MuxConnection
+from setup_lib.facts import HostFacts
+from setup_lib.postgres import pgtune, postgresql_conf, write_conf_d
 
-# call this before running the script:
+
+# call this before running the script (all ssh traffic is multiplexed over one master connection):
 # eval $(ssh-agent); ssh-add -t 10m
 
 
@@ -61,16 +65,11 @@ temp_workdir = pjoin(du.get_dir_of_this_file(), "tmp_workdir")  # this will be d
 os.system(f"rm -rf {temp_workdir}")
 os.makedirs(temp_workdir)
 
-c = du.StateConnection(remote, user=user, target="remote", parse_args=True)
+c = MuxConnection(remote, user=user, target="remote", parse_args=True)
 
-c.run(f"echo hello new vm with os:")
-# get name of Linux distribution
-res = c.run(f"lsb_release -a")
-res = c.run(f"lsb_release -a")
-res = c.run(f"lsb_release -a")
-res = c.run(f"lsb_release -a")
-res = c.run(f"lsb_release -a")
-res = c.run(f"lsb_release -a")
+# os, cores, memory, installed packages etc. (one remote command, cached for the run, see setup_lib/facts.py)
+facts = HostFacts(c)
+print(f"host: {facts['os']} ({facts['arch']}), {facts['nproc']} cores, {facts['mem_total_mb']} MiB RAM")
 exit()
 
 
@@ -95,6 +94,11 @@ def prepare01(c: du.StateConnection):
     cmd_string = " ".join(psql_commands)
     c.run(f"sudo -u postgres psql {cmd_string}")
 
+    # settings derived from the host (mattermost runs on the same host -> postgres gets half of the memory)
+    tuning = pgtune(facts["mem_total_mb"] // 2, cpus=facts["nproc"])
+    print(du.dim("\n".join(tuning.reasoning)))
+    write_conf_d(c, postgresql_conf(tuning.settings))
+
 
     """
     """
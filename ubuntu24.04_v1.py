@@ -9,8 +9,8 @@ It also incorporates some customization (e.g. starship and mc to simplify debugg
 
 import time
 import os
+import shutil
 import sys
-import os
 from os.path import join as pjoin
 from textwrap import dedent
 
@@ -32,18 +32,40 @@ try:
 except ImportError as err:
     print("You need to install the package `deploymentutils` to run this script.")
 
-
-# call this before running the script:
+from setup_lib.bundle import BundleRecorder
+from setup_lib.stepcache import StepCache, TrackingConfig
+from setup_lib.scheduler import StepScheduler
+from setup_lib.packages import PackagePlan
+from setup_lib.artifacts import ArtifactCache
+from setup_lib.editing import EditBatch
+from setup_lib.occ import OCC_BASE_CMD, OccConfig
+from setup_lib.facts import HostFacts
+from setup_lib.sizing import (
+    size_fpm_pool, fpm_pool_replacements, opcache_budget_mb, cache_memory_mb,
+    read_php_source_stats, size_caches, cache_ini, PRELOAD_PHP,
+)
+from setup_lib.redis_cache import redis_packages, setup_redis, nextcloud_redis_config
+from setup_lib.mariadb import MARIADB_SOCKET, buffer_pool_mb, mariadb_profile, apply_profile
+from setup_lib.extract import PhaseTimer, extract_cmd, stream_extract, zstd_repack
+from setup_lib import fleet
+from setup_lib import tracing
+from setup_lib import cassette
+from setup_lib import preflight
+
+
+# call this before running the script (all ssh traffic is multiplexed over one master connection):
 # eval $(ssh-agent); ssh-add -t 10m
 
 
-# simplify debugging
-activate_ips_on_exception()
+# simplify debugging (not in fleet mode where the script runs without terminal)
+if not fleet.is_fleet_worker():
+    activate_ips_on_exception()
 
 
 # -------------------------- Essential Config section  ------------------------
 
-config = du.get_nearest_config("config.toml")
+# track which config values are read by the steps (they are part of the step fingerprints)
+config = TrackingConfig(du.get_nearest_config(fleet.config_fpath("config.toml")))
 
 remote = config("remote")
 user = config("user")
@@ -53,23 +75,102 @@ user = config("user")
 
 PHP_VERSION = "8.3"
 
+# opcache jit buffer (MiB)
+JIT_BUFFER_MB = 256
+
 # this is the root dir of the project (where setup.py lies)
 # if you maintain more than one instance (and deploy.py lives outside the project dir, this has to change)
 project_src_path = os.path.dirname(du.get_dir_of_this_file())
 
-temp_workdir = pjoin(du.get_dir_of_this_file(), "tmp_workdir")  # this will be deleted/overwritten
+# this will be deleted/overwritten (fleet mode: one per host)
+temp_workdir = pjoin(fleet.host_dir(du.get_dir_of_this_file()), "tmp_workdir")
 
 # ensure clean workdir
-os.system(f"rm -rf {temp_workdir}")
+shutil.rmtree(temp_workdir, ignore_errors=True)
 os.makedirs(temp_workdir)
 
-c = du.StateConnection(remote, user=user, target="remote")
+du.argparser.add_argument(
+    "--compile", metavar="FPATH", help="record all steps into one shell script (bundle), upload and run it"
+)
+du.argparser.add_argument("--plan-only", action="store_true", help="together with --compile: only write the bundle")
+
+args = du.parse_args()
+
+# config secrets are not stored in the cassette and in the trace
+secrets = [config("nc_admin_pw"), config("sql_password")]
+
+# the connection is also needed with --plan-only: the php-fpm pool, the caches and mariadb in the bundle are
+# sized for the host (see `host_facts` below)
+# NST_CASSETTE_MODE=record|replay: record the remote operations or replay them offline (see setup_lib/cassette.py)
+c = cassette.open_connection(remote, user=user, target="remote", redact=secrets)
+# time every operation (per step); the trace is written to traces/ at exit (see setup_lib/tracing.py)
+tracing.install(c, redact=secrets)
+
+# os, cores, memory, installed packages etc. (one remote command, cached for the run, see setup_lib/facts.py)
+facts = HostFacts(c)
+print(f"host: {facts['os']} ({facts['arch']}), {facts['nproc']} cores, {facts['mem_total_mb']} MiB RAM")
+
+# used to size the php-fpm pool, the caches and mariadb
+host_facts = facts.sizing()
+
+# the steps declare their apt packages; they are installed together in one transaction
+package_plan = PackagePlan()
+
+# downloads on the control machine (shared by all runs and hosts)
+artifact_cache = ArtifactCache()
+
+# durations of fetching, transferring and extracting the release
+install_phases = PhaseTimer()
+
+# results of the pre-flight disk, cpu and memory tests (set before the installation, see setup_lib/preflight.py);
+# empty in compile mode (a bundle does not depend on the host it was compiled for)
+preflight_results = {}
 
-c.run(f"echo hello new vm with os:")
-# get name of Linux distribution
-res = c.run(f"lsb_release -a")
+
+CACHE_BACKENDS = ("memcached", "redis", "redis-locking")
+
+
+def cache_backend() -> str:
+    # "memcached" (default): file locking and distributed cache in memcached
+    # "redis": file locking and distributed cache in redis (recommended by Nextcloud, memcached is not installed)
+    # "redis-locking": file locking in redis (locks are never evicted), distributed cache in memcached (LRU)
+    backend = config("cache_backend", ignore_undefined=True, default="memcached")
+    if backend not in CACHE_BACKENDS:
+        msg = f"invalid cache_backend `{backend}` (valid values: {CACHE_BACKENDS})"
+        raise ValueError(msg)
+    return backend
+
+
+def uses_redis() -> bool:
+    return cache_backend() != "memcached"
+
+
+def uses_memcached() -> bool:
+    return cache_backend() != "redis"
+
+
+def cache_backend_memory_mb() -> int:
+    # memory of the distributed cache ("redis-locking": the locks in redis need negligible memory)
+    if cache_backend() == "redis":
+        # locks and cache in one instance which never evicts -> the whole budget
+        return cache_memory_mb(config("redis_memory", ignore_undefined=True, default="auto"), host_facts)
+    # "auto": upper bound (the actual value is set after extraction)
+    return cache_memory_mb(config("memcached_memory"), host_facts)
+
+
+def fpm_pool_sizing() -> du.EContainer:
+    # php-fpm pool size derived from cores and memory (see setup_lib/sizing.py for the model)
+    # opcache: upper bound (the actual value is set after extraction); mariadb: planned buffer pool
+    return size_fpm_pool(
+        host_facts,
+        cache_backend_memory_mb(),
+        opcache_budget_mb(host_facts),
+        JIT_BUFFER_MB,
+        innodb_buffer_pool_mb=buffer_pool_mb(host_facts),
+    )
 
 
+@package_plan.requires("tmux rsync mc")
 def install_starship_tmux_mc(c: du.StateConnection):
     c.run(f"mkdir -p ~/tmp")
     c.run(f"mkdir -p ~/bin")
@@ -96,24 +197,29 @@ def install_starship_tmux_mc(c: du.StateConnection):
 
     c.string_to_file(bashrc_content, "~/.bashrc", mode=">>")
 
-    c.run(f"sudo apt update && sudo apt upgrade -y")
-    c.run(f"apt install --assume-yes tmux rsync")
+    # one `apt-get update` for upgrade and installation of all planned packages
+    package_plan.apply(c, upgrade=True)
 
     # midnight commander with lynx like motion
-    c.run(f"apt install --assume-yes mc")
     c.run(f"mkdir -p ~/.config/mc")
     # trailing slash at source is important
     c.rsync_upload("config_files/mc/", "~/.config/mc", "remote")
 
 
+@package_plan.requires("curl wget gnupg2 lsb-release ca-certificates imagemagick unzip smbclient")
 def nc_prep01(c: du.StateConnection):
-    c.run("apt install --assume-yes curl wget gnupg2 lsb-release ca-certificates")
-    c.run("apt install --assume-yes apache2")
-    c.run("apt install --assume-yes imagemagick memcached libmemcached-tools mariadb-server unzip smbclient")
-    php_modules = "{cli,common,curl,gd,mbstring,xml,zip,intl,gmp,bcmath,mysql,imagick,memcached,apcu}"
-    c.run(f"apt install --assume-yes php{PHP_VERSION}-fpm php{PHP_VERSION}-{php_modules}")
+    # install the packages of all steps (one `dpkg-query` to find the missing ones, one apt transaction)
+    package_plan.apply(c, facts=facts)
 
 
+if uses_memcached():
+    package_plan.require("nc_prep02", f"memcached libmemcached-tools php{PHP_VERSION}-memcached")
+
+
+@package_plan.requires(
+    "apache2 "
+    f"php{PHP_VERSION}-fpm php{PHP_VERSION}-{{cli,common,curl,gd,mbstring,xml,zip,intl,gmp,bcmath,mysql,imagick,apcu}}"
+)
 def nc_prep02(c: du.StateConnection):
     c.run(f"a2enconf php{PHP_VERSION}-fpm")
 
@@ -168,14 +274,16 @@ def nc_prep02(c: du.StateConnection):
 
     """).lstrip("\n")
 
-    c.multi_edit_file("/etc/memcached.conf", [("-m 64", f"-m {config('memcached_memory')}")])
+    # all config files are fetched in one transfer, edited locally and written back together (only if changed)
+    edits = EditBatch(c)
+
+    sizing = fpm_pool_sizing()
+    if not getattr(c, "records_only", False):
+        print(du.dim("\n".join(sizing.reasoning)))
 
     pool_conf_fpath = f"/etc/php/{PHP_VERSION}/fpm/pool.d/www.conf"
     replacements = [
-        ("max_children = 5", "max_children = 80"),
-        ("start_servers = 2", "start_servers = 20"),
-        ("min_spare_servers = 1", "min_spare_servers = 20"),
-        ("max_spare_servers = 3", "max_spare_servers = 60"),
+        *fpm_pool_replacements(sizing),
 
         (";env[HOSTNAME] = $HOSTNAME", "env[HOSTNAME] = $HOSTNAME"),
         (";env[PATH] = /usr/local/bin:/usr/bin:/bin", "env[PATH] = /usr/local/bin:/usr/bin:/bin",),
@@ -183,17 +291,15 @@ def nc_prep02(c: du.StateConnection):
         (";env[TMPDIR] = /tmp", "env[TMPDIR] = /tmp"),
         (";env[TEMP] = /tmp", "env[TEMP] = /tmp"),
     ]
-    c.multi_edit_file(pool_conf_fpath, replacements)
+    edits.add(pool_conf_fpath, replacements)
 
     php_ini_fpath = f"/etc/php/{PHP_VERSION}/fpm/php.ini"
     replacements = [
         ("memory_limit = 128M", "memory_limit = 1024M"),
         ("post_max_size = 8M", "post_max_size = 512M"),
         ("upload_max_filesize = 2M", "upload_max_filesize = 1024M"),
+        # memory_consumption, interned_strings_buffer and max_accelerated_files: see `download_and_unzip_nc`
         (";opcache.enable=1", "opcache.enable=1"),
-        (";opcache.memory_consumption=128", "opcache.memory_consumption=1024"),
-        (";opcache.interned_strings_buffer=8", "opcache.interned_strings_buffer=64"),
-        (";opcache.max_accelerated_files=10000", "opcache.max_accelerated_files=150000"),
         (";opcache.max_wasted_percentage=5", "opcache.max_wasted_percentage=15"),
         (";opcache.revalidate_freq=2", "opcache.revalidate_freq=60"),
         (";opcache.save_comments=1", "opcache.save_comments=1"),
@@ -211,22 +317,48 @@ def nc_prep02(c: du.StateConnection):
     ;opcache.lockfile_path=/tmp
 
     opcache.jit=1255
-    opcache.jit_buffer_size=256M
+    opcache.jit_buffer_size={JIT_BUFFER_MB}M
 
     [curl]
     """).lstrip("\n")
 
     replacements.append((old, new))
-    c.multi_edit_file(php_ini_fpath, replacements)
+    edits.add(php_ini_fpath, replacements)
+
+    changed = edits.apply()
+    if pool_conf_fpath in changed or php_ini_fpath in changed:
+        c.run(f"systemctl restart php{PHP_VERSION}-fpm")
+
+
+if uses_redis():
+    package_plan.require("setup_redis_cache", redis_packages(PHP_VERSION))
 
 
+def setup_redis_cache(c: du.StateConnection):
+    # redis on a unix socket for the file locking ("redis": and the distributed cache, with a memory limit)
+    maxmemory_mb = cache_backend_memory_mb() if cache_backend() == "redis" else 0
+    setup_redis(c, PHP_VERSION, maxmemory_mb)
+
+
+@package_plan.requires("mariadb-server")
 def nc_prep03(c: du.StateConnection):
 
+    # buffer pool, redo log and connections sized from the memory and the php-fpm concurrency
+    # flush method and io capacity from the pre-flight disk tests of the data directory
+    profile = mariadb_profile(
+        host_facts, fpm_pool_sizing().max_children, io=preflight.innodb_io_settings(preflight_results)
+    )
+    if not getattr(c, "records_only", False):
+        print(du.dim("\n".join(profile.reasoning)))
+    apply_profile(c, profile)
+    if not getattr(c, "records_only", False):
+        facts.invalidate("innodb_buffer_pool_mb")
+
     user = config("sql_user")
     password = config("sql_password")
 
     sql_commands = [
-        f"CREATE USER '{user}'@'localhost' IDENTIFIED BY '{password}';",
+        f"CREATE USER IF NOT EXISTS '{user}'@'localhost' IDENTIFIED BY '{password}';",
         f"CREATE DATABASE IF NOT EXISTS nextcloud CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci;",
         f"GRANT ALL PRIVILEGES ON nextcloud.* TO '{config('sql_user')}'@'localhost';",
         "FLUSH PRIVILEGES;",
@@ -235,30 +367,85 @@ def nc_prep03(c: du.StateConnection):
     for cmd in sql_commands:
         c.run(f"mysql --execute \"{cmd}\"")
 
+def fetch_nc_tarball(c: du.StateConnection):
+    # independent of the package installation -> can run concurrently (/var/www might not exist yet)
+    # the tarball is downloaded once to the local artifact cache, verified and pushed (skipped if already there)
+    url = config("nc_release_file_url")
+    stream = config("nc_transfer_mode", ignore_undefined=True, default="push") == "stream"
+    if getattr(c, "fingerprint_only", False):
+        # the fingerprint covers the url and the transfer mode (no download before the skip decision)
+        return
+
+    with install_phases.phase(c, "fetch to local cache"):
+        entry = artifact_cache.fetch(url, checksum_url=f"{url}.sha256")
+
+    if stream:
+        # nothing is stored on the host, the archive is piped into tar by `download_and_unzip_nc`
+        with install_phases.phase(c, "zstd repack (local)"):
+            zstd_repack(entry["fpath"])
+        return
+
+    c.run("mkdir -p /var/www")
+    with install_phases.phase(c, "push to host"):
+        artifact_cache.push(c, url, f"/var/www/{os.path.basename(url)}")
+
+
+@package_plan.requires("lbzip2 zstd")
 def download_and_unzip_nc(c: du.StateConnection):
 
     c.chdir("/var/www")
-    c.run(f"wget {config('nc_release_file_url')}")
 
-    # unpack tar.bz2 file
-    c.run("tar xjf nextcloud*.tar.bz2")
-    c.run("chown -R www-data:www-data /var/www/nextcloud")
+    # unpack (decompression on all cores, tar runs as www-data -> no `chown -R` afterwards)
+    url = config("nc_release_file_url")
+    if config("nc_transfer_mode", ignore_undefined=True, default="push") == "stream":
+        # fingerprint: the url is covered (no download and repacking before the skip decision)
+        if not getattr(c, "fingerprint_only", False):
+            with install_phases.phase(c, "stream + decompress + extract"):
+                entry = artifact_cache.fetch(url)
+                stream_extract(c, zstd_repack(entry["fpath"]), "/var/www/nextcloud")
+    else:
+        with install_phases.phase(c, "decompress + extract"):
+            c.run(extract_cmd(f"/var/www/{os.path.basename(url)}", "/var/www/nextcloud"), use_dir=False)
+
+    if not getattr(c, "records_only", False):
+        print(install_phases.report())
+
+    # size opcache, APCu and memcached from the extracted php files (incl. apps) and the memory of the host
+    php_stats = read_php_source_stats(c, "/var/www/nextcloud")
+    memcached_memory = config("memcached_memory") if uses_memcached() else None
+    cache_sizing = size_caches(host_facts, php_stats, memcached_memory)
+    if not getattr(c, "records_only", False):
+        print(du.dim("\n".join(cache_sizing.reasoning)))
+    if uses_memcached():
+        edits = EditBatch(c)
+        edits.add("/etc/memcached.conf", [("-m 64", f"-m {cache_sizing.memcached_mb}")])
+        edits.apply()
+
+    preload_fpath = None
+    if config("nc_opcache_preload", ignore_undefined=True, default=False):
+        # outside of the webroot (not affected by updates)
+        preload_fpath = "/var/www/nextcloud-preload.php"
+        c.string_to_file(PRELOAD_PHP, preload_fpath)
+    cache_ini_fpath = f"/etc/php/{PHP_VERSION}/fpm/conf.d/90-nextcloud-cache.ini"
+    c.string_to_file(cache_ini(cache_sizing, preload_fpath), cache_ini_fpath)
 
     # disable default apache2 demo page
     c.run("a2dissite 000-default.conf")
     c.run("a2ensite nextcloud.conf")
 
     c.run("systemctl restart apache2")
-    c.run("systemctl restart memcached")
+    if uses_memcached():
+        c.run("systemctl restart memcached")
     c.run(f"systemctl restart php{PHP_VERSION}-fpm")
 
 
 def initial_nc_config(c):
 
-    occ_base_cmd = "sudo -u www-data php /var/www/nextcloud/occ"
+    occ_base_cmd = OCC_BASE_CMD
     cmd1 = dedent(f"""
     {occ_base_cmd} maintenance:install \
     --database "mysql" \
+    --database-host "localhost:{MARIADB_SOCKET}" \
     --database-name "nextcloud" \
     --database-user "{config("sql_user")}" \
     --database-pass "{config("sql_password")}" \
@@ -267,41 +454,89 @@ def initial_nc_config(c):
     --data-dir "/var/www/nextcloud/data"
     """)
     c.run(cmd1)
-    cmd2 = f'{occ_base_cmd} config:system:set trusted_domains 1 --value="{config("server_name")}"'
-    c.run(cmd2)
 
-    # this url will be used e.g. in automatically generated emails
-    cmd3 = f'{occ_base_cmd} config:system:set overwrite.cli.url --value="https://{config("server_name")}"'
+    # all system values are applied with one `occ config:import` (one PHP bootstrap instead of one per key)
+    occ_config = OccConfig()
 
-    c.run(cmd3)
-
-    # activate memcache (recommendation from the video)
-    pairs = [
-        ("memcache.local", r"\OC\Memcache\APCu"),
-        ("memcache.distributed", r"\OC\Memcache\Memcached"),
-        ("memcache.locking", r"\OC\Memcache\Memcached"),
-    ]
-    for varname, value in pairs:
-        # note that if you edit the config file (display it with `cat config.php`) the backslashes appear
-        # doubled (e.g. "\\OC\\Memcache\\Memcached" representing "\OC\Memcache\Memcached")
-        cmd4 = f"{occ_base_cmd} config:system:set {varname} --value='{value}'"
-        c.run(cmd4)
+    # the complete list is set (maintenance:install creates the entry "localhost")
+    occ_config.set_system("trusted_domains", ["localhost", config("server_name")])
 
+    # this url will be used e.g. in automatically generated emails
+    occ_config.set_system("overwrite.cli.url", f"https://{config('server_name')}")
 
-if 0:
+    # activate memcache (recommendation from the video)
+    # note that if you edit the config file (display it with `cat config.php`) the backslashes appear
+    # doubled (e.g. "\\OC\\Memcache\\Memcached" representing "\OC\Memcache\Memcached")
+    if uses_redis():
+        occ_config.update_system(nextcloud_redis_config(distributed=cache_backend() == "redis"))
+    else:
+        occ_config.update_system({
+            "memcache.local": r"\OC\Memcache\APCu",
+            "memcache.distributed": r"\OC\Memcache\Memcached",
+            "memcache.locking": r"\OC\Memcache\Memcached",
+        })
+    occ_config.apply(c)
+
+    # indices and primary keys which are not created by the installation itself
+    c.run(f"{occ_base_cmd} db:add-missing-indices && {occ_base_cmd} db:add-missing-primary-keys")
+
+
+# fleet mode (`python -m setup_lib.fleet fleet.toml`) always runs the installation
+if args.compile:
+    # compile the installation into one shell script (reviewable plan) which is uploaded once
+    # and executed in a single round trip
+    bundle = BundleRecorder(remote, user)
+    step_funcs = [nc_prep01, fetch_nc_tarball, nc_prep02, nc_prep03, download_and_unzip_nc]
+    if uses_redis():
+        step_funcs.append(setup_redis_cache)
+    for step_func in (*step_funcs, initial_nc_config):
+        bundle.record(step_func)
+    # the bundle contains secrets of the host (fleet mode: one file per host)
+    bundle_fpath = pjoin(fleet.host_dir("."), args.compile)
+    if args.plan_only:
+        bundle.write(bundle_fpath)
+    else:
+        bundle.execute(c, bundle_fpath)
+else:
     # this is needed when run nc prep from scratch because it is missing in my test-image
     c.run(f"apt install --assume-yes rsync")
     c.run(f"mkdir -p ~/.config/mc")
     c.rsync_upload("config_files/mc/", "~/.config/mc", "remote")
 
+    # pre-flight: short disk tests of the data directory, cpu and memory (once per host, stored with the facts);
+    # a too slow host is rejected
+    preflight_results = preflight.run_preflight(c, facts, [preflight.NEXTCLOUD_DATA_DIR])
+    allow_slow_host = config("preflight::allow_slow_host", ignore_undefined=True, default=False)
+    print(du.dim("\n".join([
+        *preflight.check_host(preflight_results, allow_slow=allow_slow_host),
+        *preflight.data_volume_advice(preflight_results).reasoning,
+    ])))
+
     # this is the actual nextcloud installation:
-    nc_prep01(c)
-    nc_prep02(c)
-    nc_prep03(c)
-    download_and_unzip_nc(c)
+    # steps which already ran with identical commands and config values on this host are skipped
+    # (use `step_cache.run_step(..., force=True)` or `step_cache.invalidate(...)` to enforce a re-run)
+    # the sizing facts are part of the fingerprints (pool, caches and mariadb are derived from them)
+    step_cache = StepCache(c, config, facts=host_facts)
+
+    # independent steps run concurrently (each step on its own ssh channel)
+    scheduler = StepScheduler(
+        c, runner=lambda step_func, connection: step_cache.run_step(step_func, connection=connection)
+    )
+    scheduler.add(nc_prep01)
+    scheduler.add(fetch_nc_tarball)
+    scheduler.add(nc_prep02, depends=[nc_prep01])
+    scheduler.add(nc_prep03, depends=[nc_prep01])
+    scheduler.add(download_and_unzip_nc, depends=[nc_prep02, fetch_nc_tarball])
+    config_depends = [nc_prep03, download_and_unzip_nc]
+    if uses_redis():
+        # restarts php-fpm -> after its configuration
+        scheduler.add(setup_redis_cache, depends=[nc_prep02])
+        config_depends.append(setup_redis_cache)
 
     # at this point the tutorial video continues via browser
     # we need to automate this (using `sudo -u www-data php /var/www/nextcloud/occ ...`)
-    initial_nc_config(c)
+    scheduler.add(initial_nc_config, depends=config_depends)
+    scheduler.run()
 
-IPS()
+if not fleet.is_fleet_worker():
+    IPS()